@@ -0,0 +1,98 @@
+'''Compares the server engines by playing whole games with raw protocol clients
+run from the repo root: python -m Benchmarks.EngineBench [--games N] [--stalled N] [--engines threaded asyncio]'''
+import socket, threading, multiprocessing
+import logging, argparse, copy, time, statistics
+
+from Shared import ConnectionPrimitives
+from Shared.Enums import COM
+
+SHIPS = [{'pos': [3, 0], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [4, 3], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [5, 7], 'size': 3, 'horizontal': True, 'hitted': [False, False, False]}, {'pos': [1, 5], 'size': 4, 'horizontal': False, 'hitted': [False, False, False, False]}, {'pos': [8, 4], 'size': 1, 'horizontal': True, 'hitted': [False]}, {'pos': [6, 1], 'size': 1, 'horizontal': False, 'hitted': [False]}, {'pos': [5, 9], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [1, 1], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [9, 0], 'size': 3, 'horizontal': False, 'hitted': [False, False, False]}]
+
+def runServer(engine: str, portPipe, stopEvent):
+	logging.basicConfig(level=logging.WARNING)
+	ConnectionPrimitives.DEBUG_REQS = False
+	import ServerMain
+	server = ServerMain.ENGINES[engine](('127.0.0.1', 0))
+	portPipe.send(server.serverSocket.getsockname()[1])
+	stopEvent.wait()
+	server.close(closeNow=True)
+
+class BenchClient:
+	'''plays one game over a single connection, shooting the cells in order'''
+	def __init__(self, port: int, latencies: list[float]):
+		self.conn = socket.create_connection(('127.0.0.1', port))
+		self.id = 0
+		self.reqId = 0
+		self.codec = ConnectionPrimitives.CODEC_JSON
+		self.latencies = latencies
+		self.connected = True
+	def req(self, command: COM, payload: dict) -> dict:
+		self.reqId += 1
+		start = time.perf_counter()
+		ConnectionPrimitives.send(self.conn, self.id, command, payload, self.reqId, self.codec)
+		id, recvdCommand, payload, reqId, codec = ConnectionPrimitives.recv(self.conn)
+		self.latencies.append(time.perf_counter() - start)
+		assert recvdCommand == command and reqId == self.reqId, f'unexpected response {recvdCommand} {payload}'
+		self.connected = payload['stay_connected']
+		return payload
+	def play(self):
+		res = self.req(COM.CONNECT, {'name': 'bench', 'codecs': ConnectionPrimitives.SUPPORTED_CODECS})
+		self.id, self.codec = res['id'], res['codec']
+		while not self.req(COM.PAIR, {}).get('paired'): pass
+		self.req(COM.GAME_READINESS, {'ships': copy.deepcopy(SHIPS), 'ready': True})
+		while not (res := self.req(COM.GAME_WAIT, {}))['started']: pass
+		onTurn = res['on_turn'] == self.id
+		cells = [[x, y] for y in range(10) for x in range(10)]
+		while True:
+			if onTurn:
+				if self.req(COM.SHOOT, {'pos': cells.pop(0)})['game_won']: break
+			else:
+				res = self.req(COM.OPPONENT_SHOT, {})
+				if not res['shotted']: continue
+				if res['lost']: break
+			onTurn = not onTurn
+		if self.connected: self.req(COM.DISCONNECT, {}) # NOTE polled after the winner left, the server already ended the session
+		self.conn.close()
+
+def openStalledConnections(port: int, num: int) -> list[socket.socket]:
+	'''connections which send only a part of a request and then stall'''
+	conns = []
+	for i in range(num):
+		conn = socket.create_connection(('127.0.0.1', port))
+		body = ConnectionPrimitives.encodeBody(0, COM.CONNECT, {'name': 'stalled'}, 1, ConnectionPrimitives.CODEC_JSON)
+		conn.sendall(len(body).to_bytes(ConnectionPrimitives.MSGLEN_SIZE, byteorder='big') + body[:i % len(body)])
+		conns.append(conn)
+	return conns
+
+def benchEngine(engine: str, games: int, stalled: int=0) -> dict:
+	portRecv, portSend = multiprocessing.Pipe(False)
+	stopEvent = multiprocessing.Event()
+	proc = multiprocessing.Process(target=runServer, args=(engine, portSend, stopEvent)) # NOTE not a daemon, the sharded engine starts its workers
+	proc.start()
+	port = portRecv.recv()
+	stalledConns = openStalledConnections(port, stalled)
+	latencies = []
+	clients = [BenchClient(port, latencies) for _ in range(2 * games)]
+	threads = [threading.Thread(target=c.play, daemon=True) for c in clients]
+	start = time.perf_counter()
+	for t in threads: t.start()
+	for t in threads: t.join()
+	elapsed = time.perf_counter() - start
+	stopEvent.set()
+	proc.join()
+	for conn in stalledConns: conn.close()
+	latencies.sort()
+	return {'engine': engine, 'games': games, 'stalled': stalled, 'requests': len(latencies), 'seconds': elapsed, 'reqs_per_sec': len(latencies) / elapsed,
+		'p50_ms': 1000 * statistics.median(latencies), 'p99_ms': 1000 * latencies[int(len(latencies) * .99)]}
+
+def main():
+	parser = argparse.ArgumentParser('EngineBench')
+	parser.add_argument('--games', type=int, default=100, help='number of concurrent games')
+	parser.add_argument('--stalled', type=int, default=0, help='number of connections stalled in the middle of a request')
+	parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+	args = parser.parse_args()
+	for engine in args.engines:
+		r = benchEngine(engine, args.games, args.stalled)
+		print(f"{r['engine']:>9}: {r['games']} games, {r['stalled']} stalled, {r['requests']} reqs in {r['seconds']:.2f}s = {r['reqs_per_sec']:.0f} req/s, latency p50 {r['p50_ms']:.2f}ms p99 {r['p99_ms']:.2f}ms")
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,102 @@
+'''Recovery time and append throughput of the server journal
+the games are made in the shooting stage and journaled, closing the journal compacts them into a snapshot,
+then a tail of updates is appended like the shots of a running server would be and the server "dies" without compacting it,
+the recovery reads the snapshot and the tail and indexes the players as a restarted JournaledServer does,
+unpacking the games of the players once they resume is timed apart
+run from the repo root: python -m Benchmarks.JournalBench [--games N] [--tail N] [--dir DIR] [--json FILE]'''
+import argparse, json, copy, gc, random, shutil, tempfile, time, threading, logging
+
+from Shared import Fleet
+import ServerMain
+from Server.Journal import Journal
+
+class HeadlessJournaledServer(ServerMain.JournaledServer):
+	'''only recovers the journal, without its sockets and threads'''
+	def openSocket(self, addr):
+		return None
+	def startEngine(self):
+		pass
+
+def makeGames(n: int, shots: int) -> list[ServerMain.Game]:
+	games = []
+	cells = [[x, y] for y in range(Fleet.GRID_HEIGHT) for x in range(Fleet.GRID_WIDTH)]
+	for i in range(n):
+		game = ServerMain.Game(i + 1, ServerMain.ConnectedPlayer(2*i + 1, f'player{2*i}'), ServerMain.ConnectedPlayer(2*i + 2, f'player{2*i+1}'), True)
+		for player in game.players: game.updateGameState(player, {'ships': copy.deepcopy(Fleet.AUTOPLACE_SHIPS), 'ready': True})
+		game.startShooting()
+		for pos in cells[:shots]:
+			game.shoot(game.players[game.players[0].id != game.playerOnTurn], pos)
+			game.opponentShottedReq(game.getOpponent(game.players[0]))
+		games.append(game)
+	return games
+def durable(journal: Journal):
+	'''waits until everything appended is on disk'''
+	done = threading.Event()
+	journal.whenDurable(done.set)
+	done.wait()
+
+def snapshot(directory: str, games: list[ServerMain.Game]) -> dict:
+	journal = Journal(directory)
+	journal.start()
+	started = time.perf_counter()
+	for game in games: journal.put(ServerMain.GAMES, game.id, game.pack())
+	durable(journal)
+	appended = time.perf_counter() - started
+	started = time.perf_counter()
+	journal.close()
+	return {'append_s': appended, 'records_per_s': len(games) / appended, 'commits': journal.commits, 'compact_s': time.perf_counter() - started}
+def tail(directory: str, games: list[ServerMain.Game], n: int) -> dict:
+	'''appends @n updates of random games, the journal isn't closed as if the server was killed'''
+	journal = Journal(directory)
+	journal.start()
+	cells = [[x, y] for y in range(Fleet.GRID_HEIGHT) for x in range(Fleet.GRID_WIDTH)]
+	started = time.perf_counter()
+	for _ in range(n):
+		game = random.choice(games)
+		game.shoot(game.players[game.players[0].id != game.playerOnTurn], random.choice(cells))
+		journal.put(ServerMain.GAMES, game.id, game.pack())
+	durable(journal)
+	appended = time.perf_counter() - started
+	return {'append_s': appended, 'records_per_s': n / appended, 'commits': journal.commits, 'records_per_commit': n / max(journal.commits, 1)}
+def recover(directory: str) -> dict:
+	'''the startup of a restarted JournaledServer, reading the journal is also timed alone, then every player resumes'''
+	started = time.perf_counter()
+	Journal(directory).load()
+	loaded = time.perf_counter() - started
+	server = HeadlessJournaledServer(None, directory)
+	started = time.perf_counter()
+	server.recoverJournal()
+	recovered = time.perf_counter() - started
+	players = len(server.recovered)
+	started = time.perf_counter()
+	for playerId in list(server.recovered): server.resumeRecovered(playerId)
+	return {'load_s': loaded, 'recovery_s': recovered, 'resume_all_s': time.perf_counter() - started, 'games': len(server.games), 'players': players}
+
+def main():
+	parser = argparse.ArgumentParser('JournalBench')
+	parser.add_argument('--games', type=int, default=100000, help='games in the snapshot')
+	parser.add_argument('--shots', type=int, default=20, help='shots already fired in every game')
+	parser.add_argument('--tail', type=int, default=100000, help='updates appended after the snapshot')
+	parser.add_argument('--dir', help='directory of the journal, a temporary one by default')
+	parser.add_argument('--json', help='also write the results to this file')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+	directory = args.dir or tempfile.mkdtemp(prefix='journalbench-')
+	try:
+		games = makeGames(args.games, args.shots)
+		results = {'games': args.games, 'record_bytes': len(games[0].pack()), 'snapshot': snapshot(directory, games), 'tail': tail(directory, games, args.tail)}
+		del games # NOTE the restarted server starts without them
+		gc.collect()
+		results['recovery'] = recover(directory)
+	finally:
+		if args.dir is None: shutil.rmtree(directory, ignore_errors=True)
+	print(f"{args.games} games of {results['record_bytes']} B")
+	for name in ('snapshot', 'tail'):
+		print(f"{name:>9}: {results[name]['records_per_s']:9.0f} records/s in {results[name]['commits']} commits")
+	recovery = results['recovery']
+	print(f" recovery: {recovery['recovery_s']:.3f} s for {recovery['games']} games, reading the journal alone {recovery['load_s']:.3f} s")
+	print(f"   resume: {recovery['resume_all_s']:.3f} s to unpack all {recovery['players']} players once they reconnect")
+	if args.json:
+		with open(args.json, 'w') as f: json.dump(results, f, indent=1)
+if __name__ == '__main__':
+	main()
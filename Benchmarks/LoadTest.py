@@ -0,0 +1,160 @@
+'''Load test of a local server with headless bots, reports latency percentiles and throughput per COM
+and the wake-up latency of COM.OPPONENT_SHOT, measured from sending the opponent's COM.SHOOT
+run from the repo root: python -m Benchmarks.LoadTest [--bots N] [--games N] [--ramp S] [--engine threaded] [--shared-io] [--json FILE]'''
+import multiprocessing, threading
+import logging, argparse, json, time, os, sys
+
+from Shared import ConnectionPrimitives
+from Shared.Enums import COM
+from Client.Bot import Bot
+from Client.Session import Request, SharedIOLoop
+from Benchmarks.EngineBench import runServer
+
+STEP_INTERVAL = 0.005
+
+# server process stats ------------------------------
+def statFields(pid: int) -> list[str]:
+	'''the fields of /proc/pid/stat after the process name'''
+	with open(f'/proc/{pid}/stat') as f:
+		return f.read().rsplit(')', 1)[1].split()
+def childPids(pid: int) -> list[int]:
+	'''the worker processes of the sharded engine, the listeners of the reuseport engine'''
+	children = []
+	for entry in os.listdir('/proc'):
+		try:
+			if entry.isdigit() and int(statFields(int(entry))[1]) == pid: children.append(int(entry))
+		except OSError:
+			pass
+	return children
+def processStats(pid: int) -> dict:
+	'''@return cpu seconds and rss of the process together with its children, read from /proc so only on linux'''
+	cpu, rss = 0., 0
+	ticks = os.sysconf('SC_CLK_TCK')
+	try:
+		for p in [pid] + childPids(pid):
+			fields = statFields(p)
+			cpu += (int(fields[11]) + int(fields[12])) / ticks
+			with open(f'/proc/{p}/status') as f:
+				rss += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+	except (OSError, StopIteration):
+		return {'cpu_s': None, 'rss_mb': None}
+	return {'cpu_s': cpu, 'rss_mb': rss / 2**20}
+
+class ServerSampler:
+	'''samples cpu and rss of the server process while the test runs'''
+	def __init__(self, pid: int, interval=0.5):
+		self.pid = pid
+		self.interval = interval
+		self.peakRss = 0.
+		self.stopEvent = threading.Event()
+		self.startStats = processStats(pid)
+		self.thread = threading.Thread(target=self.sampleLoop, daemon=True, name='Thread-Sampler')
+		self.thread.start()
+	def sampleLoop(self):
+		while not self.stopEvent.wait(self.interval):
+			self.peakRss = max(self.peakRss, processStats(self.pid)['rss_mb'] or 0.)
+	def stop(self, elapsed: float) -> dict:
+		self.stopEvent.set()
+		self.thread.join()
+		end = processStats(self.pid)
+		if end['cpu_s'] is None: return end
+		cpu = end['cpu_s'] - self.startStats['cpu_s']
+		return {'cpu_s': cpu, 'cpu_percent': 100 * cpu / elapsed, 'rss_mb': end['rss_mb'], 'peak_rss_mb': max(self.peakRss, end['rss_mb'])}
+
+# measuring ------------------------------------------
+def percentile(sortedValues: list[float], q: float) -> float:
+	return sortedValues[min(int(len(sortedValues) * q), len(sortedValues) - 1)]
+def summarize(values: list[float], elapsed: float) -> dict:
+	values = sorted(values)
+	return {'count': len(values), 'per_sec': len(values) / elapsed, 'p50_ms': 1000 * percentile(values, .5), 'p95_ms': 1000 * percentile(values, .95), 'p99_ms': 1000 * percentile(values, .99)}
+
+class LatencyRecorder:
+	'''collects the latencies reported by the bot sessions'''
+	def __init__(self):
+		self.latencies: dict[str, list[float]] = {}
+		self.shootsSent: dict[int, float] = {} # NOTE shooter id -> when his COM.SHOOT was sent
+		self.wakeupsRecvd: dict[int, float] = {} # NOTE shooter id -> when his opponent received the COM.OPPONENT_SHOT response
+		self.lock = threading.Lock()
+	def hook(self, bot: Bot):
+		return lambda req: self.record(bot, req)
+	def record(self, bot: Bot, req: Request):
+		'''the COM.SHOOT and the COM.OPPONENT_SHOT responses arrive on different sessions in any order, the second one completes the wake-up latency'''
+		with self.lock:
+			if req.reqId: self.latencies.setdefault(req.command.name, []).append(req.timeRecvd - req.timeSent) # NOTE a pushed event has no round trip
+			if req.command == COM.SHOOT:
+				if (recvd := self.wakeupsRecvd.pop(bot.session.id, None)) is not None: self.addWakeup(recvd - req.timeSent)
+				else: self.shootsSent[bot.session.id] = req.timeSent
+			elif req.command == COM.OPPONENT_SHOT and req.payload['shotted']:
+				if (sent := self.shootsSent.pop(bot.opponentId, None)) is not None: self.addWakeup(req.timeRecvd - sent)
+				else: self.wakeupsRecvd[bot.opponentId] = req.timeRecvd
+	def addWakeup(self, latency: float):
+		self.latencies.setdefault('OPPONENT_SHOT_WAKEUP', []).append(latency)
+
+# running ----------------------------------------------
+def driveBots(bots: list[Bot], ramp: float):
+	'''starts the bots evenly over @ramp seconds and steps them until all of them finish'''
+	start = time.perf_counter()
+	running: list[Bot] = []
+	waiting = list(bots)
+	while waiting or running:
+		started = len(bots) if ramp <= 0 else int(len(bots) * (time.perf_counter() - start) / ramp) + 1
+		while waiting and len(bots) - len(waiting) < started:
+			running.append(waiting.pop(0))
+		for bot in running:
+			bot.step()
+		running = [bot for bot in running if not bot.finished()]
+		time.sleep(STEP_INTERVAL)
+	for bot in bots: bot.session.quitNow()
+	for bot in bots: bot.close()
+
+def loadTest(engine: str, numBots: int, games: int, ramp: float, drivers: int, sharedIO=False) -> dict:
+	portRecv, portSend = multiprocessing.Pipe(False)
+	stopEvent = multiprocessing.Event()
+	proc = multiprocessing.Process(target=runServer, args=(engine, portSend, stopEvent)) # NOTE not a daemon, the sharded engine starts its workers
+	proc.start()
+	port = portRecv.recv()
+	recorder = LatencyRecorder()
+	ioLoop = SharedIOLoop() if sharedIO else None
+	bots = []
+	for i in range(numBots):
+		bot = Bot(f'load{i}', ('127.0.0.1', port), games=games, seed=i, ioLoop=ioLoop)
+		bot.session.onResponse = recorder.hook(bot)
+		bots.append(bot)
+	sampler = ServerSampler(proc.pid)
+	start = time.perf_counter()
+	threads = [threading.Thread(target=driveBots, args=(bots[i::drivers], ramp), daemon=True, name=f'Thread-Driver{i}') for i in range(drivers)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	elapsed = time.perf_counter() - start
+	if ioLoop: ioLoop.close()
+	server = sampler.stop(elapsed)
+	stopEvent.set()
+	proc.join()
+	return {'engine': engine, 'shared_io': sharedIO, 'push': '--long-poll' not in sys.argv, 'bots': numBots, 'games_per_bot': games, 'ramp_s': ramp, 'seconds': elapsed,
+		'games': sum(bot.gamesPlayed for bot in bots) // 2, 'failed_bots': sum(bot.failed for bot in bots), 'server': server,
+		'commands': {command: summarize(values, elapsed) for command, values in sorted(recorder.latencies.items())}}
+
+def main():
+	parser = argparse.ArgumentParser('LoadTest')
+	parser.add_argument('--bots', type=int, default=200, help='number of simulated players')
+	parser.add_argument('--games', type=int, default=3, help='games played by every bot')
+	parser.add_argument('--ramp', type=float, default=5., help='seconds over which the bots connect')
+	parser.add_argument('--drivers', type=int, default=2, help='threads driving the bots')
+	parser.add_argument('--engine', default='threaded', help='server engine')
+	parser.add_argument('--shared-io', action='store_true', help='one I/O thread for all bot sessions')
+	parser.add_argument('--long-poll', action='store_true', help='the bots poll with blocking requests instead of subscribing to pushed events') # NOTE read by the sessions from sys.argv
+	parser.add_argument('--json', help='also write the results to this file')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+	ConnectionPrimitives.DEBUG_REQS = False
+	r = loadTest(args.engine, args.bots, args.games, args.ramp, args.drivers, args.shared_io)
+	print(f"{r['engine']}: {r['bots']} bots, {r['games']} games in {r['seconds']:.2f}s, {r['failed_bots']} bots failed")
+	print(f"{'command':>22} {'count':>7} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+	for command, s in r['commands'].items():
+		print(f"{command:>22} {s['count']:>7} {s['per_sec']:>8.1f} {s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f}")
+	if r['server']['cpu_s'] is not None:
+		print(f"server: cpu {r['server']['cpu_s']:.2f}s ({r['server']['cpu_percent']:.0f}%), rss {r['server']['rss_mb']:.1f} MB, peak {r['server']['peak_rss_mb']:.1f} MB")
+	if args.json:
+		with open(args.json, 'w') as f: json.dump(r, f, indent=1)
+if __name__ == '__main__':
+	main()
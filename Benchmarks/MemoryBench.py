@@ -0,0 +1,98 @@
+'''Memory the server keeps per connected idle player and per active game
+the requests go through the handlers of the threaded engine, without its sockets and threads,
+the memory is measured by tracemalloc and, in another run without it, as the growth of the process rss
+run from the repo root: python -m Benchmarks.MemoryBench [--players N] [--games N] [--long-poll] [--json FILE]'''
+import argparse, json, copy, gc, logging, tracemalloc
+
+from Shared import ConnectionPrimitives, Fleet
+from Shared.Enums import COM
+import ServerMain
+
+class HeadlessServer(ServerMain.Server):
+	'''the game logic of the threaded engine, what would be sent is dropped'''
+	def openSocket(self, addr):
+		return None
+	def startEngine(self):
+		pass
+	def queueOutput(self, conn, data: bytes):
+		pass
+
+class Client:
+	'''sends the requests of one player as they would be received'''
+	def __init__(self, server: HeadlessServer, port: int):
+		self.server = server
+		self.conn = ServerMain.ClientConnection(None, ('127.0.0.1', port), server)
+		server.connections.add(self.conn)
+		self.id = 0
+		self.reqIds = 0
+	def req(self, command: COM, payload: dict):
+		self.reqIds += 1
+		body = ConnectionPrimitives.encodeBody(self.id, command, payload, self.reqIds, ConnectionPrimitives.CODEC_BIN)
+		req = self.server._parseReq(self.conn, body)
+		self.server.handleReq(req)
+		return req
+	def connect(self, name: str, push: bool):
+		req = self.req(COM.CONNECT, {'name': name, 'codecs': ConnectionPrimitives.SUPPORTED_CODECS, 'push': push})
+		self.id = req.playerId
+
+def rssBytes() -> int:
+	with open('/proc/self/status') as f:
+		return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+def measure(populate, n: int) -> dict:
+	'''@return bytes per item kept by the server populate() returns after making n of them'''
+	gc.collect()
+	rss = rssBytes()
+	server = populate()
+	gc.collect()
+	rss = rssBytes() - rss
+	del server
+	gc.collect()
+	tracemalloc.start()
+	server = populate()
+	gc.collect()
+	traced = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return {'traced_bytes': traced / n, 'rss_bytes': rss / n}
+
+def idlePlayers(n: int, push: bool):
+	'''connected players waiting to be paired, long-polling ones hold a COM.CONNECTION_CHECK'''
+	server = HeadlessServer(None)
+	clients = [Client(server, i) for i in range(n)]
+	for i, client in enumerate(clients):
+		client.connect(f'idle{i}', push)
+		if not push: client.req(COM.CONNECTION_CHECK, {})
+	return server
+def activeGames(n: int, push: bool, shots=20):
+	'''games in the shooting stage after @shots shots, together with their two players'''
+	server = HeadlessServer(None)
+	clients = [Client(server, i) for i in range(2 * n)]
+	for i, client in enumerate(clients): client.connect(f'player{i}', push)
+	for a, b in zip(clients[::2], clients[1::2]):
+		a.req(COM.PAIR, {})
+		b.req(COM.PAIR, {}) # NOTE answers the blocking COM.PAIR of a too
+		for client in (a, b): client.req(COM.GAME_READINESS, {'ships': copy.deepcopy(Fleet.AUTOPLACE_SHIPS), 'ready': True})
+		game = server.games[server.players[a.id].gameId]
+		cells = iter([x, y] for y in range(Fleet.GRID_HEIGHT) for x in range(Fleet.GRID_WIDTH))
+		for _ in range(shots):
+			shooter, target = (a, b) if game.playerOnTurn == a.id else (b, a)
+			shooter.req(COM.SHOOT, {'pos': next(cells)})
+			if not push: target.req(COM.OPPONENT_SHOT, {})
+	return server
+
+def main():
+	parser = argparse.ArgumentParser('MemoryBench')
+	parser.add_argument('--players', type=int, default=20000, help='idle players to connect')
+	parser.add_argument('--games', type=int, default=5000, help='active games to play')
+	parser.add_argument('--long-poll', action='store_true', help='the players poll with blocking requests instead of subscribing to pushed events')
+	parser.add_argument('--json', help='also write the results to this file')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+	ConnectionPrimitives.DEBUG_REQS = False
+	push = not args.long_poll
+	results = {'push': push, 'idle_player': measure(lambda: idlePlayers(args.players, push), args.players), 'active_game': measure(lambda: activeGames(args.games, push), args.games)}
+	for name in ('idle_player', 'active_game'):
+		print(f"{name:>12}: {results[name]['traced_bytes']:8.0f} B traced, {results[name]['rss_bytes']:8.0f} B rss")
+	if args.json:
+		with open(args.json, 'w') as f: json.dump(results, f, indent=1)
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,161 @@
+'''Microbenchmarks of the protocol, game rules and rendering hot paths
+the results are stored as JSON, so runs of different commits can be compared
+run from the repo root: python -m Benchmarks.MicroBench [--filter STR] [--out FILE] [--compare FILE]
+the client benchmarks need pygame and run under the SDL dummy video driver'''
+import os, socket, subprocess
+import argparse, json, copy, timeit, statistics, platform
+from typing import Callable
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+from Shared import ConnectionPrimitives, Fleet, Schemas
+from Shared.Enums import COM
+
+BENCHES: dict[str, Callable[[], Callable[[], None]]] = {} # NOTE name -> setup returning the benchmarked function
+def bench(name: str):
+	def register(setup):
+		BENCHES[name] = setup
+		return setup
+	return register
+
+# protocol ---------------------------------------
+def roundTrip(command: COM, payload: dict, codec: str) -> Callable[[], None]:
+	'''one message there and back over a socketpair'''
+	a, b = socket.socketpair()
+	def run():
+		ConnectionPrimitives.send(a, 1234, command, payload, 1, codec)
+		id, recvdCommand, recvdPayload, reqId, recvdCodec = ConnectionPrimitives.recv(b)
+		ConnectionPrimitives.send(b, id, recvdCommand, recvdPayload, reqId, recvdCodec)
+		ConnectionPrimitives.recv(a)
+	return run
+@bench('protocol.roundtrip_shoot_json')
+def benchShootJson():
+	return roundTrip(COM.SHOOT, {'pos': [3, 4]}, ConnectionPrimitives.CODEC_JSON)
+@bench('protocol.roundtrip_shoot_bin')
+def benchShootBin():
+	return roundTrip(COM.SHOOT, {'pos': [3, 4]}, ConnectionPrimitives.CODEC_BIN)
+@bench('protocol.roundtrip_fleet_json')
+def benchFleetJson():
+	return roundTrip(COM.GAME_READINESS, {'ships': Fleet.AUTOPLACE_SHIPS, 'ready': True}, ConnectionPrimitives.CODEC_JSON)
+@bench('protocol.roundtrip_fleet_bin')
+def benchFleetBin():
+	return roundTrip(COM.GAME_READINESS, {'ships': Fleet.AUTOPLACE_SHIPS, 'ready': True}, ConnectionPrimitives.CODEC_BIN)
+@bench('protocol.validate_shoot')
+def benchValidateShoot():
+	return lambda: Schemas.validateRequest(COM.SHOOT, {'pos': [3, 4]})
+@bench('protocol.validate_fleet')
+def benchValidateFleetPayload():
+	payload = {'ships': copy.deepcopy(Fleet.AUTOPLACE_SHIPS), 'ready': True}
+	return lambda: Schemas.validateRequest(COM.GAME_READINESS, payload)
+
+# game rules --------------------------------------
+@bench('game.shoot_whole_board')
+def benchGameShoot():
+	'''readies both fleets and shoots every cell of the opponent's board'''
+	import ServerMain
+	cells = [[x, y] for y in range(Fleet.GRID_HEIGHT) for x in range(Fleet.GRID_WIDTH)]
+	def run():
+		p1, p2 = ServerMain.ConnectedPlayer(1, 'a'), ServerMain.ConnectedPlayer(2, 'b')
+		game = ServerMain.Game(1, p1, p2, True)
+		for p in (p1, p2): game.gameReadiness(p, {'ships': copy.deepcopy(Fleet.AUTOPLACE_SHIPS), 'ready': True})
+		for pos in cells: game.shoot(p1, pos)
+	return run
+@bench('game.validate_fleet')
+def benchValidateFleet():
+	return lambda: Fleet.validateFleet(Fleet.AUTOPLACE_SHIPS)
+
+# client -----------------------------------------
+def clientModules():
+	'''@return (Game, Frontend) modules, raises ImportError without pygame'''
+	from Client import Game, Frontend
+	return Game, Frontend
+def autoplacedGrid():
+	Game, Frontend = clientModules()
+	grid = Game.Grid(True)
+	grid.autoplace()
+	for x in range(0, Fleet.GRID_WIDTH, 2):
+		for y in range(0, Fleet.GRID_HEIGHT, 3): grid.gotShotted((x, y))
+	return grid
+@bench('client.grid_markBlocked')
+def benchMarkBlocked():
+	grid = autoplacedGrid()
+	ship = grid.ships[3]
+	return lambda: grid._markBlocked(ship)
+@bench('client.grid_canPlaceShip')
+def benchCanPlaceShip():
+	Game, Frontend = clientModules()
+	grid = autoplacedGrid()
+	ships = [Game.Ship([x, y], 3, bool(x % 2)) for x in range(8) for y in range(8)]
+	def run():
+		for ship in ships: grid.canPlaceShip(ship)
+	return run
+@bench('client.frontend_getFrame_cold')
+def benchGetFrameCold():
+	Game, Frontend = clientModules()
+	def run():
+		Frontend.SHIP_FRAMES.clear()
+		Frontend.getFrame(4, True, [True, False, True, False], 1)
+	return run
+@bench('client.frontend_getFrame_cached')
+def benchGetFrameCached():
+	Game, Frontend = clientModules()
+	Frontend.getFrame(4, True, [True, False, True, False], 1)
+	return lambda: Frontend.getFrame(4, True, [True, False, True, False], 1)
+@bench('client.grid_drawShots')
+def benchDrawShots():
+	grid = autoplacedGrid()
+	return grid.drawShots
+@bench('client.grid_draw')
+def benchDraw():
+	grid = autoplacedGrid()
+	return lambda: grid.draw(shots=True)
+
+# running ----------------------------------------
+def measure(func: Callable[[], None], repeat: int, minTime: float) -> dict:
+	timer = timeit.Timer(func)
+	number = 1
+	while timer.timeit(number) < minTime: number *= 2
+	times = [t / number for t in timer.repeat(repeat, number)]
+	return {'number': number, 'min_us': 1e6 * min(times), 'median_us': 1e6 * statistics.median(times)}
+def gitCommit() -> str:
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return ''
+def runBenches(nameFilter: str, repeat: int, minTime: float) -> dict:
+	ConnectionPrimitives.DEBUG_REQS = False
+	results = {}
+	for name, setup in BENCHES.items():
+		if nameFilter not in name: continue
+		try:
+			func = setup()
+		except ImportError as e:
+			print(f'{name:>36}: skipped, {e}')
+			continue
+		results[name] = measure(func, repeat, minTime)
+		print(f"{name:>36}: {results[name]['min_us']:10.2f} us")
+	return {'commit': gitCommit(), 'python': platform.python_version(), 'results': results}
+def compare(results: dict, baselineFile: str):
+	with open(baselineFile) as f:
+		baseline = json.load(f)
+	print(f"compared to {baseline.get('commit') or baselineFile}:")
+	for name, r in results['results'].items():
+		if name in baseline['results']:
+			print(f"{name:>36}: {r['min_us'] / baseline['results'][name]['min_us']:6.2f}x")
+
+def main():
+	parser = argparse.ArgumentParser('MicroBench')
+	parser.add_argument('--filter', default='', help='run only the benchmarks containing this string')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--min-time', type=float, default=0.05, help='minimal seconds of one repetition')
+	parser.add_argument('--out', help='write the results to this JSON file')
+	parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+	args = parser.parse_args()
+	results = runBenches(args.filter, args.repeat, args.min_time)
+	if args.out:
+		with open(args.out, 'w') as f: json.dump(results, f, indent=1)
+	if args.compare: compare(results, args.compare)
+if __name__ == '__main__':
+	main()
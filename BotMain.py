@@ -0,0 +1,45 @@
+import time, threading
+import logging, argparse
+
+from Client.Bot import Bot
+from Client.Session import SERVER_ADDRES, SharedIOLoop
+from Shared.Helpers import runFuncLogged, initLogging
+
+STEP_INTERVAL = 0.01
+
+def runBots(bots: list[Bot]):
+	'''drives all bots from one thread until each of them played its games'''
+	running = list(bots)
+	while running:
+		for bot in running:
+			bot.step()
+		running = [bot for bot in running if not bot.finished()]
+		time.sleep(STEP_INTERVAL)
+	for bot in bots: bot.session.quitNow() # NOTE lets all the session threads end at once before joining them
+	for bot in bots: bot.close()
+
+def botMain():
+	initLogging('bot_log.txt')
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--bots', help='number of simulated players', type=int, default=2)
+	parser.add_argument('--games', help='games played by every bot, 0 - play forever', type=int, default=1)
+	parser.add_argument('--no-rematch', help='reconnect after every game instead of rematching', action='store_true')
+	parser.add_argument('--host', help='server address', default=SERVER_ADDRES[0])
+	parser.add_argument('--port', help='server port', type=int, default=SERVER_ADDRES[1])
+	parser.add_argument('--drivers', help='threads driving the bots', type=int, default=1)
+	parser.add_argument('--shared-io', help='do the I/O of all bots in one thread instead of two threads per bot', action='store_true')
+	args, unknown = parser.parse_known_args()
+	ioLoop = SharedIOLoop() if args.shared_io else None
+	bots = [Bot(f'bot{i}', (args.host, args.port), games=args.games, rematch=not args.no_rematch, seed=i, ioLoop=ioLoop) for i in range(args.bots)]
+	logging.info(f'running {len(bots)} bots against {args.host}:{args.port}')
+	start = time.time()
+	drivers = [threading.Thread(target=lambda i=i: runFuncLogged(lambda: runBots(bots[i::args.drivers])), daemon=True, name=f'Thread-Driver{i}') for i in range(args.drivers)]
+	for driver in drivers: driver.start()
+	for driver in drivers: driver.join()
+	if ioLoop: ioLoop.close()
+	played = sum(bot.gamesPlayed for bot in bots)
+	logging.info(f'{played} games played in {time.time() - start:.1f} s, {sum(bot.gamesWon for bot in bots)} won, {sum(bot.failed for bot in bots)} bots failed')
+def main():
+	runFuncLogged(botMain)
+if __name__ == '__main__':
+	main()
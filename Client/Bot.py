@@ -0,0 +1,154 @@
+import logging, random, copy
+from typing import Optional
+
+from .Session import Session, SharedIOLoop
+from Shared.Enums import STAGES, COM
+from Shared import Fleet
+
+class BotBoard:
+	'''what the bot knows about the opponent's grid, picks the next shot by hunting randomly and finishing hitted ships'''
+	UNKNOWN, MISSED, HITTED, BLOCKED = range(4)
+	def __init__(self, rng: random.Random):
+		self.rng = rng
+		self.cells = bytearray(Fleet.GRID_WIDTH * Fleet.GRID_HEIGHT) # NOTE cell (x, y) is at y * GRID_WIDTH + x
+		self.targets: list[int] = [] # NOTE neighbours of hitted cells, tried first
+	def nextShot(self) -> list[int]:
+		while self.targets:
+			cell = self.targets.pop()
+			if self.cells[cell] == self.UNKNOWN: return self._pos(cell)
+		return self._pos(self.rng.choice([c for c, state in enumerate(self.cells) if state == self.UNKNOWN]))
+	def update(self, pos: list[int], hitted: bool, sunkenShip: Optional[dict]):
+		cell = pos[1] * Fleet.GRID_WIDTH + pos[0]
+		self.cells[cell] = self.HITTED if hitted else self.MISSED
+		if sunkenShip:
+			occupied, surroundings = Fleet.PLACEMENTS[(*sunkenShip['pos'], sunkenShip['size'], sunkenShip['horizontal'])]
+			for c in range(len(self.cells)):
+				if surroundings >> c & 1 and self.cells[c] == self.UNKNOWN: self.cells[c] = self.BLOCKED
+		elif hitted:
+			x, y = pos
+			for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+				if 0 <= nx < Fleet.GRID_WIDTH and 0 <= ny < Fleet.GRID_HEIGHT: self.targets.append(ny * Fleet.GRID_WIDTH + nx)
+	def _pos(self, cell: int) -> list[int]:
+		return [cell % Fleet.GRID_WIDTH, cell // Fleet.GRID_WIDTH]
+
+class Bot:
+	'''headless player running the same request flow as Game, without any Frontend
+	it autoplaces the ships, shoots with BotBoard and rematches until it played @games games (0 - forever)
+	@ioLoop: shared by many bots, so they don't need two threads each'''
+	def __init__(self, name: str, addr, *, games=0, rematch=True, seed=None, ioLoop: SharedIOLoop=None):
+		self.name = name
+		self.session = Session(addr, ioLoop=ioLoop)
+		self.games = games
+		self.rematch = rematch
+		self.rng = random.Random(seed)
+		self.gamesPlayed = 0
+		self.gamesWon = 0
+		self.failed = False
+		self.gameStage: STAGES = STAGES.CONNECTING
+		self.repeatableInit()
+	def repeatableInit(self):
+		self.board = BotBoard(self.rng)
+		self.opponentId = 0
+		self.onTurn = False
+		self.opponentRematching = False
+		self.rematchSent = False
+	def newGameStage(self, stage: STAGES):
+		assert stage != self.gameStage
+		self.gameStage = stage
+		logging.debug('Bot %s new game stage: %s', self.name, stage)
+		if stage == STAGES.CONNECTING:
+			self.repeatableInit()
+			self.session.repeatebleInit()
+		elif stage == STAGES.PLACING:
+			self.newGameStage(STAGES.GAME_WAIT)
+			self.session.tryToSend(COM.GAME_READINESS, {'ships': copy.deepcopy(Fleet.AUTOPLACE_SHIPS), 'ready': True}, self.gameReadinessCallback, blocking=False, mustSend=True)
+	def finished(self) -> bool:
+		return self.gameStage == STAGES.CLOSING or self.failed
+	def wantsAnotherGame(self) -> bool:
+		return self.games == 0 or self.gamesPlayed < self.games
+	def gameEnded(self, won: bool):
+		self.gamesPlayed += 1
+		self.gamesWon += won
+		self.newGameStage(STAGES.GAME_END)
+
+	# requests -------------------------------------------------
+	def connectCallback(self, res):
+		self.session.id = res['id']
+		self.session.connected = True
+		self.newGameStage(STAGES.PAIRING)
+	def pairCallback(self, res, rematched=False):
+		if res.get('paired') or (rematched and res.get('rematched')):
+			self.opponentId = res['opponent']['id']
+			self.newGameStage(STAGES.PLACING)
+	def gameReadinessCallback(self, res):
+		assert res['approved'], 'getting ready should always be approved'
+	def gameWaitCallback(self, res):
+		if res['started']:
+			self.onTurn = res['on_turn'] == self.session.id
+			self.newGameStage(STAGES.SHOOTING)
+	def shootCallback(self, pos, res):
+		self.board.update(pos, res['hitted'], res['sunken_ship'])
+		self.onTurn = False
+		if res['game_won']: self.gameEnded(won=True)
+	def gettingShotCallback(self, res):
+		if not res['shotted']: return
+		self.onTurn = True
+		if res['lost']: self.gameEnded(won=False)
+	def rematchCallback(self, res):
+		if res.get('rematched'): self.execRematch(res)
+	def awaitRematchCallback(self, res):
+		if not res['changed'] or self.gameStage != STAGES.GAME_END: return
+		if res.get('opponent_disconnected'):
+			self.session.disconnect()
+		elif res.get('rematched'):
+			self.execRematch(res)
+		elif 'opponent_rematching' in res:
+			self.opponentRematching = res['opponent_rematching']
+	def execRematch(self, res: dict):
+		self.repeatableInit()
+		self.pairCallback(res, True)
+
+	def step(self):
+		'''handles the received responses and sends the requests of the current stage, called repeatedly by the driver
+		a bot whose session fails is marked as failed, so it doesn't stop the other bots'''
+		try:
+			self.session.checkThreads()
+			self.handleResponses()
+			if not self.finished():
+				self.spawnReqs()
+				self.session.sendQueued()
+		except (RuntimeError, AssertionError, OSError) as e:
+			logging.error('Bot %s failed in %s: %r', self.name, self.gameStage, e)
+			self.failed = True
+	def close(self):
+		if self.failed: self.session.quitNow()
+		else: self.session.quit()
+	def handleResponses(self):
+		gameEndMsg, opponentState = self.session.loadResponses()
+		if self.gameStage == STAGES.GAME_END:
+			if self.session.fullyDisconnected():
+				self.newGameStage(STAGES.CONNECTING if self.wantsAnotherGame() else STAGES.CLOSING)
+		elif gameEndMsg: # NOTE unstandard game end
+			logging.warning("Bot %s: server commanded disconnect: '%s'", self.name, gameEndMsg)
+			self.newGameStage(STAGES.GAME_END)
+	def spawnReqs(self):
+		if self.gameStage == STAGES.CONNECTING:
+			self.session.tryToSend(COM.CONNECT, {'name': self.name}, self.connectCallback, blocking=False)
+		elif self.gameStage == STAGES.PAIRING:
+			self.session.tryToSend(COM.PAIR, {}, self.pairCallback, blocking=True)
+		elif self.gameStage == STAGES.GAME_WAIT:
+			self.session.tryToSend(COM.GAME_WAIT, {}, self.gameWaitCallback, blocking=True)
+		elif self.gameStage == STAGES.SHOOTING and self.onTurn:
+			if not self.session.alreadySent[COM.SHOOT]:
+				pos = self.board.nextShot()
+				self.session.tryToSend(COM.SHOOT, {'pos': pos}, lambda res: self.shootCallback(pos, res), blocking=False)
+		elif self.gameStage == STAGES.SHOOTING:
+			self.session.tryToSend(COM.OPPONENT_SHOT, {}, self.gettingShotCallback, blocking=True)
+		elif self.gameStage == STAGES.GAME_END and self.session.connected:
+			if not (self.rematch and self.wantsAnotherGame()):
+				if self.session.noPendingReqs(): self.session.disconnect()
+			elif not self.rematchSent:
+				self.rematchSent = self.session.tryToSend(COM.UPDATE_REMATCH, {'rematch_desired': True}, self.rematchCallback, blocking=False)
+			elif not self.session.alreadySent[COM.UPDATE_REMATCH]: # NOTE sent after the update is answered, so it can't arrive after the rematch
+				self.session.tryToSend(COM.AWAIT_REMATCH, {'expected_opponent_rematch': self.opponentRematching}, self.awaitRematchCallback, blocking=True)
+		self.session.spawnConnectionCheck()
@@ -1,7 +1,5 @@
 from pygame import Rect
-
-GRID_HEIGHT = 10
-GRID_WIDTH = 10
+from Shared.Fleet import GRID_HEIGHT, GRID_WIDTH
 
 GRID_X_SPACING = 72
 GRID_Y_SPACING = 72
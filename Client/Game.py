@@ -1,4 +1,4 @@
-import logging, sys, string
+import logging, sys, string, copy
 from pygame import Rect, mouse
 import pygame
 from typing import TypeVar, Optional
@@ -7,6 +7,7 @@ from . import Constants
 from . import Frontend
 from .Session import Session
 from Shared.Enums import SHOTS, STAGES, COM
+from Shared import Fleet
 
 class Game:
 	def __init__(self):
@@ -146,8 +147,9 @@ class Game:
 		self.session.checkThreads()
 		self.handleResponses()
 		self.spawnReqs()
+		self.session.sendQueued()
 	def handleResponses(self):
-		assert len(COM) == 12
+		assert len(COM) == 13
 		gameEndMsg, opponentState = self.session.loadResponses()
 		if self.gameStage in [STAGES.MAIN_MENU, STAGES.GAME_END]:
 			if '--autoplay-repeat' in sys.argv and self.session.fullyDisconnected():
@@ -407,10 +409,23 @@ class Grid:
 		self.initShipSizes()
 		self.flyingShip: Ship = Ship([-1, -1], 0, True)
 		self.ships: list[Ship] = []
-		self.shots = [[SHOTS.NOT_SHOTTED] * Constants.GRID_WIDTH for y in range(Constants.GRID_HEIGHT)]
+		self.shots = bytearray([SHOTS.NOT_SHOTTED]) * (Constants.GRID_WIDTH * Constants.GRID_HEIGHT) # NOTE cell (x, y) is at y * GRID_WIDTH + x
+		self.cellShips: list[Optional[Ship]] = [None] * (Constants.GRID_WIDTH * Constants.GRID_HEIGHT)
+		self.board = 0 # NOTE Fleet bitmask of the cells occupied by ships
 	def initShipSizes(self):
-		self.shipSizes: dict[int, int] = {1: 2, 2: 4, 3: 2, 4: 1} # shipSize : shipCount
+		self.shipSizes: dict[int, int] = dict(Fleet.SHIP_SIZES) # shipSize : shipCount
 
+	def addShip(self, ship: 'Ship'):
+		'''adds the ship to the ships and to the cell index'''
+		self.ships.append(ship)
+		self.board |= Fleet.PLACEMENTS[ship.placementKey()][0]
+		for cell in ship.cells():
+			self.cellShips[cell] = ship
+	def removeShip(self, ship: 'Ship'):
+		self.ships.remove(ship)
+		self.board &= ~Fleet.PLACEMENTS[ship.placementKey()][0]
+		for cell in ship.cells():
+			self.cellShips[cell] = None
 	def shipsDicts(self):
 		return [ship.asDict() for ship in self.ships]
 	def allShipsPlaced(self):
@@ -439,29 +454,23 @@ class Grid:
 			return self.placeShip()
 		return False
 	def canPlaceShip(self, placed):
-		gridRect = Rect(0, 0, Constants.GRID_WIDTH, Constants.GRID_HEIGHT)
-		if not gridRect.contains(placed.getOccupiedRect()):
-			return False
-		for ship in self.ships:
-			if placed.isColliding(ship):
-				return False
-		return True
+		placement = Fleet.PLACEMENTS.get(placed.placementKey())
+		return placement is not None and not self.board & placement[1]
 
 	def placeShip(self) -> bool:
 		placed = self.flyingShip.getPlacedShip()
 		canPlace = self.canPlaceShip(placed)
 		if canPlace:
-			self.ships.append(placed)
+			self.addShip(placed)
 			self.shipSizes[placed.size] -= 1
 			self.changeSize(+1, canBeSame=True)
 		return canPlace
 	def autoplace(self):
-		if self.shipSizes == {1: 2, 2: 4, 3: 2, 4: 1}:
+		if self.shipSizes == Fleet.SHIP_SIZES:
 			self.flyingShip.setSize(0)
-			dicts = [{'pos': [3, 0], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [4, 3], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [5, 7], 'size': 3, 'horizontal': True, 'hitted': [False, False, False]}, {'pos': [1, 5], 'size': 4, 'horizontal': False, 'hitted': [False, False, False, False]}, {'pos': [8, 4], 'size': 1, 'horizontal': True, 'hitted': [False]}, {'pos': [6, 1], 'size': 1, 'horizontal': False, 'hitted': [False]}, {'pos': [5, 9], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [1, 1], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [9, 0], 'size': 3, 'horizontal': False, 'hitted': [False, False, False]}]
-			for d in dicts:
+			for d in copy.deepcopy(Fleet.AUTOPLACE_SHIPS):
 				ship = Ship.fromDict(d)
-				self.ships.append(ship)
+				self.addShip(ship)
 				self.shipSizes[ship.size] -= 1
 			assert self.allShipsPlaced(), 'autoplace is expected to place all ships'
 	def pickUpShip(self, mousePos) -> bool:
@@ -469,13 +478,16 @@ class Grid:
 		if ship:
 			self.removeShipInCursor()
 			self.flyingShip = ship.getFlying()
-			self.ships.remove(ship)
+			self.removeShip(ship)
 			self.shipSizes[ship.size] += 1
 		return bool(ship)
 	def _getClickedShip(self, mousePos):
-		for ship in self.ships:
-			if ship.realRect.collidepoint(mousePos):
-				return ship
+		cell = self._clickedCell(mousePos)
+		return None if cell is None else self.cellShips[cell]
+	def _clickedCell(self, mousePos) -> Optional[int]:
+		'''@return index of the cell under mousePos, None outside the grid'''
+		x, y = mousePos[0] // Constants.GRID_X_SPACING, (mousePos[1] - Constants.GRID_Y_OFFSET) // Constants.GRID_Y_SPACING
+		if 0 <= x < Constants.GRID_WIDTH and 0 <= y < Constants.GRID_HEIGHT: return y * Constants.GRID_WIDTH + x
 		return None
 
 	def _nextShipSize(self, startSize, increment):
@@ -500,27 +512,28 @@ class Grid:
 		self.flyingShip.setSize(currSize)
 
 	# shooting --------------------------------------------------
-	def localGridShotted(self, pos, update=True) -> tuple[bool, Ship]:
+	def localGridShotted(self, pos) -> tuple[bool, Ship]:
 		'''returns if hitted, any hitted ship'''
-		for ship in self.ships:
-			if ship.shot(pos, update):
-				return True, ship
-		return False, None
+		ship = self.cellShips[pos[1] * Constants.GRID_WIDTH + pos[0]]
+		if ship is None: return False, None
+		ship.hitted[ship.segmentAt(pos)] = True
+		return True, ship
 	def gotShotted(self, pos, hitted=False, sunkenShip=None):
 		'''process shot result, supplied from server for opponents grid'''
+		cell = pos[1] * Constants.GRID_WIDTH + pos[0]
 		if self.isLocal: hitted, sunkenShip = self.localGridShotted(pos)
-		else: assert self.shots[pos[1]][pos[0]] == SHOTS.SHOTTED_UNKNOWN
-		self.shots[pos[1]][pos[0]] = [SHOTS.NOT_HITTED, SHOTS.HITTED][hitted]
+		else: assert self.shots[cell] == SHOTS.SHOTTED_UNKNOWN
+		self.shots[cell] = [SHOTS.NOT_HITTED, SHOTS.HITTED][hitted]
 		if sunkenShip and all(sunkenShip.hitted):
-			if not self.isLocal: self.ships.append(sunkenShip)
+			if not self.isLocal: self.addShip(sunkenShip)
 			self.shipSizes[sunkenShip.size] -= 1
 			self._markBlocked(sunkenShip)
 	def shoot(self, mousePos) -> Optional[list[int]]:
 		'''mouse click -> clicked grid pos if shooting location available'''
-		if mousePos[1] < Constants.GRID_Y_OFFSET: return None
-		clickedX, clickedY = mousePos[0] // Constants.GRID_X_SPACING, (mousePos[1] - Constants.GRID_Y_OFFSET) // Constants.GRID_Y_SPACING
-		if self.shots[clickedY][clickedX] != SHOTS.NOT_SHOTTED: return None
-		self.shots[clickedY][clickedX] = SHOTS.SHOTTED_UNKNOWN
+		cell = self._clickedCell(mousePos)
+		if cell is None or self.shots[cell] != SHOTS.NOT_SHOTTED: return None
+		self.shots[cell] = SHOTS.SHOTTED_UNKNOWN
+		clickedX, clickedY = cell % Constants.GRID_WIDTH, cell // Constants.GRID_WIDTH
 		if self.isLocal: self.gotShotted((clickedX, clickedY))
 		return [clickedX, clickedY]
 	def _markBlocked(self, ship: Ship):
@@ -529,18 +542,18 @@ class Grid:
 		occupied: Rect = ship.getOccupiedRect()
 		for x in range(rect.x, rect.x + rect.width):
 			for y in range(rect.y, rect.y + rect.height):
-				if self.shots[y][x] == SHOTS.NOT_SHOTTED:
-					self.shots[y][x] = SHOTS.BLOCKED
+				cell = y * Constants.GRID_WIDTH + x
+				if self.shots[cell] == SHOTS.NOT_SHOTTED:
+					self.shots[cell] = SHOTS.BLOCKED
 				if occupied.collidepoint((x, y)):
-					self.shots[y][x] = SHOTS.HITTED_SUNKEN
+					self.shots[cell] = SHOTS.HITTED_SUNKEN
 	def updateAfterGameEnd(self, dicts):
 		assert not self.isLocal
 		for ship in dicts['ships']:
 			ship = Ship.fromDict(ship)
-			if self.canPlaceShip(ship): self.ships.append(ship)
-		for y, row in enumerate(self.shots):
-			for x, shot in enumerate(row):
-				if shot == SHOTS.HITTED: self.shots[y][x] = SHOTS.HITTED_SUNKEN
+			if self.canPlaceShip(ship): self.addShip(ship)
+		for cell, shot in enumerate(self.shots):
+			if shot == SHOTS.HITTED: self.shots[cell] = SHOTS.HITTED_SUNKEN
 
 	# drawing -----------------------------------------------
 	def drawShot(self, color, x, y, offset, *, thumbRect:Rect=None):
@@ -550,10 +563,9 @@ class Grid:
 		colors = {SHOTS.NOT_HITTED: (11, 243, 255)}
 		if not self.isLocal: colors.update({SHOTS.HITTED: (255, 0, 0), SHOTS.BLOCKED: (128, 128, 128)})
 		if thumbRect is not None: colors.update({SHOTS.HITTED: (255, 0, 0), SHOTS.HITTED_SUNKEN: (255, 0, 0), SHOTS.NOT_SHOTTED: (0, 0, 0)})
-		for y, lineShotted in enumerate(self.shots):
-			for x, shot in enumerate(lineShotted):
-				if shot in colors and (shot != SHOTS.NOT_SHOTTED or self.localGridShotted((x, y), update=False)[0]):
-					self.drawShot(colors[shot], x, y, offset, thumbRect=thumbRect)
+		for cell, shot in enumerate(self.shots):
+			if shot in colors and (shot != SHOTS.NOT_SHOTTED or self.cellShips[cell] is not None):
+				self.drawShot(colors[shot], cell % Constants.GRID_WIDTH, cell // Constants.GRID_WIDTH, offset, thumbRect=thumbRect)
 	def draw(self, *, flying=False, shots=False, offset=0):
 		Frontend.drawBackground(offset)
 		for ship in self.ships: ship.draw(offset)
@@ -629,36 +641,23 @@ class Ship:
 		'''Rect of window ship coordinates'''
 		return Rect(self.realPos[0], self.realPos[1] + Constants.GRID_Y_OFFSET, self.widthInGrid * Constants.GRID_X_SPACING, self.heightInGrid * Constants.GRID_Y_SPACING)
 
-	def getRealSegmentCoords(self):
-		'''returns list of real coords of all ship segments'''
-		segments = []
-		realX, realY = self.realPos
-		for i in range(self.size):
-			segments.append([realX, realY])
-			realX += Constants.GRID_X_SPACING * self.horizontal
-			realY += Constants.GRID_Y_SPACING * (not self.horizontal)
-		return segments
+	def placementKey(self) -> tuple[int, int, int, bool]:
+		'''key of the ship in Fleet.PLACEMENTS'''
+		return (self.pos[0], self.pos[1], self.size, self.horizontal)
+	def cells(self) -> range:
+		'''indices of the cells occupied by the ship'''
+		start = self.pos[1] * Constants.GRID_WIDTH + self.pos[0]
+		step = 1 if self.horizontal else Constants.GRID_WIDTH
+		return range(start, start + self.size * step, step)
+	def segmentAt(self, pos) -> int:
+		return (pos[0] - self.pos[0]) if self.horizontal else (pos[1] - self.pos[1])
 
 	def getnoShipsRect(self):
 		rect = Rect(self.pos[0] - 1, self.pos[1] - 1, self.widthInGrid + 2, self.heightInGrid + 2)
 		return rect.clip(Rect(0, 0, Constants.GRID_WIDTH, Constants.GRID_HEIGHT))
 	def getOccupiedRect(self):
 		return Rect(self.pos[0], self.pos[1], self.widthInGrid, self.heightInGrid)
-	def isColliding(self, other):
-		'''checks if other collides with the noShipsRect of self'''
-		return self.getnoShipsRect().colliderect(other.getOccupiedRect())
-
-	def shot(self, pos, update) -> bool:
-		if not self.getOccupiedRect().collidepoint(pos):
-			return False
 
-		realPos = pos[0] * Constants.GRID_X_SPACING, pos[1] * Constants.GRID_Y_SPACING
-		for i, (x, y) in enumerate(self.getRealSegmentCoords()):
-			r = Rect(x, y, 1, 1)
-			if r.collidepoint((realPos)):
-				if update: self.hitted[i] = True
-				return True
-		return False
 	@ classmethod
 	def advanceAnimations(cls):
 		cls.animationStage += cls.animationDirection * 2 - 1
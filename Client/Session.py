@@ -1,17 +1,19 @@
-import socket, time
-from queue import Queue, Empty
-import threading
+import socket, selectors, time, sys, os
+from queue import Queue, SimpleQueue, Empty
+from collections import deque
+import threading, itertools, heapq
 import logging
 
 from dataclasses import dataclass
 import enum, typing
 
-from Shared import ConnectionPrimitives
+from Shared import ConnectionPrimitives, Schemas
 from Shared.Enums import COM
 from Shared.Helpers import runFuncLogged
 
 # helpers
 AnyT = typing.TypeVar('AnyT')
+RECV_SIZE = 4096
 def iterQueue(q: Queue[AnyT]) -> typing.Iterator[AnyT]:
 		try:
 			while 1:
@@ -24,29 +26,65 @@ class Request:
 	payload: dict
 	callback: typing.Callable
 	blocking: bool
-	conn: socket.socket=None
+	reqId: int=0
 	state: int=0 # 0 waiting, 1 sent, 2 received
+	timeSent: float=0.
+	timeRecvd: float=0.
 
 SERVER_ADDRES = ('192.168.0.159', 1250)
+RESUME_TIMEOUT = 10. # NOTE how long a session whose connection was lost tries to reconnect, the restarted server keeps it MAX_TIME_FOR_DISCONNECT
+# NOTE blocking requests a subscribed session doesn't send, the server pushes their responses as the events happen
+PUSHED_COMMANDS = {COM.CONNECTION_CHECK, COM.OPPONENT_READY, COM.GAME_WAIT, COM.OPPONENT_SHOT, COM.AWAIT_REMATCH}
+def startsNewGame(payload: dict) -> bool:
+	return payload.get('paired', False) or payload.get('rematched', False)
 
 class Session:
-	def __init__(self):
+	def __init__(self, addr=SERVER_ADDRES, onResponse: typing.Callable[[Request], None]=None, ioLoop: 'SharedIOLoop'=None):
+		'''@onResponse: called with every received request from the receiving thread, used for measuring latencies
+		@ioLoop: shared thread doing the I/O of this session, otherwise the session starts its own Thread-Send and Thread-Recv'''
+		self.addr = addr
+		self.onResponse = onResponse
+		self.ioLoop = ioLoop
+		self.ioError: Exception = None # NOTE what failed the session in the shared loop
+		self.conn: socket.socket = None # NOTE one persistent connection multiplexing all requests, opened with COM.CONNECT
+		self.pendingReqs: dict[int, Request] = {} # reqId -> sent request awaiting response
+		self.pendingLock = threading.Lock()
+		self.sendLock = threading.Lock() # NOTE the requests sent again on resuming must go before any new one
+		self.reqIds = itertools.count(1) # NOTE reqId 0 marks the pushed events
+		self.pushLock = threading.Lock()
+		if ioLoop is None:
+			self.selector = selectors.DefaultSelector() # NOTE Thread-Recv waits on the connection and the wakeup socket
+			self.wakeupRecv, self.wakeupSend = socket.socketpair()
+			self.wakeupRecv.setblocking(False)
+			self.wakeupSend.setblocking(False)
+			self.selector.register(self.wakeupRecv, selectors.EVENT_READ)
 		self.repeatebleInit()
 
-		self.reqQueue: Queue[Request] = Queue()
-		self.requestsToRecv: Queue[Request] = Queue()
+		self.outgoing: list[Request] = [] # NOTE requests queued by the main thread since the last sendQueued()
+		self.reqQueue: Queue[list[Request]] = Queue()
 		self.responseQueue: Queue[Request] = Queue()
 		self.quitNowEvent = threading.Event()
 
+		if ioLoop is not None: return
 		self.sendThread = threading.Thread(target=lambda: runFuncLogged(self.sendLoop), name='Thread-Send', daemon=True)
 		self.sendThread.start()
 		self.recvThread = threading.Thread(target=lambda: runFuncLogged(self.recvLoop), name='Thread-Recv', daemon=True)
 		self.recvThread.start()
 	def repeatebleInit(self):
+		self._closeConnection()
 		self.id: int = 0
-		assert len(COM) == 12
+		self.codec: str = ConnectionPrimitives.CODEC_JSON # NOTE switched to the negotiated codec on COM.CONNECT response
+		assert len(COM) == 13
 		self.alreadySent: dict[COM, bool] = {COM.CONNECT: False, COM.CONNECTION_CHECK: False, COM.PAIR: False, COM.OPPONENT_READY: False, COM.GAME_READINESS: False, COM.GAME_WAIT: False, COM.SHOOT: False, COM.OPPONENT_SHOT: False, COM.DISCONNECT: False, COM.AWAIT_REMATCH: False, COM.UPDATE_REMATCH: False}
 		self.connected = False # NOTE connected only if active communication w/ server is established and will be kept
+		self.push = False # NOTE subscribed to pushed events, negotiated on COM.CONNECT unless '--long-poll'
+		self.name = ''
+		self.resumable = False # NOTE the server accepted the session and hasn't ended it, set by the receiving thread
+		self.resumeDeadline = 0. # NOTE set while the session on a shared loop reconnects, until the server answers the resume
+		self.resumeDelay = 0.
+		with self.pushLock:
+			self.subscriptions: dict[COM, Request] = {} # NOTE blocking requests waiting for their pushed event
+			self.pushedEvents: dict[COM, deque[Request]] = {} # NOTE events pushed before their request was made
 
 	def setAlreadySent(self, comm: COM):
 		assert not self.alreadySent[comm]
@@ -54,7 +92,8 @@ class Session:
 	def resetAlreadySent(self, comm: COM):
 		self.alreadySent[comm] = False
 	def noPendingReqs(self):
-		return not any(self.alreadySent.values())
+		'''the subscriptions aren't pending, no response to them is owed'''
+		return not any(sent and command not in self.subscriptions for command, sent in self.alreadySent.items())
 	def fullyDisconnected(self) -> bool:
 		return not self.connected and self.noPendingReqs()
 
@@ -80,15 +119,24 @@ class Session:
 				gameEndMsg = req.payload['game_end_msg']
 				self.connected = False
 				if 'opponent_grid' in req.payload: opponentState = req.payload['opponent_grid']
+			if self.push and (not req.payload['stay_connected'] or startsNewGame(req.payload)): self._cancelSubscriptions()
 			if not _drain: req.callback(req.payload)
 			self.resetAlreadySent(req.command)
-			self.reqQueue.task_done()
 		return gameEndMsg, opponentState
 	def _putReq(self, command: COM, payload: dict, callback: typing.Callable, *, blocking: bool):
 		assert isinstance(command, enum.Enum) and isinstance(command, str) and isinstance(payload, dict) and callable(callback), 'the request does not meet expected properties'
 		assert self.connected or command == COM.CONNECT, 'the session is not conected'
 		assert self.id != 0 or command == COM.CONNECT, 'self.id is invalid for sending this request'
-		self.reqQueue.put(Request(command, payload, callback, blocking))
+		req = Request(command, payload, callback, blocking)
+		if self.push and command in PUSHED_COMMANDS: return self._subscribe(req)
+		self.outgoing.append(req)
+	def sendQueued(self):
+		'''hands the requests queued since the last call over to Thread-Send, which sends them together in one COM.BATCH
+		called once per frame after all requests of the frame are queued'''
+		if not self.outgoing: return
+		if self.ioLoop is None: self.reqQueue.put(self.outgoing)
+		else: self.ioLoop.send(self, self.outgoing)
+		self.outgoing = []
 	# checks and closing -----------------------
 	def spawnConnectionCheck(self):
 		if self.noPendingReqs() and self.connected:
@@ -99,77 +147,413 @@ class Session:
 		self.connected = False
 	def quit(self):
 		'''gracefully closes session (recvs last reqs, joins threads), COM.DISCONNECT must have been sent in advance'''
+		self.sendQueued()
 		while not self.noPendingReqs():
 			self.loadResponses(_drain=True)
 		assert not self.connected, 'the session is still connected'
-		self.quitNowEvent.set()
+		self.quitNow()
+		if self.ioLoop is not None: return self._closeConnection()
 		self.sendThread.join()
 		self.recvThread.join()
+		self._closeConnection()
+		self.selector.close()
+		self.wakeupRecv.close()
+		self.wakeupSend.close()
+	def quitNow(self):
+		'''lets the threads end without waiting for the pending responses'''
+		self.quitNowEvent.set()
+		self._connectionChanged()
 	def checkThreads(self):
+		if self.ioLoop is not None:
+			if self.ioError is not None: raise RuntimeError(f'session failed in the shared I/O loop: {self.ioError!r}')
+			if not self.ioLoop.thread.is_alive(): raise RuntimeError('Thread-IOLoop ended')
+			return
 		if not self.sendThread.is_alive():
 			raise RuntimeError('Thread-Send ended')
 		if not self.recvThread.is_alive():
 			raise RuntimeError('Thread-Recv ended')
 	# request handling running in threads -------------------------------------
 	def sendLoop(self):
-		'''waits for reqs from main_thread, sends them and then:
-		- _fetchResponse for the nonblocking
-		- move to Thread-Recv for the blocking'''
+		'''waits for reqs from main_thread and sends them over the connection,
+		the responses are matched by reqId in Thread-Recv'''
 		while not self.quitNowEvent.is_set():
 			try:
-				req = self.reqQueue.get(timeout=1.)
-				self._sendReq(req)
-				if req.blocking:
-					self.requestsToRecv.put(req)
-				else:
-					self._fetchResponse(req)
+				self._sendReqs(self.reqQueue.get(timeout=1.))
 			except Empty:
 				pass
 	def recvLoop(self):
-		pendingReqs: list[Request] = []
+		'''receives responses from the connection and hands them over to the main thread
+		sleeps in the selector until the connection is readable or it's woken by a new or closed connection'''
+		watchedConn = None
 		while not self.quitNowEvent.is_set():
-			try:
-				req = self.requestsToRecv.get(timeout=0.1)
-				pendingReqs.append(req)
-			except Empty:
-				pass
-			self.tryReceiving(pendingReqs)
-	def tryReceiving(self, pendingReqs: list[Request]):
-		'''loops through pendingReqs and tries to fetch them'''
-		doneReqs = []
-		for req in pendingReqs:
-			if self._canSocketRecv(req.conn):
-				self._fetchResponse(req)
-				doneReqs.append(req)
-		for r in doneReqs:
-			pendingReqs.remove(r)
-	def _fetchResponse(self, req: Request):
-		self._recvReq(req)
-		self.responseQueue.put(req)
-	@ staticmethod
-	def _canSocketRecv(s: socket.socket):
+			conn = self.conn
+			if conn is not watchedConn:
+				if watchedConn is not None: self.selector.unregister(watchedConn)
+				if conn is not None: self.selector.register(conn, selectors.EVENT_READ)
+				watchedConn = conn
+			for key, events in self.selector.select(timeout=1.): # NOTE the timeout only lets it notice quitNowEvent set directly
+				if key.fileobj is self.wakeupRecv:
+					self._drainWakeup()
+				elif conn is self.conn:
+					self._recvFrom(conn)
+	def _recvFrom(self, conn: socket.socket):
 		try:
-			s.setblocking(False)
-			return s.recv(1, socket.MSG_PEEK)
-		except BlockingIOError:
-			return False
+			self._handleMsg(*ConnectionPrimitives.recv(conn))
+		except (ConnectionPrimitives.ConnectionClosed, OSError) as e:
+			self._connectionLost(conn, e)
+	def _connectionLost(self, conn: socket.socket, error: OSError):
+		'''resumes the session, or closes it when nothing more is owed to it, otherwise raises the error'''
+		if conn is not self.conn: return # closed by us
+		if self.resumable and not self.quitNowEvent.is_set(): return self._resume(conn, error)
+		with self.pendingLock:
+			if self.pendingReqs: raise error
+		with self.pushLock:
+			if self.subscriptions: raise error # NOTE the subscribed events can't come anymore
+		logging.info('Connection closed by server')
+		self._closeConnection()
 
 	# internals -------------------------------------
-	def _sendReq(self, req: Request) -> socket.socket:
+	def _sendReqs(self, reqs: list[Request]):
+		'''requests queued together go in COM.BATCH messages, COM.CONNECT alone as it opens the connection
+		all of them are pending before the first is sent, when the connection is lost they're sent again on resuming'''
+		with self.sendLock:
+			for req in reqs: self._markSent(req)
+			try:
+				if len(reqs) == 1 or any(req.command == COM.CONNECT for req in reqs):
+					for req in reqs: self._sendReq(req)
+					return
+				for start in range(0, len(reqs), ConnectionPrimitives.MAX_BATCH_LEN):
+					batch = reqs[start:start+ConnectionPrimitives.MAX_BATCH_LEN]
+					payload = {'reqs': [{'command': req.command, 'payload': req.payload, 'req_id': req.reqId} for req in batch]}
+					self._send(COM.BATCH, payload, 0)
+			except OSError:
+				if not self.resumable: raise
+				logging.info('sending failed, the requests go again once the session resumes')
+	def _sendReq(self, req: Request):
+		self._send(req.command, req.payload, req.reqId)
+	def _send(self, command: COM, payload: dict, reqId: int):
+		'''on the shared loop the message only goes to the output buffer of the connection, see LoopConnection'''
+		ConnectionPrimitives.send(self.conn if self.ioLoop is None else self.ioLoop.output(self), self.id, command, payload, reqId, self.codec)
+	def _markSent(self, req: Request):
+		'''assigns the reqId and makes the request pending, before it's sent so the response can't come first'''
 		assert req.state == 0
-		self._newServerSocket(req)
-		ConnectionPrimitives.send(req.conn, self.id, req.command, req.payload)
+		if self.conn is None: self._newServerSocket()
+		if req.command == COM.CONNECT and '--json-codec' not in sys.argv:
+			req.payload['codecs'] = ConnectionPrimitives.SUPPORTED_CODECS
+		if req.command == COM.CONNECT and '--long-poll' not in sys.argv and self.id == 0:
+			req.payload['push'] = True
+		if req.command == COM.CONNECT: self.name = req.payload['name']
+		req.reqId = next(self.reqIds)
 		req.state = 1
-	def _recvReq(self, req: Request):
-		assert req.state == 1
-		id, recvdCommand, req.payload = ConnectionPrimitives.recv(req.conn)
-		req.conn.close()
-		req.state = 2
+		req.timeSent = time.perf_counter()
+		with self.pendingLock:
+			self.pendingReqs[req.reqId] = req
+	def _handleMsg(self, id: int, recvdCommand: str, payload: dict, reqId: int, codec: str):
 		if recvdCommand == COM.ERROR:
-			logging.error(f'Recvd !ERROR response {req.payload}')
+			logging.error('Recvd !ERROR response %s', payload)
 			raise RuntimeError('Recvd !ERROR response')
+		if reqId == 0: return self._recvPush(id, COM(recvdCommand), payload)
+		with self.pendingLock:
+			req = self.pendingReqs.pop(reqId, None)
+		if req is None:
+			logging.debug('Dropping response %s with reqId %d from a closed session', recvdCommand, reqId)
+			return
+		assert req.state == 1
+		req.payload = payload
+		req.state = 2
+		req.timeRecvd = time.perf_counter()
 		assert recvdCommand == req.command, 'Response should have the same command'
+		if (error := Schemas.validateResponse(recvdCommand, payload)) is not None:
+			logging.error('Recvd invalid %s response: %s', recvdCommand, error)
+			raise RuntimeError('Recvd invalid response')
 		assert self.id == id or not self.connected, 'The received id is not my id'
-	def _newServerSocket(self, req: Request):
-		req.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		req.conn.connect(SERVER_ADDRES)
+		if recvdCommand == COM.CONNECT:
+			if self.id != 0 and not payload.get('resumed', False): raise RuntimeError('the server could not resume the session')
+			self.codec = payload.get('codec', ConnectionPrimitives.CODEC_JSON)
+			self.push = payload.get('push', False)
+			self.resumeDeadline = 0.
+		self.resumable = payload['stay_connected']
+		if startsNewGame(payload): self._dropPushedEvents()
+		if self.onResponse: self.onResponse(req)
+		self.responseQueue.put(req)
+	# pushed events ------------------------------
+	def _recvPush(self, id: int, command: COM, payload: dict):
+		'''hands the event to its subscription or keeps it until the subscription is made,
+		an event ending the connection goes to the main thread at once, like a default response would'''
+		if (error := Schemas.validateResponse(command, payload)) is not None:
+			logging.error('Recvd invalid pushed %s: %s', command, error)
+			raise RuntimeError('Recvd invalid pushed event')
+		assert self.push and self.id == id, 'Unexpected pushed event'
+		self.resumable = payload['stay_connected']
+		event = Request(command, payload, None, True, state=2, timeRecvd=time.perf_counter())
+		if startsNewGame(payload): self._dropPushedEvents()
+		if self.onResponse: self.onResponse(event)
+		with self.pushLock:
+			subscription = self.subscriptions.pop(command, None)
+			if subscription is None and payload['stay_connected']:
+				self.pushedEvents.setdefault(command, deque()).append(event)
+				return
+		event.callback = subscription.callback if subscription else lambda res: None
+		self.responseQueue.put(event)
+	def _subscribe(self, req: Request):
+		with self.pushLock:
+			if not self.push: return self.outgoing.append(req) # NOTE the session resumed meanwhile, it long-polls now
+			if not (events := self.pushedEvents.get(req.command)):
+				self.subscriptions[req.command] = req
+				return
+			event = events.popleft()
+		event.callback = req.callback
+		self.responseQueue.put(event)
+	def _dropPushedEvents(self):
+		'''the events kept belong to the previous game'''
+		with self.pushLock:
+			self.pushedEvents.clear()
+	def _cancelSubscriptions(self):
+		with self.pushLock:
+			subscriptions, self.subscriptions = self.subscriptions, {}
+		for command in subscriptions: self.resetAlreadySent(command)
+	def _newServerSocket(self):
+		self.conn = self._openSocket(background=self.ioLoop is not None)
+		self._connectionChanged()
+	def _openSocket(self, background=False) -> socket.socket:
+		'''@background: doesn't wait for the connect, the shared loop learns its outcome when the socket becomes writable'''
+		conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if background: conn.setblocking(False)
+		try:
+			conn.connect(self.addr)
+		except BlockingIOError:
+			pass
+		except OSError:
+			conn.close()
+			raise
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return conn
+	# resuming ---------------------------------
+	def _resume(self, conn: socket.socket, error: OSError):
+		'''continues the session on a new connection, after the connection was lost or the server restarted with its journal'''
+		if self.ioLoop is not None: return self._resumeLater(conn, error)
+		logging.warning('connection of session %d lost, resuming it', self.id)
+		self._resumeOn(conn, self._reconnect())
+	def _resumeOn(self, conn: socket.socket, newConn: socket.socket):
+		'''the pending requests are sent again with their reqIds, the resumed session long-polls so its subscriptions are sent as blocking requests'''
+		with self.sendLock:
+			with self.pushLock:
+				self.push = False
+				subscriptions, self.subscriptions = list(self.subscriptions.values()), {}
+				self.pushedEvents.clear()
+			for req in [req for req in subscriptions if req.command == COM.CONNECTION_CHECK]: # NOTE the new connection answers it, held with another blocking request it would answer that one
+				subscriptions.remove(req)
+				req.payload, req.state = {'stay_connected': True}, 2
+				self.responseQueue.put(req)
+			with self.pendingLock:
+				for req in [req for req in self.pendingReqs.values() if req.command == COM.CONNECT]: del self.pendingReqs[req.reqId] # NOTE the resume sent on a connection lost before its answer, a new one goes first
+				pending = sorted(self.pendingReqs.values(), key=lambda req: req.reqId)
+			self.conn = newConn
+			if self.ioLoop is not None: self.ioLoop.retire(self, conn)
+			else: closeSocket(conn)
+			self._connectionChanged()
+			resume = Request(COM.CONNECT, {'name': self.name}, lambda res: None, False)
+			for req in [resume, *subscriptions]: self._markSent(req)
+			try:
+				for req in [resume, *pending, *subscriptions]: self._sendReq(req)
+			except OSError: # NOTE the new connection was accepted by the dying server, its loss resumes the session again
+				logging.info('resuming failed, the requests go again on the next connection')
+	def _reconnect(self) -> socket.socket:
+		'''@return new connection to the server, the server may be restarting, so it's retried until RESUME_TIMEOUT'''
+		deadline, delay = time.time() + RESUME_TIMEOUT, .1
+		while True:
+			try:
+				return self._openSocket()
+			except OSError:
+				if time.time() + delay > deadline or self.quitNowEvent.is_set(): raise
+				time.sleep(delay)
+				delay = min(2 * delay, 1.)
+	def _resumeLater(self, conn: socket.socket, error: OSError):
+		'''the shared loop can't sleep in _reconnect, every attempt is its timed event with a non-blocking connect,
+		a refused attempt is lost like any connection and schedules the next one, until RESUME_TIMEOUT'''
+		self.ioLoop.retire(self, conn)
+		if not self.resumeDeadline:
+			logging.warning('connection of session %d lost, resuming it', self.id)
+			self.resumeDeadline, self.resumeDelay = time.time() + RESUME_TIMEOUT, 0.
+		elif time.time() + self.resumeDelay > self.resumeDeadline: raise error
+		self.ioLoop.schedule(self.resumeDelay, self, self._reconnectFrom, conn)
+		self.resumeDelay = min(max(2 * self.resumeDelay, .1), 1.)
+	def _reconnectFrom(self, conn: socket.socket):
+		if conn is not self.conn or self.quitNowEvent.is_set(): return # NOTE closed meanwhile
+		try:
+			newConn = self._openSocket(background=True)
+		except OSError as e:
+			return self._connectionLost(conn, e)
+		self._resumeOn(conn, newConn)
+	def _connectionChanged(self):
+		'''lets the receiving thread watch the new connection'''
+		if self.ioLoop is not None: return self.ioLoop.watch(self)
+		try:
+			self.wakeupSend.send(b'\0')
+		except OSError: # NOTE the wakeups pending fill the buffer, or the session already quit
+			pass
+	def _drainWakeup(self):
+		try:
+			while self.wakeupRecv.recv(64): pass
+		except BlockingIOError:
+			pass
+	def _closeConnection(self):
+		conn, self.conn = self.conn, None
+		with self.pendingLock:
+			self.pendingReqs.clear()
+		if conn is None: return
+		if self.ioLoop is not None: return self.ioLoop.retire(self, conn) # NOTE closed by the loop after it stops watching it
+		self._connectionChanged()
+		closeSocket(conn)
+
+def closeSocket(conn: socket.socket):
+	try:
+		conn.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
+	conn.close()
+
+class LoopConnection:
+	'''the connection of a session in SharedIOLoop, with its partially received data and the bytes not yet sent,
+	both are processed only by Thread-IOLoop'''
+	__slots__ = ('sock', 'session', 'loop', 'inBuffer', 'outBuffer', 'connecting', 'waitingWritable')
+	def __init__(self, sock: socket.socket, session: Session, loop: 'SharedIOLoop'):
+		self.sock = sock
+		self.session = session
+		self.loop = loop
+		self.inBuffer = ConnectionPrimitives.MessageBuffer()
+		self.outBuffer = bytearray()
+		self.connecting = True # NOTE until the socket is writable the first time, the connect may still be in progress
+		self.waitingWritable = True
+	def sendall(self, data):
+		'''queues the data, never blocks the loop'''
+		self.loop.queueOutput(self, data)
+
+class SharedIOLoop:
+	'''one thread sending and receiving for any number of sessions, instead of two threads in every session
+	all the sockets are non-blocking, registered, unregistered and closed only by this thread, so a reused fd can't be mistaken'''
+	def __init__(self):
+		self.selector = selectors.DefaultSelector()
+		self.wakeupRecv, self.wakeupSend = socket.socketpair()
+		self.wakeupRecv.setblocking(False)
+		self.wakeupSend.setblocking(False)
+		self.selector.register(self.wakeupRecv, selectors.EVENT_READ)
+		self.sendQueue: SimpleQueue[tuple[Session, list[Request]]] = SimpleQueue()
+		self.changedQueue: SimpleQueue[Session] = SimpleQueue()
+		self.retiredQueue: SimpleQueue[tuple[Session, socket.socket]] = SimpleQueue()
+		self.watched: dict[Session, LoopConnection] = {}
+		self.timers: list[tuple[float, int, Session, typing.Callable, tuple]] = [] # NOTE heap of the timed events, only on Thread-IOLoop
+		self.timerSeq = itertools.count() # NOTE orders the events due at the same time
+		self.quitEvent = threading.Event()
+		self.thread = threading.Thread(target=lambda: runFuncLogged(self.loop), name='Thread-IOLoop', daemon=True)
+		self.thread.start()
+	# api called from the sessions ----------------
+	def send(self, session: Session, reqs: list[Request]):
+		self.sendQueue.put((session, reqs))
+		self._wakeup()
+	def watch(self, session: Session):
+		'''called from Thread-IOLoop it takes effect at once, the messages sent next go to the new connection'''
+		if threading.current_thread() is self.thread: return self._watch(session)
+		self.changedQueue.put(session)
+		self._wakeup()
+	def retire(self, session: Session, conn: socket.socket):
+		if threading.current_thread() is self.thread: return self._retire(session, conn)
+		self.retiredQueue.put((session, conn))
+		self._wakeup()
+	def schedule(self, delay: float, session: Session, func: typing.Callable, *args):
+		'''runs func(*args) for the session in @delay seconds, only on Thread-IOLoop'''
+		heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timerSeq), session, func, args))
+	def output(self, session: Session) -> LoopConnection:
+		'''@return the watched connection of the session to queue its messages to, only on Thread-IOLoop'''
+		conn = self.watched.get(session)
+		if conn is None or conn.sock is not session.conn: raise ConnectionPrimitives.ConnectionClosed('the connection of the session is not watched')
+		return conn
+	def close(self):
+		self.quitEvent.set()
+		self._wakeup()
+		self.thread.join()
+		for conn in self.watched.values(): closeSocket(conn.sock)
+		self.selector.close()
+		self.wakeupRecv.close()
+		self.wakeupSend.close()
+	def _wakeup(self):
+		try:
+			self.wakeupSend.send(b'\0')
+		except OSError: # NOTE the wakeups pending fill the buffer, or the loop already closed
+			pass
+
+	# loop thread -----------------------------------
+	def loop(self):
+		while not self.quitEvent.is_set():
+			timeout = min(max(self.timers[0][0] - time.monotonic(), 0.), 1.) if self.timers else 1.
+			for key, events in self.selector.select(timeout=timeout):
+				if key.fileobj is self.wakeupRecv: self.handleQueued()
+				elif self.watched.get(key.data.session) is key.data: self._guarded(key.data.session, self.handleConnection, key.data, events) # NOTE not retired earlier in this batch
+			self.runTimers()
+	def runTimers(self):
+		now = time.monotonic()
+		while self.timers and self.timers[0][0] <= now:
+			_, _, session, func, args = heapq.heappop(self.timers)
+			if session.ioError is None: self._guarded(session, func, *args)
+	def handleQueued(self):
+		try:
+			while self.wakeupRecv.recv(RECV_SIZE): pass
+		except BlockingIOError:
+			pass
+		for session, reqs in iterQueue(self.sendQueue):
+			if session.ioError is None: self._guarded(session, session._sendReqs, reqs)
+		for session, conn in iterQueue(self.retiredQueue): self._retire(session, conn)
+		for session in iterQueue(self.changedQueue): self._watch(session)
+	def handleConnection(self, conn: LoopConnection, events: int):
+		try:
+			if events & selectors.EVENT_WRITE:
+				if conn.connecting and (error := conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)): raise OSError(error, os.strerror(error))
+				conn.connecting = False
+				self.flushConnection(conn)
+			if events & selectors.EVENT_READ: self.readConnection(conn)
+		except OSError as e:
+			conn.session._connectionLost(conn.sock, e)
+	def readConnection(self, conn: LoopConnection):
+		try:
+			data = conn.sock.recv(RECV_SIZE)
+		except BlockingIOError:
+			return
+		if not data: raise ConnectionPrimitives.ConnectionClosed('connection closed by the other side')
+		for body in conn.inBuffer.feed(data):
+			conn.session._handleMsg(*ConnectionPrimitives.decodeMessage(body))
+	def queueOutput(self, conn: LoopConnection, data: bytes):
+		conn.outBuffer += data
+		if not conn.connecting: self.flushConnection(conn)
+	def flushConnection(self, conn: LoopConnection):
+		'''sends as much of the buffered data as the socket accepts, the rest waits until it becomes writable'''
+		try:
+			sent = conn.sock.send(conn.outBuffer) if conn.outBuffer else 0
+		except BlockingIOError:
+			sent = 0
+		except OSError:
+			sent = len(conn.outBuffer) # NOTE the connection is lost, reading from it resumes or fails the session
+		del conn.outBuffer[:sent]
+		if bool(conn.outBuffer) != conn.waitingWritable:
+			conn.waitingWritable = bool(conn.outBuffer)
+			self.selector.modify(conn.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE * conn.waitingWritable), conn)
+	def _watch(self, session: Session):
+		sock = None if session.quitNowEvent.is_set() else session.conn
+		if (conn := self.watched.get(session)) is not None and conn.sock is sock: return
+		if conn is not None: self._unwatch(session)
+		if sock is None: return
+		sock.setblocking(False)
+		self.watched[session] = conn = LoopConnection(sock, session, self)
+		self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+	def _retire(self, session: Session, sock: socket.socket):
+		if (conn := self.watched.get(session)) is not None and conn.sock is sock: self._unwatch(session)
+		closeSocket(sock)
+	def _unwatch(self, session: Session):
+		self.selector.unregister(self.watched.pop(session).sock)
+	def _guarded(self, session: Session, func, *args):
+		'''runs the I/O of one session, its failure fails only that session, see Session.checkThreads'''
+		try:
+			func(*args)
+		except Exception as e:
+			logging.error('session %d failed in the shared I/O loop: %r', session.id, e)
+			session.ioError = e
+			session._closeConnection()
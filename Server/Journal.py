@@ -0,0 +1,178 @@
+'''Append-only journal of the server state, so a restarted server continues the games it had
+
+the state is kept as records of (table, id) keys - the latest record of a key wins, a deletion drops the key,
+the records are group-committed: the thread handling the requests only appends them to a list
+and Thread-Journal writes whatever piled up meanwhile with one write and one fsync,
+the journal is split into segments, the full ones are compacted on Thread-Compact into a snapshot of the live records
+so the recovery reads the newest snapshot and the few segments written after it'''
+import os, re, struct, zlib, time
+import threading, logging
+from typing import Callable, Optional
+
+from Shared.Helpers import runFuncLogged
+
+Key = tuple[int, int] # NOTE (table, id)
+HEADER = struct.Struct('<IBIi') # NOTE crc32 of the rest of the record, table, id, body length
+HEADER_REST = struct.Struct('<BIi')
+DELETED = -1 # NOTE body length of a deletion
+SEGMENT_BYTES = 2**26
+SEGMENT_NAME = 'journal-{:08d}.bin'
+SNAPSHOT_NAME = 'snapshot-{:08d}.bin'
+FILE_RE = re.compile(r'(journal|snapshot)-(\d{8})\.bin')
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+def packRecord(table: int, id: int, body: Optional[bytes]) -> bytes:
+	'''@body None deletes the key'''
+	rest = HEADER_REST.pack(table, id, DELETED if body is None else len(body))
+	body = body or b''
+	return zlib.crc32(body, zlib.crc32(rest)).to_bytes(4, 'little') + rest + body
+def applyRecords(state: dict[Key, bytes], data: bytes, name: str):
+	'''applies the records of one file to @state, a torn record ends the file - it's the tail of a segment the server died writing'''
+	offset, end = 0, len(data)
+	view = memoryview(data) # NOTE the crc is computed without copying the record
+	unpack, crc32, headerSize = HEADER.unpack_from, zlib.crc32, HEADER.size # NOTE locals, the loop runs for every record of the recovery
+	while offset + headerSize <= end:
+		crc, table, id, length = unpack(data, offset)
+		start = offset + headerSize
+		stop = start + length if length > 0 else start
+		if stop > end or crc32(view[offset+4:stop]) != crc: break
+		if length == DELETED: state.pop((table, id), None)
+		else: state[table, id] = data[start:stop]
+		offset = stop
+	if offset != end: logging.warning('journal file %s has a torn record at byte %d of %d, the rest is ignored', name, offset, end)
+
+class Journal:
+	'''the records appended by one thread, made durable in batches by Thread-Journal'''
+	def __init__(self, directory: str, segmentBytes=SEGMENT_BYTES):
+		self.directory = directory
+		self.segmentBytes = segmentBytes
+		os.makedirs(directory, exist_ok=True)
+		self.cond = threading.Condition()
+		self.pending: list[bytes] = [] # NOTE records not written yet, guarded by cond
+		self.callbacks: list[Callable[[], None]] = [] # NOTE called after the next fsync, guarded by cond
+		self.writing = False
+		self.closing = False
+		self.file = None
+		self.seq = 0 # NOTE number of the segment being written
+		self.segmentSize = 0
+		self.records = 0
+		self.commits = 0
+		self.thread: Optional[threading.Thread] = None
+		self.compactThread: Optional[threading.Thread] = None
+
+	# files ---------------------------------------
+	def files(self) -> tuple[int, list[int]]:
+		'''@return the number of the newest snapshot, 0 when there is none, and the numbers of the segments after it'''
+		found = [(m[1], int(m[2])) for m in map(FILE_RE.fullmatch, os.listdir(self.directory)) if m]
+		snapshot = max([seq for kind, seq in found if kind == 'snapshot'], default=0)
+		return snapshot, sorted(seq for kind, seq in found if kind == 'journal' and seq > snapshot)
+	def read(self, snapshot: int, segments: list[int]) -> dict[Key, bytes]:
+		state = {}
+		for name in [SNAPSHOT_NAME.format(snapshot)] * (snapshot > 0) + [SEGMENT_NAME.format(seq) for seq in segments]:
+			with open(os.path.join(self.directory, name), 'rb') as f:
+				applyRecords(state, f.read(), name)
+		return state
+	def load(self) -> dict[Key, bytes]:
+		'''@return the latest body of every live key'''
+		return self.read(*self.files())
+	def _openSegment(self, seq: int):
+		self.seq, self.segmentSize = seq, 0
+		self.file = open(os.path.join(self.directory, SEGMENT_NAME.format(seq)), 'ab')
+		self._syncDirectory()
+	def _syncDirectory(self):
+		'''makes the created and renamed files durable, not possible on Windows where it's not needed'''
+		try:
+			fd = os.open(self.directory, os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	# api --------------------------------------------
+	def start(self):
+		'''opens a new segment after the existing ones and starts Thread-Journal'''
+		snapshot, segments = self.files()
+		self._openSegment(max([snapshot, *segments]) + 1)
+		self.thread = threading.Thread(target=lambda: runFuncLogged(self.writeLoop), name='Thread-Journal', daemon=True)
+		self.thread.start()
+	def put(self, table: int, id: int, body: bytes):
+		self._append(packRecord(table, id, body))
+	def delete(self, table: int, id: int):
+		self._append(packRecord(table, id, None))
+	def _append(self, record: bytes):
+		with self.cond:
+			self.pending.append(record)
+			self.cond.notify()
+	def whenDurable(self, callback: Callable[[], None]):
+		'''calls @callback once everything appended so far is on disk - right away if it already is, otherwise from Thread-Journal,
+		the callbacks are called in the order they were given'''
+		with self.cond:
+			if self.pending or self.writing or self.callbacks:
+				self.callbacks.append(callback)
+				self.cond.notify()
+				return
+		callback()
+	def idle(self) -> bool:
+		with self.cond:
+			return not (self.pending or self.writing or self.callbacks)
+	def close(self):
+		'''writes what is left and compacts all the segments, so the next start reads one snapshot'''
+		with self.cond:
+			self.closing = True
+			self.cond.notify()
+		if self.thread is not None: self.thread.join()
+		if self.compactThread is not None: self.compactThread.join()
+		if self.file is None: return
+		self.file.close()
+		self.compact(self.seq)
+
+	# writing ---------------------------------------
+	def writeLoop(self):
+		while True:
+			with self.cond:
+				while not (self.pending or self.callbacks or self.closing): self.cond.wait()
+				if not (self.pending or self.callbacks): return
+				records, self.pending = self.pending, []
+				callbacks, self.callbacks = self.callbacks, []
+				self.writing = True
+			if records: self.commit(records)
+			for callback in callbacks: callback()
+			with self.cond:
+				self.writing = False
+	def commit(self, records: list[bytes]):
+		'''the records appended during the previous commit go in one write and one fsync'''
+		data = b''.join(records)
+		self.file.write(data)
+		self.file.flush()
+		_sync(self.file.fileno())
+		self.segmentSize += len(data)
+		self.records += len(records)
+		self.commits += 1
+		if self.segmentSize >= self.segmentBytes: self.rotate()
+	def rotate(self):
+		'''starts the next segment, the full ones are compacted into a snapshot unless a compaction still runs'''
+		self.file.close()
+		self._openSegment(self.seq + 1)
+		if self.compactThread is not None and self.compactThread.is_alive(): return
+		upTo = self.seq - 1
+		self.compactThread = threading.Thread(target=lambda: runFuncLogged(lambda: self.compact(upTo)), name='Thread-Compact', daemon=True)
+		self.compactThread.start()
+	def compact(self, upTo: int):
+		'''replaces the newest snapshot and the segments up to @upTo with a snapshot of their live records'''
+		started = time.perf_counter()
+		snapshot, segments = self.files()
+		segments = [seq for seq in segments if seq <= upTo]
+		if not segments: return
+		state = self.read(snapshot, segments)
+		path = os.path.join(self.directory, SNAPSHOT_NAME.format(upTo))
+		with open(path + '.tmp', 'wb') as f:
+			f.write(b''.join(packRecord(table, id, body) for (table, id), body in state.items()))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(path + '.tmp', path)
+		self._syncDirectory()
+		for name in [SNAPSHOT_NAME.format(snapshot)] * (snapshot > 0) + [SEGMENT_NAME.format(seq) for seq in segments]:
+			os.remove(os.path.join(self.directory, name))
+		logging.info('journal compacted into %s, %d live records in %.3f s', SNAPSHOT_NAME.format(upTo), len(state), time.perf_counter() - started)
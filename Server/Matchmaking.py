@@ -0,0 +1,32 @@
+from collections import OrderedDict
+from typing import Optional, Protocol
+
+class Pairable(Protocol):
+	id: int
+
+class MatchmakingQueue:
+	'''players not yet in a game, in the order they connected
+	players long-polling with COM.PAIR are kept in a second queue so they are preferred as opponents'''
+	def __init__(self):
+		self.unpaired: OrderedDict[int, Pairable] = OrderedDict()
+		self.polling: OrderedDict[int, Pairable] = OrderedDict()
+
+	def add(self, player: Pairable):
+		self.unpaired[player.id] = player
+	def remove(self, player: Pairable):
+		'''removes the player from both queues, once paired or disconnected'''
+		self.unpaired.pop(player.id, None)
+		self.polling.pop(player.id, None)
+	def setPolling(self, player: Pairable, polling: bool):
+		if not polling: self.polling.pop(player.id, None)
+		elif player.id in self.unpaired: self.polling[player.id] = player
+
+	def findOpponent(self, player: Pairable) -> Optional[Pairable]:
+		'''@return the longest polling player, otherwise the longest waiting one, never the player itself'''
+		for queue in (self.polling, self.unpaired):
+			for opponent in queue.values(): # NOTE looks at two entries at most
+				if opponent.id != player.id: return opponent
+		return None
+
+	def __len__(self) -> int:
+		return len(self.unpaired)
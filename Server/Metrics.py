@@ -0,0 +1,93 @@
+'''Live server metrics, served as text in the Prometheus exposition format
+
+updating them costs a few integer operations on the thread handling the requests,
+everything derived from the server state is computed only when the endpoint is read'''
+import bisect, threading, logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable
+
+PREFIX = 'battleships_'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 25.) # NOTE seconds
+
+class Histogram:
+	def __init__(self, buckets: tuple[float, ...]=LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1) # NOTE the last one is +Inf
+		self.sum = 0.
+		self.count = 0
+	def observe(self, value: float):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+	def merge(self, other: 'Histogram'):
+		'''adds the observations of @other, which has the same buckets'''
+		self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+		self.sum += other.sum
+		self.count += other.count
+	def render(self, name: str, labels: str) -> list[str]:
+		lines = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+			cumulative += count
+			lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+		lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+		lines.append(f'{name}_count{{{labels}}} {self.count}')
+		return lines
+
+def _labels(label: tuple[str, str]) -> str:
+	return f'{label[0]}="{label[1]}"' if label else ''
+
+class Metrics:
+	'''counters and histograms, each one keyed by its name and an optional (label name, label value)'''
+	def __init__(self):
+		self.counters: dict[tuple[str, tuple], int] = {}
+		self.histograms: dict[tuple[str, tuple], Histogram] = {}
+	def inc(self, name: str, label: tuple[str, str]=(), n=1):
+		key = (name, label)
+		self.counters[key] = self.counters.get(key, 0) + n
+	def observe(self, name: str, label: tuple[str, str], value: float):
+		key = (name, label)
+		if key not in self.histograms: self.histograms[key] = Histogram()
+		self.histograms[key].observe(value)
+	def snapshot(self) -> tuple[dict, dict]:
+		'''@return copies of the counters and histograms, a worker process sends them to the one serving the endpoint'''
+		histograms = {}
+		for key, histogram in list(self.histograms.items()):
+			histograms[key] = kept = Histogram(histogram.buckets)
+			kept.merge(histogram)
+		return dict(self.counters), histograms
+	def merge(self, counters: dict, histograms: dict):
+		'''adds a snapshot() of other metrics'''
+		for key, value in counters.items(): self.counters[key] = self.counters.get(key, 0) + value
+		for key, histogram in histograms.items():
+			if key not in self.histograms: self.histograms[key] = Histogram(histogram.buckets)
+			self.histograms[key].merge(histogram)
+
+	def render(self, gauges: dict[tuple[str, tuple], float]) -> str:
+		'''@gauges current values of the server state, keyed like the counters'''
+		lines = []
+		for (name, label), value in sorted(gauges.items()):
+			lines.append(f'{PREFIX}{name}{{{_labels(label)}}} {value}')
+		for (name, label), value in sorted(list(self.counters.items())): # NOTE list() copies it at once, the handling thread may insert meanwhile
+			lines.append(f'{PREFIX}{name}_total{{{_labels(label)}}} {value}')
+		for (name, label), histogram in sorted(list(self.histograms.items())):
+			lines += histogram.render(PREFIX + name, _labels(label))
+		return '\n'.join(lines) + '\n'
+
+# endpoint ----------------------------------------
+def serveMetrics(addr, renderMetrics: Callable[[], str]) -> ThreadingHTTPServer:
+	'''serves the output of renderMetrics on every GET from a daemon thread, shut it down with .shutdown()'''
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			body = renderMetrics().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		def log_message(self, format, *args):
+			logging.debug('metrics request: ' + format % args)
+	httpServer = ThreadingHTTPServer(addr, MetricsHandler)
+	httpServer.daemon_threads = True
+	threading.Thread(target=httpServer.serve_forever, daemon=True, name='Thread-Metrics').start()
+	return httpServer
@@ -0,0 +1,45 @@
+from typing import Optional
+
+Key = tuple[str, int] # NOTE ('player', id) or ('game', id)
+
+class Registry:
+	'''which listener process owns every player and game, and the one player left waiting on COM.PAIR without an opponent in his process
+	kept by the supervisor of the reuseport engine, every change is reported by the listeners'''
+	def __init__(self):
+		self.owners: dict[Key, int] = {}
+		self.waiting: Optional[tuple[int, int]] = None # NOTE (process, player id)
+
+	def own(self, process: int, key: Key):
+		self.owners[key] = process
+	def disown(self, process: int, key: Key):
+		'''a report of a process which doesn't own the key anymore is stale, the key moved meanwhile'''
+		if self.owners.get(key) == process: del self.owners[key]
+		if key[0] == 'player': self.stopWaiting(process, key[1])
+	def move(self, key: Key, process: int):
+		if key in self.owners: self.owners[key] = process
+
+	def wait(self, process: int, playerId: int) -> Optional[int]:
+		'''@return the process where another player waits, the player has to move there, None when he's the one waiting now'''
+		if self.waiting is not None and self.waiting[0] != process and self.owners.get(('player', self.waiting[1])) == self.waiting[0]:
+			target, self.waiting = self.waiting[0], None
+			return target
+		self.waiting = (process, playerId)
+		return None
+	def stopWaiting(self, process: int, playerId: int):
+		if self.waiting == (process, playerId): self.waiting = None
+
+	def processDied(self, process: int) -> dict[str, int]:
+		'''drops everything the process owned, @return the number of lost keys per kind'''
+		lost = [key for key, owner in self.owners.items() if owner == process]
+		for key in lost: del self.owners[key]
+		if self.waiting is not None and self.waiting[0] == process: self.waiting = None
+		return {kind: sum(key[0] == kind for key in lost) for kind in ('player', 'game')}
+	def counts(self) -> dict[tuple[str, int], int]:
+		'''@return the number of keys per (kind, process), may be called from another thread'''
+		counts = {}
+		for (kind, _), process in list(self.owners.items()): # NOTE list() copies it at once
+			counts[(kind, process)] = counts.get((kind, process), 0) + 1
+		return counts
+
+	def __len__(self) -> int:
+		return len(self.owners)
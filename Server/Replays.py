@@ -0,0 +1,140 @@
+'''Replays of the finished games in fixed size binary records, read back through mmap
+
+every process running the game logic appends to its own file, the game's record is written once it's won or abandoned,
+a record holds both placements, every shot with the milliseconds since the previous one and the outcome,
+all the records are RECORD_SIZE bytes so the n-th one is read without parsing the ones before it
+run from the repo root: python -m Server.Replays DIR [--json FILE] prints the statistics of the replays in DIR'''
+import os, time, mmap, struct, argparse, json, logging
+from typing import Iterator
+
+from Shared import Fleet
+
+MAGIC = b'BSREPLAY'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sHH') # NOTE magic, version, record size
+HEAD = struct.Struct('<IIIdfBBH') # NOTE game id, ids of both players, unix time the shooting started, duration, index of the first mover and of the winner, shots fired
+SHOT = struct.Struct('<BH') # NOTE cell y * GRID_WIDTH + x, milliseconds since the previous shot or the start
+MAX_SHIPS = sum(Fleet.SHIP_SIZES.values())
+MAX_SHOTS = 2 * Fleet.GRID_WIDTH * Fleet.GRID_HEIGHT # NOTE every cell of both boards, more shots are counted but not kept
+SHIPS_BYTES = 4 * MAX_SHIPS # NOTE x, y, size, horizontal of every ship as in Fleet.PackedFleet.ships, a size 0 pads it
+RECORD_SIZE = HEAD.size + 2 * SHIPS_BYTES + MAX_SHOTS * SHOT.size
+NO_WINNER = 255 # NOTE the game was abandoned
+FILE_NAME = 'replays-{}-{}.bin'
+
+def packReplay(gameId: int, playerIds: tuple[int, int], started: float, duration: float, firstMover: int, winner: int, ships: tuple[bytes, bytes], history: bytes) -> bytes:
+	'''@firstMover, @winner - indexes of the players, @ships - their Fleet.PackedFleet.ships, @history - the SHOT records of the game'''
+	head = HEAD.pack(gameId, *playerIds, started, duration, firstMover, winner, len(history) // SHOT.size)
+	shots = history[:MAX_SHOTS * SHOT.size]
+	return head + b''.join(s[:SHIPS_BYTES].ljust(SHIPS_BYTES, b'\0') for s in ships) + shots + bytes(MAX_SHOTS * SHOT.size - len(shots))
+
+class ReplayWriter:
+	'''appends the records to a file of this process in @directory, created with the first record,
+	every record goes in one unbuffered write, so a killed server leaves at most one torn record which the reader ignores'''
+	def __init__(self, directory: str):
+		self.directory = directory
+		self.file = None
+		self.recorded = 0
+	def record(self, data: bytes):
+		assert len(data) == RECORD_SIZE
+		if self.file is None:
+			os.makedirs(self.directory, exist_ok=True)
+			path = os.path.join(self.directory, FILE_NAME.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+			self.file = open(path, 'xb', buffering=0)
+			self.file.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+			logging.info('recording replays to %s', path)
+		self.file.write(data)
+		self.recorded += 1
+	def close(self):
+		if self.file is not None: self.file.close()
+
+# reading ---------------------------------------
+class Replay:
+	'''one recorded game, decoded from its record only when it's read'''
+	__slots__ = ('gameId', 'playerIds', 'started', 'duration', 'firstMover', 'winner', 'shotCount', 'ships', 'shots')
+	def __init__(self, data, offset: int):
+		self.gameId, *ids, self.started, self.duration, self.firstMover, self.winner, self.shotCount = HEAD.unpack_from(data, offset)
+		self.playerIds = tuple(ids)
+		offset += HEAD.size
+		self.ships = tuple([tuple(data[o:o+4]) for o in range(start, start + SHIPS_BYTES, 4) if data[o+2]] for start in (offset, offset + SHIPS_BYTES))
+		offset += 2 * SHIPS_BYTES
+		self.shots = [(cell % Fleet.GRID_WIDTH, cell // Fleet.GRID_WIDTH, delay) for cell, delay in SHOT.iter_unpack(data[offset:offset + min(self.shotCount, MAX_SHOTS) * SHOT.size])]
+	def __repr__(self):
+		return f'{self.__class__.__name__}(gameId={self.gameId}, shots={self.shotCount}, winner={self.winner})'
+	def shooter(self, shot: int) -> int:
+		'''@return index of the player who fired the @shot-th shot, the players take turns from the first mover'''
+		return (self.firstMover + shot) % 2
+	def abandoned(self) -> bool:
+		return self.winner == NO_WINNER
+
+class ReplayFile:
+	'''the records of one file, mapped into memory and decoded on access,
+	a file still being written is read as far as it was when opened'''
+	def __init__(self, path: str):
+		self.path = path
+		with open(path, 'rb') as f:
+			header = f.read(FILE_HEADER.size)
+			if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header) != (MAGIC, VERSION, RECORD_SIZE):
+				raise ValueError(f'{path} is not a replay file of version {VERSION}')
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.count = (len(self.map) - FILE_HEADER.size) // RECORD_SIZE # NOTE a torn record at the end isn't counted
+	def __len__(self) -> int:
+		return self.count
+	def __getitem__(self, i: int) -> Replay:
+		if not -self.count <= i < self.count: raise IndexError('replay index out of range')
+		return Replay(self.map, FILE_HEADER.size + (i % self.count) * RECORD_SIZE)
+	def __iter__(self) -> Iterator[Replay]:
+		return (self[i] for i in range(self.count))
+	def heads(self) -> Iterator[tuple]:
+		'''the HEAD fields of every record, without decoding the placements and shots'''
+		return struct.iter_unpack(HEAD.format + f'{RECORD_SIZE - HEAD.size}x', memoryview(self.map)[FILE_HEADER.size:FILE_HEADER.size + self.count * RECORD_SIZE])
+	def shotCells(self, i: int) -> bytes:
+		'''@return the cells y * GRID_WIDTH + x of the shots of the i-th record, without decoding the rest of it'''
+		offset = FILE_HEADER.size + i * RECORD_SIZE
+		start = offset + HEAD.size + 2 * SHIPS_BYTES
+		return self.map[start:start + min(HEAD.unpack_from(self.map, offset)[-1], MAX_SHOTS) * SHOT.size:SHOT.size]
+	def close(self):
+		self.map.close()
+
+def openReplays(directory: str) -> list[ReplayFile]:
+	'''@return the replay files in @directory, oldest first'''
+	return [ReplayFile(os.path.join(directory, name)) for name in sorted(os.listdir(directory)) if name.startswith('replays-') and name.endswith('.bin')]
+
+# statistics ---------------------------------------
+def statistics(files: list[ReplayFile]) -> dict:
+	'''win rate of the first mover, shots per won game and how often every cell was shot'''
+	games = abandoned = firstMoverWins = shots = 0
+	duration = 0.
+	cells = [0] * (Fleet.GRID_WIDTH * Fleet.GRID_HEIGHT)
+	for file in files:
+		for i, (gameId, id1, id2, started, length, firstMover, winner, shotCount) in enumerate(file.heads()):
+			games += 1
+			if winner == NO_WINNER:
+				abandoned += 1
+				continue
+			firstMoverWins += winner == firstMover
+			shots += shotCount
+			duration += length
+			for cell in file.shotCells(i): cells[cell] += 1
+	won = games - abandoned
+	return {'games': games, 'abandoned': abandoned, 'first_mover_win_rate': firstMoverWins / won if won else None,
+		'shots_per_game': shots / won if won else None, 'seconds_per_game': duration / won if won else None,
+		'shot_cells': [cells[y*Fleet.GRID_WIDTH:(y+1)*Fleet.GRID_WIDTH] for y in range(Fleet.GRID_HEIGHT)]}
+
+def main():
+	parser = argparse.ArgumentParser('Replays')
+	parser.add_argument('directory', help='directory the server recorded the replays to')
+	parser.add_argument('--json', help='also write the statistics to this file')
+	args = parser.parse_args()
+	files = openReplays(args.directory)
+	started = time.perf_counter()
+	stats = statistics(files)
+	print(f"{stats['games']} games in {len(files)} files read in {time.perf_counter() - started:.3f} s, {stats['abandoned']} abandoned")
+	if stats['first_mover_win_rate'] is not None:
+		print(f"first mover wins {100 * stats['first_mover_win_rate']:.1f} %, {stats['shots_per_game']:.1f} shots and {stats['seconds_per_game']:.1f} s per won game")
+		total = max(sum(map(sum, stats['shot_cells'])), 1)
+		print('shots per cell in %:')
+		for row in stats['shot_cells']: print(' '.join(f'{100 * n / total:4.1f}' for n in row))
+	if args.json:
+		with open(args.json, 'w') as f: json.dump(stats, f, indent=1)
+if __name__ == '__main__':
+	main()
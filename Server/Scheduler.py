@@ -0,0 +1,46 @@
+import heapq, itertools
+from typing import Hashable, Iterable, Iterator, Optional
+
+class DeadlineScheduler:
+	'''min-heap of deadlines, each key has at most one active deadline
+	rescheduling or cancelling a key leaves its old heap entry in place, stale entries are skipped once they expire'''
+	def __init__(self):
+		self.heap: list[tuple[float, int, Hashable]] = []
+		self.deadlines: dict[Hashable, float] = {}
+		self.counter = itertools.count() # NOTE keeps the keys from being compared on equal deadlines
+
+	def schedule(self, key: Hashable, deadline: float):
+		'''sets the deadline of key, overriding the previous one'''
+		self.deadlines[key] = deadline
+		heapq.heappush(self.heap, (deadline, next(self.counter), key))
+		if len(self.heap) > 2 * len(self.deadlines) + 64: self._compact()
+	def scheduleAll(self, keys: Iterable[Hashable], deadline: float):
+		'''schedule() of many keys at once, the heap is rebuilt once instead of pushed into for every key'''
+		entries = [(deadline, next(self.counter), key) for key in keys]
+		self.deadlines.update((key, deadline) for _, _, key in entries)
+		self.heap += entries
+		heapq.heapify(self.heap)
+		if len(self.heap) > 2 * len(self.deadlines) + 64: self._compact()
+	def cancel(self, key: Hashable):
+		self.deadlines.pop(key, None)
+	def popExpired(self, now: float) -> Iterator[Hashable]:
+		'''yields keys whose deadline is <= now, each one is unscheduled before it's yielded'''
+		while self.heap and self.heap[0][0] <= now:
+			deadline, _, key = heapq.heappop(self.heap)
+			if self.deadlines.get(key) == deadline:
+				del self.deadlines[key]
+				yield key
+	def nextDeadline(self) -> Optional[float]:
+		'''@return the earliest active deadline, None when nothing is scheduled'''
+		while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+			heapq.heappop(self.heap)
+		return self.heap[0][0] if self.heap else None
+	def _compact(self):
+		'''drops the stale entries, so frequent rescheduling can't grow the heap without bound'''
+		self.heap = [e for e in self.heap if self.deadlines.get(e[2]) == e[0]]
+		heapq.heapify(self.heap)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self.deadlines
+	def __len__(self) -> int:
+		return len(self.deadlines)
@@ -1,20 +1,37 @@
-import socket
-import logging, inspect
-import threading, queue
-import random, time, os, sys
+import socket, asyncio, selectors
+import logging, argparse
+import threading, queue, multiprocessing, multiprocessing.connection, signal
+import random, time, sys, os, itertools, weakref, struct, gc
 
-from dataclasses import dataclass
+from multiprocessing import reduction
 from typing import Union, Optional
 
-from Shared import ConnectionPrimitives
+from Shared import ConnectionPrimitives, BinaryCodec, Fleet, Schemas
 from Shared.Enums import STAGES, COM
-from Shared.Helpers import runFuncLogged, initLogging
+from Shared.Helpers import runFuncLogged, initLogging, forwardChildLogging, initChildLogging, LogSettings
+from Server.Scheduler import DeadlineScheduler
+from Server.Matchmaking import MatchmakingQueue
+from Server.Metrics import Metrics, serveMetrics
+from Server.Registry import Registry
+from Server.Journal import Journal
+from Server.Replays import ReplayWriter, SHOT, NO_WINNER, packReplay
 
 # globals ----------------------------------------
 MAX_TIME_FOR_DISCONNECT = 30.
 MAX_TIME_FOR_BLOCKING = 20.
+MAX_TIME_FOR_SEND = 5.
+MAX_SEND_BACKLOG = 2**18
+METRICS_REPORT_INTERVAL = 1. # NOTE how often a worker of the sharded engine sends its metrics to the front
+RECV_SIZE = 4096
+CONN_KEYS = itertools.count(1)
+COM_VALUES = {c.value for c in COM}
+PLAYER_RECORD = struct.Struct('<I???bbBBI') # NOTE id, connected, ready, awaitingRematch, last shot, has fleet, codec and name lengths
+GAME_RECORD = struct.Struct('<III?BIbb') # NOTE id, player ids, active, stage, player on turn, shotted pos
+GAME_PLAYERS = struct.Struct('<III') # NOTE the start of GAME_RECORD, read by the recovery without unpacking the game
+STAGE_VALUES = {stage.value: stage for stage in STAGES}
 
 class ConnectedPlayer:
+	__slots__ = ('connected', 'id', 'name', 'inGame', 'gameId', 'lastReqTime', 'ready', 'fleet', 'awaitingRematch', 'lastShot', 'push', 'conn', 'codec')
 	def __init__(self, id: int, name: str):
 		self.connected: bool = True
 		self.id: int = id
@@ -22,91 +39,176 @@ class ConnectedPlayer:
 		self.inGame = False
 		self.gameId: int = 0
 		self.lastReqTime = time.time()
-		self.gameState: dict = {'ready': False}
+		self.ready = False
+		self.fleet: Optional[Fleet.PackedFleet] = None # NOTE the ships of the last COM.GAME_READINESS
 		self.awaitingRematch = False
+		self.lastShot = [-1, -1] # NOTE pos of his last shot in the current game, stays after it's delivered
+		self.push = False # NOTE subscribed on COM.CONNECT, gets the events pushed instead of holding blocking requests
+		self.conn = None # NOTE connection of COM.CONNECT, the pushes go there
+		self.codec: str = ConnectionPrimitives.CODEC_JSON
 	def __repr__(self):
-		return f'{self.__class__.__name__}(id={self.id}, gameId={self.gameId}, gameState={self.gameState})'
+		return f'{self.__class__.__name__}(id={self.id}, gameId={self.gameId}, ready={self.ready})'
 	def shootingReady(self):
-		return self.gameState['ready']
+		return self.ready
+	def gameState(self) -> dict:
+		'''the state of the board as sent to the clients'''
+		return {'ready': self.ready} if self.fleet is None else {'ready': self.ready, 'ships': self.fleet.shipDicts()}
 	def disconnect(self):
-		logging.info(f'disconnecting player {self.id}')
+		logging.info('disconnecting player %d', self.id)
 		self.connected = False
-@ dataclass
+	def pack(self) -> bytes:
+		'''@return the player as kept in the server journal, without his connection'''
+		codec, name = self.codec.encode(), self.name.encode()
+		head = PLAYER_RECORD.pack(self.id, self.connected, self.ready, self.awaitingRematch, *self.lastShot, self.fleet is not None, len(codec), len(name))
+		return head + codec + name + (b'' if self.fleet is None else self.fleet.pack())
+	@classmethod
+	def unpack(cls, data: bytes, offset=0) -> tuple['ConnectedPlayer', int]:
+		'''@return the player packed at @offset and the offset right after him'''
+		id, connected, ready, awaitingRematch, x, y, hasFleet, codecLen, nameLen = PLAYER_RECORD.unpack_from(data, offset)
+		offset += PLAYER_RECORD.size
+		player = cls.__new__(cls) # NOTE filled here without __init__, the recovery unpacks lots of them
+		player.id, player.connected, player.ready, player.awaitingRematch, player.lastShot = id, connected, ready, awaitingRematch, [x, y]
+		player.codec = data[offset:offset+codecLen].decode()
+		offset += codecLen
+		player.name = data[offset:offset+nameLen].decode()
+		offset += nameLen
+		player.inGame, player.gameId, player.lastReqTime, player.fleet, player.push, player.conn = False, 0, time.time(), None, False, None
+		if hasFleet: player.fleet, offset = Fleet.PackedFleet.unpack(data, offset)
+		return player, offset
 class Request:
-	conn: socket.socket
-	playerId: int
-	command: COM
-	payload: dict
-	stayConnected: bool = True
-	gameEndMsg: str = ''
+	__slots__ = ('conn', 'playerId', 'command', 'payload', 'reqId', 'codec', 'stayConnected', 'gameEndMsg', 'timeParsed', 'payloadError', 'batched')
+	def __init__(self, conn: socket.socket, playerId: int, command: COM, payload: dict, reqId: int=0, codec: str=ConnectionPrimitives.CODEC_JSON, stayConnected: bool=True,
+			gameEndMsg: str='', timeParsed: float=0., payloadError: Optional[Schemas.PayloadError]=None, batched: Optional[list['Request']]=None):
+		self.conn = conn
+		self.playerId = playerId
+		self.command = command
+		self.payload = payload
+		self.reqId = reqId
+		self.codec = codec # NOTE responses are sent in the codec of the request
+		self.stayConnected = stayConnected
+		self.gameEndMsg = gameEndMsg
+		self.timeParsed = timeParsed # NOTE perf_counter when the request was received whole
+		self.payloadError = payloadError # NOTE checked by the I/O stage against Schemas.REQUESTS
+		self.batched = batched # NOTE the requests of a valid COM.BATCH
+	def replace(self, **changes) -> 'Request':
+		'''@return a copy of the request with the attributes in changes replaced'''
+		req = object.__new__(Request)
+		for name in Request.__slots__: setattr(req, name, changes[name] if name in changes else getattr(self, name))
+		return req
 
 	def setNotStayConnected(self, msg):
 		self.stayConnected = False
 		self.gameEndMsg = msg
 
 class BlockingRequest(Request):
+	__slots__ = ('player', 'timeRecvd', 'defaultResponse')
 	player: ConnectedPlayer
 	timeRecvd: float
 	defaultResponse: dict
 
 	def __init__(self, req: Request, player: ConnectedPlayer, timeRecvd: float, defaultResponse: dict):
-		super().__init__(req.conn, req.playerId, req.command, req.payload, req.stayConnected)
+		super().__init__(req.conn, req.playerId, req.command, req.payload, req.reqId, req.codec, req.stayConnected)
 		self.player = player
 		self.timeRecvd = timeRecvd
 		self.defaultResponse = defaultResponse
 
+class ClientConnection:
+	'''one persistent client connection of the threaded engine, with its partially received data
+	and the responses not yet sent - both are processed only by the I/O stage'''
+	__slots__ = ('sock', 'addr', 'server', 'inBuffer', 'outBuffer', 'waitingWritable', 'closed', 'key', '__weakref__')
+	def __init__(self, sock: socket.socket, addr, server: 'Server'):
+		self.sock = sock
+		self.addr = addr
+		self.server = server
+		self.inBuffer = ConnectionPrimitives.MessageBuffer()
+		self.outBuffer = bytearray() # NOTE guarded by server.outLock
+		self.waitingWritable = False
+		self.closed = False
+		self.key = next(CONN_KEYS) # NOTE names the connection to the workers of the sharded engine
+	def sendall(self, data):
+		'''queues the data, never blocks the calling thread'''
+		self.server.queueOutput(self, data)
+	def getpeername(self):
+		return self.addr
+	def close(self):
+		self.sock.close()
+
+class BatchConnection:
+	'''collects the responses sent while a COM.BATCH is handled, so they leave in one write,
+	after flush() it passes everything through, for the batched blocking requests answered later'''
+	def __init__(self, conn):
+		self.conn = conn
+		self.chunks: Optional[list[bytes]] = []
+	def sendall(self, data):
+		if self.chunks is None: return self.conn.sendall(data)
+		self.chunks.append(data)
+	def flush(self):
+		chunks, self.chunks = self.chunks, None
+		if chunks: self.conn.sendall(b''.join(chunks))
+	def getpeername(self):
+		return self.conn.getpeername()
+
 # error helpers -------------------------------------------
+def commandLabel(command) -> tuple[str, str]:
+	'''metrics label of the command, unknown commands share one so they can't make up new labels'''
+	command = getattr(command, 'value', command)
+	return ('command', command if command in COM_VALUES else 'unknown')
 class PlayerDisconnectIssued(AssertionError):
 	'''Raised on sending a response without stayConnected=False to demand player disconnect'''
 	pass
 def sendErrorResponse(req: Request, error: str, obj=None): # NOTE doesn't accept BlockingRequest
 	obj = '' if obj is None else str(obj)
 	payload = {'error': error, 'error_obj': obj, 'stay_connected': False}
-	ConnectionPrimitives.send(req.conn, req.playerId, COM.ERROR, payload)
-	req.conn.close()
+	try:
+		ConnectionPrimitives.send(req.conn, req.playerId, COM.ERROR, payload, req.reqId, req.codec)
+	except (OSError, BinaryCodec.EncodeError) as e:
+		logging.warning('could not send error response to player %d: %s', req.playerId, e)
 def asert(cond, req, msg, obj=None):
+	'''on false @cond responds with COM.ERROR and raises PlayerDisconnectIssued'''
 	if cond: return
-	caller = inspect.getframeinfo(inspect.stack()[1][0])
 	log = f"{msg}: '{str(obj)}'" if obj is not None else msg
-	logging.error(f"{os.path.basename(caller.filename)}:{caller.lineno} ASSERTION FAILED: ID{req.playerId} {log}")
+	logging.error('ASSERTION FAILED: ID%d %s %s', req.playerId, req.command, log, stacklevel=2) # NOTE the record names the caller
 	sendErrorResponse(req, msg, obj)
 	raise PlayerDisconnectIssued(log)
 
 # impl classes ----------------------------------------------------------
 class Game:
+	__slots__ = ('id', 'gameActive', 'gameStage', 'players', 'playerOnTurn', 'shottedPos', 'firstMover', 'shootingStarted', 'lastShotTime', 'history')
 	def __init__(self, id, player1: ConnectedPlayer, player2: ConnectedPlayer, bothPaired: bool):
 		self.id: int = id
 		self.gameActive: bool = True
 		self.gameStage: int = STAGES.PLACING if bothPaired else STAGES.PAIRING
-		self.players: dict[int, ConnectedPlayer] = {player1.id: player1, player2.id: player2}
+		self.players: tuple[ConnectedPlayer, ConnectedPlayer] = (player1, player2)
+		self.setPlayersForGame()
 		self.repeatableInit()
 	def repeatableInit(self):
 		self.playerOnTurn: int = 0
 		self.shottedPos = [-1, -1]
-		self.setPlayersForGame()
+		self.firstMover = 0 # NOTE index of the player who shot first
+		self.shootingStarted = self.lastShotTime = 0.
+		self.history: Optional[bytearray] = None # NOTE the shots as Replays.SHOT records since recordShots(), lost by a recovery from the journal
 	def setPlayersForGame(self):
-		for p in self.players.values():
+		for p in self.players:
 			p.inGame = True
 			p.gameId = self.id
-			p.gameState = {'ready': False}
+			p.ready, p.fleet = False, None
 			p.awaitingRematch = False
+			p.lastShot = [-1, -1]
 
 	def updateGameState(self, player: ConnectedPlayer, state):
-		# TODO: validation of the game state?
-		player.gameState = state
+		player.ready = state['ready']
+		player.fleet = Fleet.PackedFleet(state['ships'])
 	def getOpponentState(self, player):
-		return self.getOpponent(player).gameState
+		return self.getOpponent(player).gameState()
 
 	def getOpponent(self, player: ConnectedPlayer) -> ConnectedPlayer:
-		return [p for p in self.players.values() if p.id != player.id][0]
+		return self.players[self.players[0].id == player.id]
 	def swapTurn(self):
-		l = list(self.players.keys())
-		l.remove(self.playerOnTurn)
-		self.playerOnTurn = l[0]
+		self.playerOnTurn = self.players[self.players[0].id == self.playerOnTurn].id
 		self.shottedPos = [-1, -1]
 
 	def canBeEnded(self):
-		return not (self.gameActive or any([p.connected for p in self.players.values()]))
+		return not (self.gameActive or any([p.connected for p in self.players]))
 	def playerDisconnect(self, player: ConnectedPlayer):
 		player.disconnect()
 		self.gameActive = False
@@ -119,11 +221,16 @@ class Game:
 			return True
 		return False
 	def canStartShooting(self):
-		return self.gameStage == STAGES.PLACING and all([p.shootingReady() for p in self.players.values()])
+		return self.gameStage == STAGES.PLACING and all([p.shootingReady() for p in self.players])
 	def startShooting(self):
-		logging.info(f'starting shooting game id {self.id}')
+		logging.info('starting shooting game id %d', self.id)
 		self.gameStage = STAGES.SHOOTING
-		self.playerOnTurn = random.choice(list(self.players.keys()))
+		self.firstMover = random.randrange(2)
+		self.playerOnTurn = self.players[self.firstMover].id
+	def recordShots(self):
+		'''keeps the shots for the replay of the game from now on'''
+		self.shootingStarted = self.lastShotTime = time.time()
+		self.history = bytearray()
 	def opponentShottedReq(self, player: ConnectedPlayer) -> tuple[list[int], bool]:
 		'''request called when responding to COM.OPPONENT_SHOT
 		@return (list[int] - where opponent shotted, bool - if you lost'''
@@ -132,116 +239,301 @@ class Game:
 		return pos, self.gameStage == STAGES.GAME_END
 	def didOpponentShoot(self, player) -> bool:
 		return self.shottedPos != [-1, -1] and player.id != self.playerOnTurn
+	def wasShotDelivered(self, player) -> bool:
+		'''the last shot of the opponent was already delivered to @player, who has the turn now'''
+		return self.getOpponent(player).lastShot != [-1, -1] and player.id == self.playerOnTurn and self.shottedPos == [-1, -1]
 	def shoot(self, player, pos) -> tuple[bool, dict, bool]:
 		'''@player - player who shotted
 		@pos - (x, y) pos where did he shoot
 		@return (bool - hitted, dict - sunken ship hitted if any, bool - game won)'''
 		self.shottedPos = pos
-		for ship in self.getOpponentState(player)['ships']:
-			x, y = ship['pos']
-			horizontal = ship['horizontal']
-			size = ship['size']
-			if (x <= pos[0] <= x + (size - 1) * horizontal) and (y <= pos[1] <= y + (size - 1) * (not horizontal)):
-				hittedSpot = (pos[0] - x) if horizontal else (pos[1] - y)
-				ship['hitted'][hittedSpot] = True
-				sunkenShip = ship if all(ship['hitted']) else None
-				gameWon = all([all(ship['hitted']) for ship in self.getOpponentState(player)['ships']])
-				return True, sunkenShip, gameWon
-		return False, None, False
+		player.lastShot = list(pos)
+		if self.history is not None:
+			now = time.time()
+			self.history += SHOT.pack(pos[1] * Fleet.GRID_WIDTH + pos[0], min(int(1000 * (now - self.lastShotTime)), 0xffff))
+			self.lastShotTime = now
+		return self.shotResult(player, pos)
+	def shotResult(self, player, pos) -> tuple[bool, dict, bool]:
+		'''the result of the shot as returned by shoot(), marking an already hitted segment again changes nothing'''
+		fleet = self.getOpponent(player).fleet
+		hitted, sunkenShip, gameWon = fleet.shoot(*pos)
+		return hitted, None if sunkenShip is None else fleet.shipDict(sunkenShip), gameWon
 	def canRematch(self):
-		numWaiting = sum([p.awaitingRematch for p in self.players.values()])
+		numWaiting = sum([p.awaitingRematch for p in self.players])
 		return self.gameActive and ((self.gameStage == STAGES.GAME_END and numWaiting == 2) or (self.gameStage == STAGES.PAIRING and numWaiting >= 1))
 	def rematch(self, player: ConnectedPlayer):
+		if self.gameStage == STAGES.GAME_END: self.playerOnTurn, self.shottedPos = 0, [-1, -1] # NOTE the winner mustn't stay on turn with no fleet to shoot at
 		self.gameStage = STAGES.PAIRING
 		player.awaitingRematch = False
-		if all([not p.awaitingRematch for p in self.players.values()]):
+		player.ready, player.fleet = False, None # NOTE reset now, the player may get ready before the opponent rematches
+		player.lastShot = [-1, -1]
+		if all([not p.awaitingRematch for p in self.players]):
 			self.gameStage = STAGES.PLACING
 			self.repeatableInit()
-			logging.info(f'Rematched game id {self.id}')
+			logging.info('Rematched game id %d', self.id)
+	def pack(self) -> bytes:
+		'''@return the game with both its players as kept in the server journal'''
+		head = GAME_RECORD.pack(self.id, self.players[0].id, self.players[1].id, self.gameActive, self.gameStage, self.playerOnTurn, *self.shottedPos)
+		return head + self.players[0].pack() + self.players[1].pack()
+	@classmethod
+	def unpack(cls, data: bytes) -> 'Game':
+		game = cls.__new__(cls)
+		game.id, _, _, game.gameActive, stage, game.playerOnTurn, x, y = GAME_RECORD.unpack_from(data)
+		game.gameStage = STAGE_VALUES[stage]
+		game.shottedPos = [x, y]
+		game.firstMover, game.shootingStarted, game.lastShotTime, game.history = 0, 0., 0., None
+		player1, offset = ConnectedPlayer.unpack(data, GAME_RECORD.size)
+		player2, offset = ConnectedPlayer.unpack(data, offset)
+		game.players = (player1, player2)
+		for p in game.players: p.inGame, p.gameId = True, game.id
+		return game
 
 class Server:
-	def __init__(self, addr):
-		self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.serverSocket.bind(addr)
-		self.serverSocket.settimeout(1.0)
-		self.serverSocket.listen()
+	'''the threaded engine - all I/O on Thread-Accept, all game logic on Thread-WaitingReqs'''
+	def __init__(self, addr, replays: Optional[str]=None):
+		self.serverSocket = self.openSocket(addr)
+		self.replays = None if replays is None else ReplayWriter(replays) # NOTE records the finished games to this directory
 
 		self.players: dict[int, ConnectedPlayer] = dict()
 		self.games: dict[int, Game] = dict()
 
 		self.waitingReqs: queue.Queue[Request] = queue.Queue()
 		self.blockingReqs: dict[int, BlockingRequest] = {}
+		# NOTE housekeeping state, touched only by the game logic
+		self.deadlines = DeadlineScheduler() # NOTE keys ('player', id) for inactivity, ('blocking', id) for blocking reqs
+		self.gamesToNotify: set[int] = set() # NOTE inactive games whose blocking reqs still need the default response
+		self.endableGames: set[int] = set()
+		self.matchmaking = MatchmakingQueue()
+		self.metrics = Metrics()
+		self.connections: set[ClientConnection] = set()
 		self.closeEvent = threading.Event()
-
+		self.startEngine()
+	def openSocket(self, addr) -> socket.socket:
+		serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		serverSocket.bind(addr)
+		serverSocket.settimeout(1.0)
+		serverSocket.listen()
+		return serverSocket
+	def startEngine(self):
+		self.serverSocket.setblocking(False)
+		self.selector = selectors.DefaultSelector()
+		self.wakeupRecv, self.wakeupSend = socket.socketpair() # NOTE wakes the I/O stage when there is new output
+		self.wakeupRecv.setblocking(False)
+		self.wakeupSend.setblocking(False)
+		self.outLock = threading.Lock()
+		self.connsToFlush: list[ClientConnection] = []
+		self.bufferedBytes = 0
+		self.peakBufferedBytes = 0
+		self.droppedConnections = 0
 		self.acceptThread = threading.Thread(target=lambda: runFuncLogged(self.acceptLoop), daemon=True, name='Thread-Accept')
 		self.acceptThread.start()
 		self.waitingReqsThread = threading.Thread(target=lambda: runFuncLogged(self.waitingReqsHandler), daemon=True, name='Thread-WaitingReqs')
 		self.waitingReqsThread.start()
+	def engineAlive(self) -> bool:
+		return self.acceptThread.is_alive() and self.waitingReqsThread.is_alive()
 	def close(self, closeNow=False):
 		self.closeEvent.set()
 		if not closeNow:
 			self.acceptThread.join()
 			self.waitingReqsThread.join()
 		self.serverSocket.close()
+		for conn in list(self.connections):
+			conn.close()
+		self.wakeupRecv.close()
+		self.wakeupSend.close()
+		if self.replays is not None: self.replays.close()
+	def renderMetrics(self) -> str:
+		'''called from the metrics endpoint thread, so it only copies the state it reads'''
+		gauges = {('waiting_reqs', ()): self.waitingReqs.qsize(), ('connections', ()): len(self.connections), **self.stateGauges()}
+		gauges.update(self.engineGauges())
+		return self.metrics.render(gauges)
+	def stateGauges(self) -> dict:
+		'''the players, games and blocking requests kept by the game logic'''
+		blocking = {}
+		for req in list(self.blockingReqs.values()):
+			label = commandLabel(req.command)
+			blocking[('blocking_reqs', label)] = blocking.get(('blocking_reqs', label), 0) + 1
+		return {('players', ()): len(self.players), ('games', ()): len(self.games), ('active_games', ()): sum(game.gameActive for game in list(self.games.values())),
+			('push_players', ()): sum(player.push for player in list(self.players.values())), **blocking}
+	def engineGauges(self) -> dict:
+		return {('send_buffer_bytes', ()): self.bufferedBytes, ('send_buffer_peak_bytes', ()): self.peakBufferedBytes, ('dropped_connections', ()): self.droppedConnections}
+	def shouldRun(self) -> bool:
+		'''on close the server keeps running until all players get the closing response'''
+		return not self.closeEvent.is_set() or self.players or self.blockingReqs
 
 	def unknownIdReq(self, req: Request):
 		if req.command == COM.CONNECT:
 			player = self.newConnectedPlayer(req.payload['name'])
 			self.players[player.id] = player
-			logging.info(f"connecting new player from {req.conn.getpeername()} as {player.id}, name '{req.payload['name']}'")
+			self.matchmaking.add(player)
+			self.deadlines.schedule(('player', player.id), player.lastReqTime + MAX_TIME_FOR_DISCONNECT)
+			codec = ConnectionPrimitives.chooseCodec(req.payload.get('codecs', []), '--json-codec' in sys.argv)
+			player.push, player.conn, player.codec = req.payload.get('push', False), req.conn, codec
+			logging.info("connecting new player from %s as %d, name '%s', codec %s, push %s", req.conn.getpeername(), player.id, req.payload['name'], codec, player.push)
 			req.playerId = player.id
-			self._sendResponse(req, {'id': player.id})
+			self._sendResponse(req, {'id': player.id, 'codec': codec, 'push': player.push})
 		else:
 			asert(False, req, 'unknown player id', req.playerId)
 
+	def resumePlayer(self, player: ConnectedPlayer, req: Request):
+		'''COM.CONNECT with the id of a known player continues his session on the new connection,
+		after his connection was lost or the server recovered him from its journal'''
+		codec = ConnectionPrimitives.chooseCodec(req.payload.get('codecs', []), '--json-codec' in sys.argv)
+		player.push, player.conn, player.codec = req.payload.get('push', False), req.conn, codec
+		logging.info('resuming player %d from %s, codec %s, push %s', player.id, req.conn.getpeername(), codec, player.push)
+		self._sendResponse(req, {'id': player.id, 'codec': codec, 'push': player.push, 'resumed': True})
+
 	def dispatchRequest(self, req: Request):
+		self.updateLastReqTime(req)
+		self.waitingReqs.put(req)
+	def updateLastReqTime(self, req: Request):
 		if req.playerId in self.players:
 			player = self.players[req.playerId]
 			player.lastReqTime = time.time()
-		self.waitingReqs.put(req)
 
 	def acceptLoop(self):
-		while not self.closeEvent.is_set() or self.players:
+		'''the I/O stage - accepts connections, reads whatever is available on any of them
+		and writes the queued responses once the sockets become writable,
+		only whole requests get dispatched, so a slow client can't stall the others'''
+		self.selector.register(self.serverSocket, selectors.EVENT_READ)
+		self.selector.register(self.wakeupRecv, selectors.EVENT_READ)
+		while self.shouldRun():
+			for key, events in self.selector.select(timeout=1.):
+				if key.fileobj is self.serverSocket: self.acceptConnections()
+				elif key.fileobj is self.wakeupRecv: self.handleQueuedOutput()
+				elif callable(key.data): key.data() # NOTE other readable sources of the subclasses
+				elif key.data.closed: continue # NOTE closed while handling an earlier key of this batch
+				else:
+					if events & selectors.EVENT_WRITE: self.flushConnection(key.data)
+					if events & selectors.EVENT_READ: self.readConnection(key.data)
+		self.handleQueuedOutput()
+		for conn in list(self.connections): self.flushConnection(conn, blocking=True)
+		self.selector.close()
+	def acceptConnections(self):
+		while True:
 			try:
-				conn, addr = self.serverSocket.accept()
-				req = self._recvReq(conn)
-				self.dispatchRequest(req)
-			except socket.timeout:
-				pass
-			finally:
-				self.checkConnections()
-				self.checkGames()
-
+				sock, addr = self.serverSocket.accept()
+			except BlockingIOError:
+				return
+			sock.setblocking(False)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # NOTE a pushed event mustn't wait for the ack of the previous message
+			conn = ClientConnection(sock, addr, self)
+			self.connections.add(conn)
+			self.selector.register(sock, selectors.EVENT_READ, conn)
+	def readConnection(self, conn: 'ClientConnection'):
+		try:
+			data = conn.sock.recv(RECV_SIZE)
+			if not data: raise ConnectionPrimitives.ConnectionClosed('connection closed by the client')
+			for body in conn.inBuffer.feed(data):
+				self.dispatchRequest(self._parseReq(conn, body))
+		except BlockingIOError:
+			pass
+		except (ConnectionError, OSError, ValueError, BinaryCodec.DecodeError) as e:
+			if not isinstance(e, ConnectionPrimitives.ConnectionClosed): logging.warning('closing connection %s: %r', conn.addr, e)
+			self.closeConnection(conn)
+	def closeConnection(self, conn: 'ClientConnection'):
+		self.connections.discard(conn)
+		with self.outLock:
+			conn.closed = True
+			self.bufferedBytes -= len(conn.outBuffer)
+			conn.outBuffer.clear()
+		try:
+			self.selector.unregister(conn.sock)
+		except (KeyError, ValueError):
+			pass
+		conn.close()
 
-	def checkGames(self):
-		for game in list(self.games.values()):
-			if game.canBeEnded():
-				self.endGame(game)
+	# outbound ---------------------------------------
+	def queueOutput(self, conn: ClientConnection, data: bytes):
+		'''appends data to the send buffer of conn and lets the I/O stage send it,
+		when the backlog exceeds MAX_SEND_BACKLOG the client gets dropped'''
+		with self.outLock:
+			if conn.closed: raise ConnectionResetError('connection closed')
+			dropped = len(conn.outBuffer) + len(data) > MAX_SEND_BACKLOG
+			if dropped:
+				conn.closed = True
+				self.droppedConnections += 1
+				self.connsToFlush.append(conn)
+				logging.warning('dropping connection %s, send backlog of %d bytes exceeded', conn.addr, len(conn.outBuffer))
+			else:
+				if not conn.outBuffer: self.connsToFlush.append(conn)
+				conn.outBuffer += data
+				self.bufferedBytes += len(data)
+				self.peakBufferedBytes = max(self.peakBufferedBytes, self.bufferedBytes)
+		try:
+			self.wakeupSend.send(b'\0')
+		except BlockingIOError:
+			pass # NOTE the I/O stage will wake up anyway
+		if dropped: raise ConnectionResetError('send backlog exceeded')
+	def handleQueuedOutput(self):
+		try:
+			while self.wakeupRecv.recv(RECV_SIZE): pass
+		except BlockingIOError:
+			pass
+		with self.outLock:
+			conns, self.connsToFlush = self.connsToFlush, []
+		for conn in conns:
+			if conn.closed: self.closeConnection(conn)
+			else: self.flushConnection(conn)
+	def flushConnection(self, conn: ClientConnection, blocking=False):
+		'''sends as much of the buffered data as the socket accepts, the rest waits until it becomes writable'''
+		with self.outLock:
+			if conn.closed: return # NOTE dropped or closed earlier in the same select() batch, its socket is gone
+			try:
+				if blocking:
+					conn.sock.settimeout(MAX_TIME_FOR_SEND)
+					conn.sock.sendall(conn.outBuffer)
+					sent = len(conn.outBuffer)
+				else: sent = conn.sock.send(conn.outBuffer)
+			except BlockingIOError:
+				sent = 0
+			except OSError:
+				sent = len(conn.outBuffer) # NOTE the connection is lost, reading from it closes it
+			del conn.outBuffer[:sent]
+			self.bufferedBytes -= sent
+			needsWrite = bool(conn.outBuffer)
+		if needsWrite != conn.waitingWritable and not blocking:
+			conn.waitingWritable = needsWrite
+			self.selector.modify(conn.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE * needsWrite), conn)
 
 	def waitingReqsHandler(self):
-		while not self.closeEvent.is_set() or self.players or self.blockingReqs:
+		while self.shouldRun():
 			try:
-				req  = self.waitingReqs.get(timeout=1.)
-				self.handleIncomingReq(req)
+				req  = self.waitingReqs.get(timeout=self.housekeepingTimeout())
+				self.handleReq(req)
 			except queue.Empty:
 				pass
-			except PlayerDisconnectIssued:
-				self.disconnectPlayer(req.playerId)
 			finally:
-				self.checkWaitingReqs()
+				self.housekeeping()
+	def handleReq(self, req: Request):
+		try:
+			self.handleIncomingReq(req)
+		except PlayerDisconnectIssued:
+			self.disconnectPlayer(req.playerId)
+		except AssertionError as e: # NOTE a broken invariant ends only the session of the player whose request hit it
+			logging.exception('assertion failed handling %s of player %d', req.command, req.playerId)
+			sendErrorResponse(req, 'internal error', e)
+			self.disconnectPlayer(req.playerId)
+		finally:
+			self.metrics.observe('request_seconds', commandLabel(req.command), time.perf_counter() - req.timeParsed)
 	def handleIncomingReq(self, req: Request):
+		asert(req.payloadError is None, req, 'invalid payload', req.payloadError)
+		if req.command == COM.BATCH:
+			return self.handleBatch(req)
 		if req.playerId not in self.players:
 			return self.unknownIdReq(req)
 
 		player = self.players[req.playerId]
 		asert(player.connected, req, 'player marked as disconnected')
 		if player.id in self.blockingReqs:
-			logging.debug(f'Responding with default due to another req from {player.id}')
+			logging.debug('Responding with default due to another req from %d', player.id)
 			self.respondBlockingReq(player, useDefault=True, disconnect=False)
 
 		if req.command == COM.DISCONNECT:
 			req.setNotStayConnected('You disconnected!')
 			self._sendResponse(req)
+		elif req.command == COM.CONNECT:
+			self.resumePlayer(player, req)
 		elif req.command == COM.PAIR:
 			self.pairPlayer(player, req)
 		elif req.command == COM.CONNECTION_CHECK:
@@ -269,33 +561,79 @@ class Server:
 			else:
 				asert(False, req, 'unknown command', req.command)
 
-	def checkConnections(self):
-		for player in list(self.players.values()):
-			if time.time() - player.lastReqTime > MAX_TIME_FOR_DISCONNECT and player.connected:
-				logging.warning(f'disconnecting player {player.id} due to not receiving requests')
-				if player.id in self.blockingReqs:
-					self.blockingReqs[player.id].setNotStayConnected('Connection timed out')
-					self.respondBlockingReq(player, useDefault=True)
-				else: self.disconnectPlayer(player.id)
+	def handleBatch(self, batch: Request):
+		'''handles the batched requests in order until one of them disconnects the player'''
+		try:
+			for req in batch.batched:
+				self.handleReq(req)
+				if (player := self.players.get(batch.playerId)) is None or not player.connected: break
+		finally:
+			try:
+				batch.conn.flush()
+			except OSError as e:
+				logging.warning('could not send batched responses to player %d: %s', batch.playerId, e)
+
+	# housekeeping -------------------------------------
+	def housekeeping(self):
+		'''handles only what expired or changed since the last call, not every player and game'''
+		now = time.time()
+		for kind, playerId in self.deadlines.popExpired(now):
+			if kind == 'blocking': self.blockingReqTimeout(playerId)
+			else: self.checkConnection(playerId, now)
+		self.checkWaitingReqs()
+		self.checkGames()
+	def housekeepingTimeout(self) -> float:
+		'''how long the game logic can wait for requests before the next deadline'''
+		deadline = self.deadlines.nextDeadline()
+		return 1. if deadline is None else min(1., max(0., deadline - time.time()))
+	def checkConnection(self, playerId: int, now: float):
+		'''called once the inactivity deadline of the player passes, the deadline is only moved when it expires
+		so the requests themselves don't touch the scheduler'''
+		if playerId not in self.players or not (player := self.players[playerId]).connected: return
+		if player.push and not player.conn.closed: player.lastReqTime = now # NOTE a subscribed player doesn't poll, its open connection keeps it alive
+		if now - player.lastReqTime <= MAX_TIME_FOR_DISCONNECT:
+			return self.deadlines.schedule(('player', playerId), player.lastReqTime + MAX_TIME_FOR_DISCONNECT)
+		logging.warning('disconnecting player %d due to not receiving requests', player.id)
+		self.metrics.inc('inactivity_disconnects')
+		if player.id in self.blockingReqs:
+			self.blockingReqs[player.id].setNotStayConnected('Connection timed out')
+			self.respondBlockingReq(player, useDefault=True)
+		else: self.disconnectPlayer(player.id)
+	def checkGames(self):
+		while self.endableGames:
+			gameId = self.endableGames.pop()
+			if gameId in self.games: self.endGame(self.games[gameId])
 
 	def disconnectPlayer(self, playerId: int):
 		if playerId not in self.players: return
 		player = self.players[playerId]
 		if player.inGame:
 			game = self.games[player.gameId]
+			if game.gameActive and game.gameStage == STAGES.SHOOTING: self.recordReplay(game, NO_WINNER)
 			game.playerDisconnect(player)
+			self.gamesToNotify.add(game.id)
+			if game.canBeEnded(): self.endableGames.add(game.id)
 		else:
 			player.disconnect()
 			self.removePlayer(player)
 	def removePlayer(self, player: ConnectedPlayer):
 		assert player.id in self.players and not player.connected
 		self.players.pop(player.id)
+		self.matchmaking.remove(player)
+		self.deadlines.cancel(('player', player.id))
 	def removeGame(self, game: Game):
 		assert game.id in self.games and game.canBeEnded()
 		self.games.pop(game.id)
+	def recordReplay(self, game: Game, winner: int):
+		'''@winner - index of the player who won or Replays.NO_WINNER, a game recovered from the journal while shooting isn't recorded'''
+		if self.replays is None or game.history is None: return
+		ships = tuple(p.fleet.ships for p in game.players)
+		self.replays.record(packReplay(game.id, (game.players[0].id, game.players[1].id), game.shootingStarted, time.time() - game.shootingStarted, game.firstMover, winner, ships, game.history))
+		game.history = None
+		self.metrics.inc('recorded_replays')
 	def endGame(self, game: Game):
-		logging.info(f'ending game id {game.id}')
-		for p in game.players.values():
+		logging.info('ending game id %d', game.id)
+		for p in game.players:
 			self.removePlayer(p)
 		self.removeGame(game)
 
@@ -303,8 +641,11 @@ class Server:
 	def addBlockingReq(self, player: ConnectedPlayer, req: Request, defaultResponse: dict):
 		'''adds to blockingReqs for player, the defaults are sent back if the request times out or the same player sends another req'''
 		assert player.id not in self.blockingReqs, 'only one blocking req per player'
-		logging.debug(f'adding blocking request {req.command}')
+		logging.debug('adding blocking request %s', req.command)
 		self.blockingReqs[player.id] = BlockingRequest(req, player, time.time(), defaultResponse)
+		if not player.push: self.deadlines.schedule(('blocking', player.id), self.blockingReqs[player.id].timeRecvd + MAX_TIME_FOR_BLOCKING)
+		if req.command == COM.PAIR: self.matchmaking.setPolling(player, True)
+		if player.inGame and not self.games[player.gameId].gameActive: self.gamesToNotify.add(player.gameId)
 	def respondBlockingReq(self, player: ConnectedPlayer, payload: dict={}, *, useDefault=False, disconnect=None):
 		'''
 		sends response for blocking req for this player
@@ -312,38 +653,35 @@ class Server:
 		@disconnect: disconnect on PlayerDisconnectIssued from _sendResponse()?, when None 'useDefault' is used
 		'''
 		req = self.blockingReqs.pop(player.id)
+		self.deadlines.cancel(('blocking', player.id))
+		self.metrics.observe('blocking_seconds', commandLabel(req.command), time.time() - req.timeRecvd)
+		if req.command == COM.PAIR: self.matchmaking.setPolling(player, False)
 		try:
 			self._sendResponse(req, req.defaultResponse if useDefault else payload)
 		except PlayerDisconnectIssued:
 			if disconnect or (disconnect is None and useDefault): self.disconnectPlayer(player.id)
 			else: raise
 
-	def _isPlayerPairableWith(self, player: ConnectedPlayer, possibleOpponent: ConnectedPlayer):
-		return not possibleOpponent.inGame and possibleOpponent.id != player.id
 	def findOpponent(self, player: ConnectedPlayer) -> Optional[ConnectedPlayer]:
-		for req in self.blockingReqs.values(): # primarily try to find a opponent from the waiting reqs
-			if req.command == COM.PAIR and self._isPlayerPairableWith(player, req.player):
-				return req.player
-		possible = list(filter(lambda p: self._isPlayerPairableWith(player, p), self.players.values()))
-		if len(possible) == 0: return None
-		opponent = possible[0]
-		if opponent.id in self.blockingReqs: assert self.blockingReqs[opponent.id].req.command == COM.PAIR, 'if the opponent _isPairableWith then any blocking req must be a COM.PAIR'
-		return opponent
+		'''primarily pairs with a player waiting on COM.PAIR, then with anyone not in a game'''
+		return self.matchmaking.findOpponent(player)
 	def pairResPayload(self, opponent: ConnectedPlayer, rematched=False):
 		positiveOutcomeStr = 'rematched' if rematched else 'paired'
 		return {positiveOutcomeStr: True, 'opponent': {'id': opponent.id, 'name': opponent.name}}
 	def pairPlayer(self, player: ConnectedPlayer, req: Request):
 		if player.inGame:
 			game = self.games[player.gameId]
-			asert(game.gameStage == STAGES.PAIRING, req, 'Unexpected game stage for !PAIR', game.id)
+			asert(game.gameStage in (STAGES.PAIRING, STAGES.PLACING), req, 'Unexpected game stage for !PAIR', game.id) # NOTE PLACING when a resumed session asks again
 			game.gameStage = STAGES.PLACING
-			return self._sendResponse(req, self.pairResPayload(game.getOpponent(player)))
+			self._sendResponse(req, self.pairResPayload(opponent := game.getOpponent(player)))
+			if player.push and opponent.shootingReady(): self.pushEvent(player, COM.OPPONENT_READY, {'opponent_ready': True}, conn=req.conn)
+			return
 		opponent = self.findOpponent(player)
 		if opponent is None:
 			self.addBlockingReq(player, req, {'paired': False})
 		else:
 			bothPaired = False
-			if opponent.id in self.blockingReqs:
+			if opponent.id in self.blockingReqs and self.blockingReqs[opponent.id].command == COM.PAIR:
 				self.respondBlockingReq(opponent, self.pairResPayload(player))
 				bothPaired = True
 			self.addNewGame(player, opponent, bothPaired)
@@ -353,15 +691,28 @@ class Server:
 			return self._sendResponse(req, {'opponent_ready': ready})
 		self.addBlockingReq(player, req, {'opponent_ready': ready})
 	def handleGameReadiness(self, player: ConnectedPlayer, game: Game, req: Request):
+		if game.gameStage not in (STAGES.PAIRING, STAGES.PLACING): # NOTE the fleet is fixed once shooting, a new one would wipe its hits
+			repeated = req.payload['ready'] and player.ready and player.fleet is not None and Fleet.PackedFleet(req.payload['ships']).ships == player.fleet.ships # NOTE a resumed session asks again for the response it lost
+			asert(repeated or not req.payload['ready'], req, 'Unexpected !GAME_READINESS in gameStage', game.gameStage)
+			return self._sendResponse(req, {'approved': repeated, 'opponent_ready': game.getOpponent(player).shootingReady()}) # NOTE unreadying is refused, the game already started
+		if req.payload['ready']:
+			asert((error := Fleet.validateFleet(req.payload.get('ships'))) is None, req, 'invalid fleet', error)
+		placing = game.gameStage == STAGES.PLACING
 		approved = game.gameReadiness(player, req.payload)
+		started = placing and game.gameStage == STAGES.SHOOTING
+		if started and self.replays is not None: game.recordShots()
 		opponent = game.getOpponent(player)
 		self._sendResponse(req, {'approved': approved, 'opponent_ready': opponent.shootingReady()})
-		if opponent.id not in self.blockingReqs: return
-		if game.gameStage == STAGES.PLACING:
-			assert self.blockingReqs[opponent.id].command == COM.OPPONENT_READY
+		if started and player.push: self.pushEvent(player, COM.GAME_WAIT, {'started': True, 'on_turn': game.playerOnTurn}, conn=req.conn)
+		if opponent.push:
+			if game.gameStage == STAGES.PLACING: self.pushEvent(opponent, COM.OPPONENT_READY, {'opponent_ready': req.payload['ready']})
+			elif started: self.pushEvent(opponent, COM.GAME_WAIT, {'started': True, 'on_turn': game.playerOnTurn})
+			return
+		if opponent.id not in self.blockingReqs: return # NOTE another blocking request of the opponent stays, he learns on his next poll
+		waiting = self.blockingReqs[opponent.id].command
+		if game.gameStage == STAGES.PLACING and waiting == COM.OPPONENT_READY:
 			self.respondBlockingReq(opponent, {'opponent_ready': req.payload['ready']})
-		elif game.gameStage == STAGES.SHOOTING:
-			assert self.blockingReqs[opponent.id].command == COM.GAME_WAIT
+		elif game.gameStage == STAGES.SHOOTING and waiting == COM.GAME_WAIT:
 			self.respondBlockingReq(opponent, {'started': True, 'on_turn': game.playerOnTurn})
 	def handleGameWait(self, player: ConnectedPlayer, game: Game, req: Request):
 		asert(player.shootingReady(), req, 'Unexpected !GAME_WAIT from unready player', player.id)
@@ -373,31 +724,42 @@ class Server:
 		payload['opponent_grid'] = game.getOpponentState(player)
 		payload['game_end_msg'] = ('You lost!   :(', 'You won!   :)')[won]
 	def shootReq(self, player: ConnectedPlayer, game: Game, req: Request):
-		asert(player.id == game.playerOnTurn, req, 'only player on turn can shoot')
-		hitted, sunkenShip, gameWon = game.shoot(player, req.payload['pos'])
+		repeated = (player.id != game.playerOnTurn or game.gameStage == STAGES.GAME_END) and player.lastShot == req.payload['pos'] # NOTE a resumed session asks again for the result it lost
+		asert(game.gameStage == STAGES.SHOOTING or (repeated and game.gameStage == STAGES.GAME_END), req, 'Unexpected !SHOOT in gameStage', game.gameStage) # NOTE the fleets are gone once rematching
+		asert(repeated or player.id == game.playerOnTurn, req, 'only player on turn can shoot')
+		hitted, sunkenShip, gameWon = (game.shotResult if repeated else game.shoot)(player, req.payload['pos'])
 		if '--instant-win' in sys.argv: gameWon = True
 		payload = {'hitted': hitted, 'sunken_ship': sunkenShip, 'game_won': gameWon}
 		if gameWon:
 			game.gameStage = STAGES.GAME_END
 			self.updateGameEndPayload(payload, player, game)
-			logging.info(f'Game {game.id} won {player.id}')
+			logging.info('Game %d won %d', game.id, player.id)
+			if not repeated: self.recordReplay(game, game.players.index(player))
+		if repeated: return self._sendResponse(req, payload)
 		opponent = game.getOpponent(player)
-		if opponent.id in self.blockingReqs:
-			blocking = self.blockingReqs[opponent.id]
-			assert blocking.command == COM.OPPONENT_SHOT
+		if opponent.push:
+			self.sendOpponentShottedRes(opponent, game, None)
+		elif opponent.id in self.blockingReqs and (blocking := self.blockingReqs[opponent.id]).command == COM.OPPONENT_SHOT:
 			self.sendOpponentShottedRes(opponent, game, blocking)
 		self._sendResponse(req, payload)
 	def opponentShotted(self, player: ConnectedPlayer, game: Game, req: Request):
 		if game.didOpponentShoot(player):
 			self.sendOpponentShottedRes(player, game, req)
+		elif game.wasShotDelivered(player): # NOTE a resumed session asks again for the shot it lost
+			self._sendResponse(req, self.opponentShotPayload(player, game, list(game.getOpponent(player).lastShot), game.gameStage == STAGES.GAME_END))
 		else:
 			self.addBlockingReq(player, req, {'shotted': False})
-	def sendOpponentShottedRes(self, player: ConnectedPlayer, game: Game, req):
-		pos, lost = game.opponentShottedReq(player)
+	def opponentShotPayload(self, player: ConnectedPlayer, game: Game, pos: list[int], lost: bool) -> dict:
 		if '--instant-win' in sys.argv: lost = True
 		payload = {'shotted': True, 'pos': pos, 'lost': lost}
 		if lost: self.updateGameEndPayload(payload, player, game, won=False)
-		if isinstance(req, BlockingRequest):
+		return payload
+	def sendOpponentShottedRes(self, player: ConnectedPlayer, game: Game, req):
+		'''@req None pushes the shot'''
+		payload = self.opponentShotPayload(player, game, *game.opponentShottedReq(player))
+		if req is None:
+			self.pushEvent(player, COM.OPPONENT_SHOT, payload)
+		elif isinstance(req, BlockingRequest):
 			assert player.id in self.blockingReqs
 			self.respondBlockingReq(player, payload, disconnect=True)
 		else:
@@ -417,15 +779,20 @@ class Server:
 		else: self._sendResponse(req, {'approved': approved})
 		self.respondAwaitingAfterRematchUpdate(game.getOpponent(player), game, player.awaitingRematch)
 	def respondAwaitingAfterRematchUpdate(self, player: ConnectedPlayer, game: Game, updatedTo: bool):
-		if player.id not in self.blockingReqs: return
-		assert (req := self.blockingReqs[player.id]).command == COM.AWAIT_REMATCH
+		if player.push:
+			if game.canRematch(): self.handleRematchedReq(game, player, None, {'changed': True})
+			else: self.pushEvent(player, COM.AWAIT_REMATCH, {'changed': True, 'opponent_rematching': updatedTo})
+			return
+		if player.id not in self.blockingReqs or (req := self.blockingReqs[player.id]).command != COM.AWAIT_REMATCH: return
 		if game.canRematch():
 			self.handleRematchedReq(game, player, req, {'changed': True})
 		else:
 			self.respondBlockingReq(player, {'changed': True, 'opponent_rematching': updatedTo})
-	def handleRematchedReq(self, game: Game, player: ConnectedPlayer, req: Request, payload:dict):
+	def handleRematchedReq(self, game: Game, player: ConnectedPlayer, req: Optional[Request], payload:dict):
+		'''@req None pushes the rematch'''
 		payload.update(self.pairResPayload(game.getOpponent(player), rematched=True))
-		if isinstance(req, BlockingRequest): self.respondBlockingReq(player, payload)
+		if req is None: self.pushEvent(player, COM.AWAIT_REMATCH, payload)
+		elif isinstance(req, BlockingRequest): self.respondBlockingReq(player, payload)
 		else: self._sendResponse(req, payload)
 		game.rematch(player)
 
@@ -436,13 +803,28 @@ class Server:
 			req.setNotStayConnected('Opponent disconnected!   :|')
 			req.defaultResponse.update({'opponent_grid': game.getOpponentState(self.players[req.player.id])})
 		self.respondBlockingReq(req.player, useDefault=True)
+	def pushInactiveGame(self, game: Game, player: ConnectedPlayer):
+		'''the pushed counterpart of handleBlockingInInactiveGame'''
+		if game.gameStage == STAGES.GAME_END:
+			self.pushEvent(player, COM.AWAIT_REMATCH, {'changed': True, 'opponent_disconnected': True})
+		else:
+			self.pushEvent(player, COM.CONNECTION_CHECK, {'opponent_grid': game.getOpponentState(player)}, endMsg='Opponent disconnected!   :|')
+	def blockingReqTimeout(self, playerId: int):
+		if playerId in self.blockingReqs:
+			self.metrics.inc('blocking_timeouts', commandLabel(self.blockingReqs[playerId].command))
+			self.respondBlockingReq(self.blockingReqs[playerId].player, useDefault=True)
 	def checkWaitingReqs(self):
-		for req in list(self.blockingReqs.values()):
-			if time.time() - req.timeRecvd > MAX_TIME_FOR_BLOCKING or self.closeEvent.is_set():
+		if self.closeEvent.is_set():
+			for req in list(self.blockingReqs.values()):
 				self.respondBlockingReq(req.player, useDefault=True)
-			elif req.player.inGame:
-				game = self.games[req.player.gameId]
-				if not game.gameActive: self.handleBlockingInInactiveGame(game, req)
+			for player in [p for p in self.players.values() if p.push and p.connected]:
+				self.pushEvent(player, COM.CONNECTION_CHECK, {})
+		while self.gamesToNotify:
+			game = self.games.get(self.gamesToNotify.pop())
+			if game is None: continue
+			for player in game.players:
+				if player.id in self.blockingReqs: self.handleBlockingInInactiveGame(game, self.blockingReqs[player.id])
+				elif player.push and player.connected: self.pushInactiveGame(game, player)
 
 	def newConnectedPlayer(self, playerName):
 		id = self._generateNewID(self.players)
@@ -451,7 +833,10 @@ class Server:
 		id = self._generateNewID(self.games)
 		game = Game(id, player1, player2, bothPaired)
 		self.games[id] = game
-		logging.info(f'starting new game id {id}, players: {player1.id}, {player2.id}')
+		self.matchmaking.remove(player1)
+		self.matchmaking.remove(player2)
+		logging.info('starting new game id %d, players: %d, %d', id, player1.id, player2.id)
+		return game
 	def _generateNewID(self, dictOfIds):
 		bounds = (1000, 2**20)
 		id = random.randint(*bounds)
@@ -459,28 +844,704 @@ class Server:
 			id = random.randint(*bounds)
 		return id
 
-	def _recvReq(self, conn: socket.socket) -> Request:
-		id, command, payload = ConnectionPrimitives.recv(conn)
-		req = Request(conn, id, command, payload)
+	def _parseReq(self, conn, body: bytes) -> Request:
+		id, command, payload, reqId, codec = ConnectionPrimitives.decodeBody(body)
+		if not (isinstance(id, int) and isinstance(command, str) and isinstance(payload, dict) and isinstance(reqId, int)):
+			raise ValueError('malformed request')
+		ConnectionPrimitives.logReq('received', id, command, reqId, payload)
+		req = Request(conn, id, command, payload, reqId, codec, timeParsed=time.perf_counter(), payloadError=Schemas.validateRequest(command, payload))
+		if command == COM.BATCH and req.payloadError is None:
+			req.conn = BatchConnection(conn)
+			req.batched = [Request(req.conn, id, r['command'], r['payload'], r['req_id'], codec, timeParsed=req.timeParsed, payloadError=Schemas.validateBatched(r['command'], r['payload'])) for r in payload['reqs']]
 		return req
+	def pushEvent(self, player: ConnectedPlayer, command: COM, payload: dict, *, conn=None, endMsg=''):
+		'''sends a subscribed player what its blocking @command would be answered with, reqId 0 marks it as pushed
+		@conn connection of the request being handled, when pushing to its sender, so the push can't overtake the response'''
+		if not player.connected: return
+		event = Request(conn or player.conn, player.id, command, payload, 0, player.codec)
+		if endMsg: event.setNotStayConnected(endMsg)
+		self.metrics.inc('pushed_events', commandLabel(command))
+		try:
+			self._sendResponse(event, payload)
+		except PlayerDisconnectIssued:
+			self.disconnectPlayer(player.id)
 	def _sendResponse(self, req: Union[Request, BlockingRequest], payload: dict={}):
 		payload.update({'stay_connected': req.stayConnected and not self.closeEvent.is_set()})
 		if not payload['stay_connected']: payload.update({'game_end_msg': 'Server is closing!' if self.closeEvent.is_set() else req.gameEndMsg})
 		assert req.playerId != 0
-		ConnectionPrimitives.send(req.conn, req.playerId, req.command, payload)
-		req.conn.close()
+		try:
+			ConnectionPrimitives.send(req.conn, req.playerId, req.command, payload, req.reqId, req.codec)
+		except (OSError, BinaryCodec.EncodeError) as e: # NOTE an unencodable response mustn't kill the game logic stage
+			logging.warning('could not send response to player %d: %s', req.playerId, e)
 		if not payload['stay_connected']: raise PlayerDisconnectIssued(payload['game_end_msg'])
 
 
+class AsyncConnection:
+	'''socket-like adapter so the shared handlers can respond through an asyncio StreamWriter'''
+	__slots__ = ('writer',)
+	def __init__(self, writer: asyncio.StreamWriter):
+		self.writer = writer
+	def sendall(self, data):
+		if self.writer.is_closing(): raise ConnectionResetError('connection closed')
+		if self.writer.transport.get_write_buffer_size() + len(data) > MAX_SEND_BACKLOG:
+			logging.warning('dropping connection %s, send backlog exceeded', self.getpeername())
+			self.writer.transport.abort()
+			raise ConnectionResetError('send backlog exceeded')
+		self.writer.write(data) # NOTE doesn't block, the transport buffers the data
+	@property
+	def closed(self) -> bool:
+		return self.writer.is_closing()
+	def getpeername(self):
+		return self.writer.get_extra_info('peername')
+	def close(self):
+		self.writer.close()
+
+class AsyncServer(Server):
+	'''the asyncio engine - one event loop runs both the I/O and the same handlers as the threaded engine'''
+	def startEngine(self):
+		self.serverSocket.setblocking(False)
+		self.loop = asyncio.new_event_loop()
+		self.loopThread = threading.Thread(target=lambda: runFuncLogged(lambda: self.loop.run_until_complete(self.mainAsync())), daemon=True, name='Thread-Asyncio')
+		self.loopThread.start()
+	def engineAlive(self) -> bool:
+		return self.loopThread.is_alive()
+	def engineGauges(self) -> dict:
+		return {}
+	def close(self, closeNow=False):
+		self.closeEvent.set()
+		if not closeNow: self.loopThread.join()
+		self.serverSocket.close()
+		if self.replays is not None: self.replays.close() # NOTE Server.close() would join the threads of the threaded engine
+
+	async def mainAsync(self):
+		server = await asyncio.start_server(self.connectionLoopAsync, sock=self.serverSocket)
+		while self.shouldRun():
+			await asyncio.sleep(self.housekeepingTimeout())
+			self.housekeeping()
+		server.close()
+		tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+		for conn in list(self.connections):
+			conn.close()
+		await asyncio.gather(*tasks, return_exceptions=True)
+	async def connectionLoopAsync(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # NOTE asyncio sets it only on sockets created with IPPROTO_TCP
+		conn = AsyncConnection(writer)
+		self.connections.add(conn)
+		try:
+			while True:
+				msgLen = int.from_bytes(await reader.readexactly(ConnectionPrimitives.MSGLEN_SIZE), byteorder='big')
+				if msgLen > ConnectionPrimitives.MAX_MSG_LEN: raise ConnectionPrimitives.MessageTooLong(f'message of {msgLen} bytes')
+				req = self._parseReq(conn, await reader.readexactly(msgLen))
+				self.updateLastReqTime(req)
+				self.handleReq(req)
+				self.housekeeping()
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		except (ValueError, BinaryCodec.DecodeError) as e:
+			logging.warning('closing connection %s: %r', conn.getpeername(), e)
+		finally:
+			self.connections.discard(conn)
+			writer.close()
+
+# journaled engine ----------------------------------------
+PLAYERS, GAMES = 0, 1 # NOTE the journal tables, a player in a game is kept in the record of the game
+JOURNALED_COMMANDS = {COM.CONNECT, COM.PAIR, COM.GAME_READINESS, COM.SHOOT, COM.OPPONENT_SHOT, COM.AWAIT_REMATCH, COM.UPDATE_REMATCH}
+
+class JournaledServer(Server):
+	'''the threaded engine keeping its players and games in a Journal, a restarted server recovers them and the clients resume their games
+	the output of the game logic is held until the journal records it reports on are durable, so no client sees a state the server could lose'''
+	def __init__(self, addr, directory: str, replays: Optional[str]=None):
+		self.journal = Journal(directory)
+		self.recovered: dict[int, int] = {} # NOTE id of every player recovered but not resumed yet -> id of his game, 0 for none
+		self.recoveredRecords: dict[tuple[int, int], bytes] = {} # NOTE the journal records of those players and their games
+		self.recoveredDeadline = 0.
+		self.heldOutput: list[tuple[ClientConnection, bytes]] = [] # NOTE touched only by the game logic
+		super().__init__(addr, replays)
+	def openSocket(self, addr) -> socket.socket:
+		'''the restarted server binds the port while the connections of the previous one are still in TIME_WAIT'''
+		serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if os.name == 'posix': serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # NOTE on Windows it would let another socket take the port
+		serverSocket.bind(addr)
+		serverSocket.listen()
+		return serverSocket
+	def startEngine(self):
+		self.recoverJournal()
+		self.journal.start()
+		super().startEngine()
+	def engineGauges(self) -> dict:
+		return {**super().engineGauges(), ('journal_records', ()): self.journal.records, ('journal_commits', ()): self.journal.commits, ('unresumed_players', ()): len(self.recovered)}
+	def shouldRun(self) -> bool:
+		return super().shouldRun() or not self.journal.idle()
+	def close(self, closeNow=False):
+		super().close(closeNow)
+		self.journal.close()
+
+	def recoverJournal(self):
+		started = time.perf_counter()
+		gcEnabled = gc.isenabled()
+		gc.disable() # NOTE the collections triggered by all the new objects would take longer than making them, none of them is garbage
+		try:
+			self.recover(self.journal.load())
+		finally:
+			if gcEnabled: gc.enable()
+		logging.info('recovered %d players from the journal in %.3f s', len(self.recovered), time.perf_counter() - started)
+	def recover(self, records: dict):
+		'''indexes the players and games in the journal, a game is unpacked only once one of its players comes back,
+		the players get MAX_TIME_FOR_DISCONNECT to resume'''
+		recovered = self.recovered
+		for (table, id), body in records.items():
+			if table != GAMES: continue
+			_, player1, player2 = GAME_PLAYERS.unpack_from(body)
+			recovered[player1] = recovered[player2] = id
+		for table, id in records.keys():
+			if table == PLAYERS and id not in recovered: recovered[id] = 0
+		self.recoveredRecords = records
+		self.recoveredDeadline = time.time() + MAX_TIME_FOR_DISCONNECT
+		if recovered: self.deadlines.schedule(('player', 0), self.recoveredDeadline) # NOTE 0 is never a player id, see checkConnection
+	def resumeRecovered(self, playerId: int):
+		'''unpacks the recovered player with his game, as recover() did for all of them before'''
+		gameId = self.recovered.pop(playerId, None)
+		if gameId is None: return
+		if gameId:
+			game = self.games[gameId] = Game.unpack(self.recoveredRecords.pop((GAMES, gameId)))
+			players = game.players
+			self.recovered.pop(game.getOpponent(players[players[1].id == playerId]).id, None)
+			if not game.gameActive: self.gamesToNotify.add(game.id)
+			if game.canBeEnded(): self.endableGames.add(game.id)
+		else:
+			players = (ConnectedPlayer.unpack(self.recoveredRecords.pop((PLAYERS, playerId)))[0],)
+			self.matchmaking.add(players[0])
+		for player in players:
+			self.players[player.id] = player
+			if player.connected: self.deadlines.schedule(('player', player.id), self.recoveredDeadline)
+	def checkConnection(self, playerId: int, now: float):
+		'''the deadline of player 0 drops the recovered players who didn't resume, together with their games'''
+		if playerId: return super().checkConnection(playerId, now)
+		if self.recovered: logging.warning('dropping %d recovered players who did not resume', len(self.recovered))
+		self.metrics.inc('inactivity_disconnects', n=len(self.recovered))
+		for table, id in self.recoveredRecords.keys(): self.journal.delete(table, id)
+		self.recovered, self.recoveredRecords = {}, {}
+	def _generateNewID(self, dictOfIds):
+		'''the ids of the players and games still in recoveredRecords are taken as well'''
+		while True:
+			id = super()._generateNewID(dictOfIds)
+			if id not in self.recovered and (GAMES, id) not in self.recoveredRecords: return id
+
+	def handleReq(self, req: Request):
+		if self.recovered: self.resumeRecovered(req.playerId)
+		super().handleReq(req)
+		if req.command not in JOURNALED_COMMANDS or (player := self.players.get(req.playerId)) is None: return
+		if player.inGame: self.journalGame(self.games[player.gameId])
+		elif req.command == COM.CONNECT: self.journal.put(PLAYERS, player.id, player.pack())
+	def journalGame(self, game: Game):
+		self.journal.put(GAMES, game.id, game.pack())
+	def addNewGame(self, player1, player2, bothPaired: bool):
+		game = super().addNewGame(player1, player2, bothPaired)
+		for player in game.players: self.journal.delete(PLAYERS, player.id)
+		return game
+	def disconnectPlayer(self, playerId: int):
+		super().disconnectPlayer(playerId)
+		if (player := self.players.get(playerId)) is not None and player.inGame: self.journalGame(self.games[player.gameId])
+	def removePlayer(self, player: ConnectedPlayer):
+		super().removePlayer(player)
+		if not player.inGame: self.journal.delete(PLAYERS, player.id)
+	def removeGame(self, game: Game):
+		super().removeGame(game)
+		self.journal.delete(GAMES, game.id)
+
+	def queueOutput(self, conn: ClientConnection, data: bytes):
+		'''holds the output until housekeeping() after the request'''
+		self.heldOutput.append((conn, data))
+	def housekeeping(self):
+		super().housekeeping()
+		if not self.heldOutput: return
+		held, self.heldOutput = self.heldOutput, []
+		self.journal.whenDurable(lambda: self.releaseOutput(held))
+	def releaseOutput(self, held: list[tuple[ClientConnection, bytes]]):
+		for conn, data in held:
+			try:
+				Server.queueOutput(self, conn, data)
+			except OSError as e:
+				logging.debug('dropping output held for %s: %r', conn.addr, e)
+
+# sharded engine ----------------------------------------
+class WorkerConnection:
+	'''a client connection as seen by a worker process, what's sent goes through the pipe to the front process'''
+	def __init__(self, key: int, worker: 'ShardWorker'):
+		self.key = key
+		self.worker = worker
+		self.closed = False
+	def sendall(self, data):
+		if self.closed: raise ConnectionResetError('connection closed')
+		self.worker.pipe.send(('out', self.key, data))
+	def getpeername(self):
+		return f'connection {self.key}'
+
+class ShardWorker(Server):
+	'''one worker process of the sharded engine, owns the games handed over by the front process and their players
+	runs the same handlers as the other engines, all in the main thread of the process'''
+	def __init__(self, index: int, pipe, replays: Optional[str]=None):
+		self.index = index
+		self.pipe = pipe
+		self.conns: dict[int, WorkerConnection] = {}
+		super().__init__(None, replays)
+	def openSocket(self, addr):
+		return None
+	def startEngine(self):
+		pass
+	def run(self):
+		nextReport = 0.
+		try:
+			while self.shouldRun():
+				if self.pipe.poll(min(self.housekeepingTimeout(), max(0., nextReport - time.monotonic()))):
+					self.handleFrontMessage(self.pipe.recv())
+				self.housekeeping()
+				if time.monotonic() >= nextReport:
+					self.reportMetrics()
+					nextReport = time.monotonic() + METRICS_REPORT_INTERVAL
+			self.reportMetrics()
+		except (EOFError, OSError):
+			logging.warning('worker %d lost the front process', self.index)
+	def reportMetrics(self):
+		'''sends the front the whole metrics of this worker, they replace the ones sent before'''
+		self.pipe.send(('metrics', (*self.metrics.snapshot(), self.stateGauges())))
+	def handleFrontMessage(self, msg: tuple):
+		if msg[0] == 'req':
+			self.handleForwarded(msg[1])
+		elif msg[0] == 'game':
+			self.addMovedGame(msg[1])
+		elif msg[0] == 'closed':
+			if (conn := self.conns.pop(msg[1], None)) is not None: conn.closed = True
+		elif msg[0] == 'close':
+			self.closeEvent.set()
+	def connection(self, key: int) -> WorkerConnection:
+		if key not in self.conns: self.conns[key] = WorkerConnection(key, self)
+		return self.conns[key]
+	def addMovedGame(self, game: Game):
+		self.games[game.id] = game
+		for player in game.players:
+			player.conn = self.connection(player.conn)
+			self.players[player.id] = player
+			self.deadlines.schedule(('player', player.id), player.lastReqTime + MAX_TIME_FOR_DISCONNECT)
+		if not game.gameActive: self.gamesToNotify.add(game.id)
+	def handleForwarded(self, req: Request):
+		req.conn = self.connection(req.conn)
+		req.timeParsed = time.perf_counter() # NOTE request_seconds of the worker measure the handling here, the clock of the front may differ
+		if req.batched is not None:
+			req.conn = BatchConnection(req.conn)
+			for r in req.batched: r.conn, r.timeParsed = req.conn, req.timeParsed
+		self.updateLastReqTime(req)
+		self.handleReq(req)
+	def removePlayer(self, player: ConnectedPlayer):
+		super().removePlayer(player)
+		self.pipe.send(('gone', player.id))
+def runWorker(index: int, pipe, logSettings: LogSettings, replays: Optional[str]):
+	initChildLogging(logSettings, f'worker {index}: ')
+	worker = ShardWorker(index, pipe, replays)
+	worker.run()
+	if worker.replays is not None: worker.replays.close()
+def usableCores() -> int:
+	'''the cores this process may run on, sched_getaffinity is only on Linux'''
+	if hasattr(os, 'sched_getaffinity'): return len(os.sched_getaffinity(0))
+	return os.cpu_count() or 1
+
+class ShardedServer(Server):
+	'''the threaded engine whose game logic is sharded across worker processes, to use more cores than the GIL allows
+	the front process owns the sockets and pairs the players, every new game moves with both players to the worker gameId % workers,
+	all later requests of its players are forwarded there'''
+	def __init__(self, addr, workers: int=None, replays: Optional[str]=None):
+		self.numWorkers = workers or max(1, usableCores() - 1) # NOTE one core stays for the front process
+		super().__init__(addr, replays) # NOTE the games and so their replays are in the workers
+	def startEngine(self):
+		self.routes: dict[int, int] = {} # NOTE player id -> index of the worker owning him
+		self.workerMetrics: dict[int, tuple[dict, dict, dict]] = {} # NOTE the last metrics reported by every worker, counters, histograms and gauges
+		self.newGames: list[Game] = []
+		self.connsByKey: weakref.WeakValueDictionary[int, ClientConnection] = weakref.WeakValueDictionary()
+		self.pipes = []
+		self.pipeLocks = []
+		self.workers = []
+		context = multiprocessing.get_context('spawn') # NOTE a fork would copy the threads' locks
+		logSettings, self.logListener = forwardChildLogging(context)
+		for i in range(self.numWorkers):
+			pipe, workerPipe = context.Pipe()
+			self.workers.append(context.Process(target=runWorker, args=(i, workerPipe, logSettings, self.replays and self.replays.directory), daemon=True, name=f'Worker-{i}'))
+			self.workers[-1].start()
+			workerPipe.close()
+			self.pipes.append(pipe)
+			self.pipeLocks.append(threading.Lock()) # NOTE the game logic stage and close() send to the workers
+		super().startEngine()
+		for i, pipe in enumerate(self.pipes):
+			self.selector.register(pipe, selectors.EVENT_READ, lambda i=i: self.readWorker(i))
+	def engineAlive(self) -> bool:
+		return super().engineAlive() and all(worker.is_alive() for worker in self.workers)
+	def renderMetrics(self) -> str:
+		'''the metrics of the front merged with the ones the workers reported, the games and their players are in the workers'''
+		metrics = Metrics()
+		metrics.merge(*self.metrics.snapshot())
+		gauges = {('waiting_reqs', ()): self.waitingReqs.qsize(), ('connections', ()): len(self.connections), **self.stateGauges(), **self.engineGauges()}
+		for counters, histograms, workerGauges in list(self.workerMetrics.values()):
+			metrics.merge(counters, histograms)
+			for key, value in workerGauges.items(): gauges[key] = gauges.get(key, 0) + value
+		return metrics.render(gauges)
+	def engineGauges(self) -> dict:
+		return {**super().engineGauges(), ('routed_players', ()): len(self.routes), ('workers_alive', ()): sum(worker.is_alive() for worker in self.workers)}
+	def shouldRun(self) -> bool:
+		'''the front relays the output of the workers until they finish'''
+		return super().shouldRun() or any(worker.is_alive() for worker in self.workers)
+	def close(self, closeNow=False):
+		self.closeEvent.set()
+		for i in range(len(self.workers)): self.sendToWorker(i, ('close',))
+		super().close(closeNow)
+		for worker in self.workers:
+			if closeNow: worker.terminate()
+			worker.join()
+		self.logListener.stop()
+
+	# game logic stage ----------------------------------
+	def handleReq(self, req: Union[Request, tuple]):
+		if isinstance(req, tuple): return self.notifyClosed(req[1]) # NOTE the I/O stage queues them among the requests
+		if (worker := self.routes.get(req.playerId)) is not None: return self.forwardReq(worker, req)
+		super().handleReq(req)
+		self.moveNewGames()
+	def notifyClosed(self, key: int):
+		for i in range(len(self.workers)): self.sendToWorker(i, ('closed', key))
+	def forwardReq(self, worker: int, req: Request):
+		'''the worker handles the request and measures it in its request_seconds, here only the forwarding is'''
+		try:
+			self.forward(worker, req)
+		except PlayerDisconnectIssued:
+			pass # NOTE the player isn't here, his game was in the worker
+		finally:
+			self.metrics.observe('forward_seconds', commandLabel(req.command), time.perf_counter() - req.timeParsed)
+	def addNewGame(self, player1, player2, bothPaired: bool):
+		game = super().addNewGame(player1, player2, bothPaired)
+		self.newGames.append(game) # NOTE moved after the request is handled, the pairing responses come from here
+		return game
+	def moveNewGames(self):
+		for game in self.newGames:
+			worker = game.id % len(self.workers)
+			self.games.pop(game.id)
+			for player in game.players:
+				if player.id in self.blockingReqs: self.respondBlockingReq(player, useDefault=True) # NOTE the client repeats it, then to the worker
+				self.players.pop(player.id)
+				self.deadlines.cancel(('player', player.id))
+				self.routes[player.id] = worker
+				self.connsByKey[player.conn.key] = player.conn
+				player.conn = player.conn.key
+			self.sendToWorker(worker, ('game', game))
+		self.newGames.clear()
+	def forward(self, worker: int, req: Request):
+		conn = getattr(req.conn, 'conn', req.conn) # NOTE a request of a batch gets answered outside of it
+		self.connsByKey[conn.key] = conn
+		batched = [r.replace(conn=None) for r in req.batched] if req.batched is not None else None
+		if not self.sendToWorker(worker, ('req', req.replace(conn=conn.key, batched=batched))):
+			self.routes.pop(req.playerId, None)
+			asert(False, req, 'the game is lost')
+	def sendToWorker(self, worker: int, msg: tuple) -> bool:
+		try:
+			with self.pipeLocks[worker]:
+				self.pipes[worker].send(msg)
+			return True
+		except OSError as e:
+			(logging.info if self.closeEvent.is_set() else logging.error)('worker %d unreachable: %r', worker, e) # NOTE on close a worker ends once its players are gone
+			return False
+
+	# I/O stage -------------------------------------------
+	def readWorker(self, worker: int):
+		pipe = self.pipes[worker]
+		try:
+			while pipe.poll():
+				msg = pipe.recv()
+				if msg[0] == 'out': self.relayOutput(msg[1], msg[2])
+				elif msg[0] == 'gone': self.routes.pop(msg[1], None)
+				elif msg[0] == 'metrics': self.workerMetrics[worker] = msg[1]
+		except (EOFError, OSError):
+			(logging.info if self.closeEvent.is_set() else logging.error)('worker %d ended', worker)
+			self.selector.unregister(pipe)
+			if worker in self.workerMetrics: self.workerMetrics[worker] = (*self.workerMetrics[worker][:2], {}) # NOTE its games are gone, what it counted stays
+	def relayOutput(self, key: int, data: bytes):
+		if (conn := self.connsByKey.get(key)) is None: return
+		try:
+			self.queueOutput(conn, data)
+		except ConnectionResetError:
+			pass
+	def closeConnection(self, conn: ClientConnection):
+		super().closeConnection(conn)
+		self.waitingReqs.put(('closed', conn.key)) # NOTE never sent from here, a worker blocked on its output to the front would block this thread for good
+
+# reuseport engine ----------------------------------------
+class ReusePortListener(Server):
+	'''one listener process of the reuseport engine, a threaded engine accepting on the port it shares with the other listeners
+	the players pair within the process first, one left waiting on COM.PAIR is reported to the supervisor,
+	which moves him together with his connection to a listener where another player waits, so every game lives in one process'''
+	def __init__(self, addr, index: int, count: int, pipe, replays: Optional[str]=None):
+		self.index = index
+		self.count = count
+		self.pipe = pipe
+		self.pipeLock = threading.Lock() # NOTE both stages report to the supervisor
+		self.handOffs: list[tuple[ClientConnection, int, ConnectedPlayer, int]] = [] # NOTE guarded by outLock
+		super().__init__(addr, replays)
+	def openSocket(self, addr) -> socket.socket:
+		serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # NOTE the kernel spreads the new connections over the listeners
+		serverSocket.bind(addr)
+		serverSocket.listen()
+		return serverSocket
+	def startEngine(self):
+		super().startEngine()
+		self.selector.register(self.pipe, selectors.EVENT_READ, self.readSupervisor)
+	def report(self, *msg):
+		try:
+			with self.pipeLock:
+				self.pipe.send(msg)
+		except OSError as e:
+			logging.error('supervisor unreachable: %r', e)
+
+	# game logic stage ----------------------------------
+	def handleReq(self, req: Union[Request, tuple]):
+		if isinstance(req, tuple): return self.handleSupervisorMessage(req) # NOTE the I/O stage queues them among the requests
+		super().handleReq(req)
+	def handleSupervisorMessage(self, msg: tuple):
+		if msg[0] == 'hand_off':
+			self.handOff(msg[1], msg[2])
+		elif msg[0] == 'take':
+			self.takePlayer(msg[1], msg[2])
+	def newConnectedPlayer(self, playerName):
+		player = super().newConnectedPlayer(playerName)
+		self.report('own', ('player', player.id))
+		return player
+	def removePlayer(self, player: ConnectedPlayer):
+		super().removePlayer(player)
+		self.report('disown', ('player', player.id))
+	def addNewGame(self, player1, player2, bothPaired: bool):
+		game = super().addNewGame(player1, player2, bothPaired)
+		self.report('own', ('game', game.id))
+		return game
+	def removeGame(self, game: Game):
+		super().removeGame(game)
+		self.report('disown', ('game', game.id))
+	def pairPlayer(self, player: ConnectedPlayer, req: Request):
+		super().pairPlayer(player, req)
+		if player.id in self.blockingReqs: self.report('waiting', player.id) # NOTE no opponent here, another listener may have one
+	def respondBlockingReq(self, player: ConnectedPlayer, payload: dict={}, **kwargs):
+		if self.blockingReqs[player.id].command == COM.PAIR: self.report('unwaiting', player.id)
+		super().respondBlockingReq(player, payload, **kwargs)
+	def handOff(self, playerId: int, target: int):
+		'''moves the player waiting on COM.PAIR to the listener @target, his request stays unanswered and the target pairs him'''
+		if self.closeEvent.is_set() or (player := self.players.get(playerId)) is None: return
+		if player.inGame or (req := self.blockingReqs.get(playerId)) is None or req.command != COM.PAIR: return # NOTE paired meanwhile
+		self.blockingReqs.pop(playerId)
+		self.deadlines.cancel(('blocking', playerId))
+		self.deadlines.cancel(('player', playerId))
+		self.matchmaking.remove(player)
+		self.players.pop(playerId)
+		conn, player.conn = player.conn, None
+		with self.outLock:
+			self.handOffs.append((conn, target, player, req.reqId))
+		try:
+			self.wakeupSend.send(b'\0')
+		except BlockingIOError:
+			pass
+	def takePlayer(self, player: ConnectedPlayer, req: Request):
+		'''the player moved here, his COM.PAIR gets handled like a new one'''
+		try:
+			asert(player.id not in self.players, req, 'player id already taken', player.id)
+		except PlayerDisconnectIssued:
+			return
+		player.lastReqTime = time.time()
+		self.players[player.id] = player
+		self.matchmaking.add(player)
+		self.deadlines.schedule(('player', player.id), player.lastReqTime + MAX_TIME_FOR_DISCONNECT)
+		super().handleReq(req)
+	def _generateNewID(self, dictOfIds):
+		'''the ids of each listener are congruent to its index, so a moved player can keep his'''
+		while (id := random.randrange(1000 // self.count, 2**20 // self.count) * self.count + self.index) in dictOfIds: pass
+		return id
+
+	# I/O stage -------------------------------------------
+	def readSupervisor(self):
+		try:
+			while self.pipe.poll():
+				msg = self.pipe.recv()
+				if msg[0] == 'take': self.takeConnection(msg[1], msg[2], msg[3], reduction.recv_handle(self.pipe))
+				elif msg[0] == 'close': self.closeEvent.set()
+				else: self.waitingReqs.put(msg)
+		except (EOFError, OSError):
+			logging.error('listener %d lost the supervisor', self.index)
+			self.selector.unregister(self.pipe)
+			self.closeEvent.set()
+	def handleQueuedOutput(self):
+		super().handleQueuedOutput()
+		with self.outLock:
+			handOffs, self.handOffs = self.handOffs, []
+		for conn, target, player, reqId in handOffs:
+			self.handOffConnection(conn, target, player, reqId)
+	def handOffConnection(self, conn: ClientConnection, target: int, player: ConnectedPlayer, reqId: int):
+		'''passes the socket to the supervisor together with the data read but not parsed yet, this process then closes only its copy'''
+		if conn.closed: return self.report('disown', ('player', player.id)) # NOTE the client left meanwhile
+		self.flushConnection(conn, blocking=True)
+		self.selector.unregister(conn.sock)
+		self.connections.discard(conn)
+		try:
+			with self.pipeLock:
+				self.pipe.send(('hand_off', target, player, reqId, bytes(conn.inBuffer.buffer)))
+				reduction.send_handle(self.pipe, conn.sock.fileno(), os.getppid())
+		except OSError as e:
+			logging.error('could not hand off player %d: %r', player.id, e)
+		with self.outLock:
+			conn.closed = True
+		conn.close()
+	def takeConnection(self, player: ConnectedPlayer, reqId: int, unparsed: bytes, fd: int):
+		sock = socket.socket(fileno=fd)
+		try:
+			conn = ClientConnection(sock, sock.getpeername(), self)
+		except OSError:
+			sock.close()
+			return self.report('disown', ('player', player.id))
+		sock.setblocking(False)
+		player.conn = conn
+		self.connections.add(conn)
+		self.selector.register(sock, selectors.EVENT_READ, conn)
+		self.waitingReqs.put(('take', player, Request(conn, player.id, COM.PAIR, {}, reqId, player.codec, timeParsed=time.perf_counter())))
+		try:
+			for body in conn.inBuffer.feed(unparsed):
+				self.dispatchRequest(self._parseReq(conn, body))
+		except (ValueError, BinaryCodec.DecodeError) as e:
+			logging.warning('closing connection %s: %r', conn.addr, e)
+			self.closeConnection(conn)
+def runListener(index: int, count: int, addr, pipe, logSettings: LogSettings, replays: Optional[str]):
+	signal.signal(signal.SIGINT, signal.SIG_IGN) # NOTE closed by the supervisor
+	initChildLogging(logSettings, f'listener {index}: ')
+	server = ReusePortListener(addr, index, count, pipe, replays)
+	server.report('ready')
+	while server.engineAlive() and not server.closeEvent.wait(1.): pass
+	server.close(closeNow=not server.engineAlive())
+
+class ReusePortServer:
+	'''the reuseport engine - listener processes sharing the port through SO_REUSEPORT, each one running the threaded engine
+	this supervisor keeps the registry of which listener owns every player and game, relays the players moved between the listeners
+	and restarts a listener which dies, only the players of that one lose their games'''
+	def __init__(self, addr, workers: int=None, replays: Optional[str]=None):
+		self.replays = replays # NOTE every listener records the games it runs
+		self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		self.serverSocket.bind(addr) # NOTE never listens, it holds the port so a restarted listener can bind it again
+		self.registry = Registry()
+		self.metrics = Metrics()
+		self.closeEvent = threading.Event()
+		self.context = multiprocessing.get_context('spawn') # NOTE a fork would copy the threads' locks
+		self.logSettings, self.logListener = forwardChildLogging(self.context)
+		count = workers or usableCores()
+		self.listeners: list[Optional[multiprocessing.Process]] = [None] * count
+		self.pipes: list[Optional[multiprocessing.connection.Connection]] = [None] * count
+		self.pipeLocks = [threading.Lock() for _ in range(count)] # NOTE close() sends from the main thread
+		for i in range(count): self.startListener(i)
+		for pipe in self.pipes: pipe.recv() # NOTE ('ready',) once it listens, so the server is ready when constructed
+		self.supervisorThread = threading.Thread(target=lambda: runFuncLogged(self.superviseLoop), daemon=True, name='Thread-Supervisor')
+		self.supervisorThread.start()
+	def startListener(self, index: int):
+		pipe, listenerPipe = self.context.Pipe()
+		args = (index, len(self.listeners), self.serverSocket.getsockname(), listenerPipe, self.logSettings, self.replays)
+		self.listeners[index] = self.context.Process(target=runListener, args=args, name=f'Listener-{index}')
+		self.listeners[index].start()
+		listenerPipe.close()
+		self.pipes[index] = pipe
+	def engineAlive(self) -> bool:
+		return self.supervisorThread.is_alive()
+	def close(self, closeNow=False):
+		self.closeEvent.set()
+		for i in range(len(self.listeners)): self.sendToListener(i, ('close',))
+		if not closeNow: self.supervisorThread.join()
+		for listener in list(self.listeners):
+			if listener is None: continue
+			if closeNow: listener.terminate()
+			listener.join()
+		self.logListener.stop()
+		self.serverSocket.close()
+	def renderMetrics(self) -> str:
+		'''the registry and the listeners alive, every listener has its own state'''
+		gauges = {('listeners_alive', ()): sum(listener is not None and listener.is_alive() for listener in list(self.listeners))}
+		for (kind, listener), n in self.registry.counts().items():
+			gauges[(f'{kind}s', ('listener', str(listener)))] = n
+		return self.metrics.render(gauges)
+
+	def superviseLoop(self):
+		while not self.closeEvent.is_set() or any(self.listeners):
+			pipes = {pipe: i for i, pipe in enumerate(self.pipes) if pipe is not None}
+			sentinels = {listener.sentinel: i for i, listener in enumerate(self.listeners) if listener is not None}
+			for ready in multiprocessing.connection.wait([*pipes, *sentinels], timeout=1.):
+				if ready in pipes: self.readListener(pipes[ready])
+				elif self.listeners[sentinels[ready]] is not None: self.listenerDied(sentinels[ready])
+	def listenerDied(self, index: int):
+		listener = self.listeners[index]
+		listener.join()
+		self.listeners[index] = None
+		if self.pipes[index] is not None: self.readListener(index) # NOTE what it reported before dying, ends with EOF
+		lost = self.registry.processDied(index)
+		if self.closeEvent.is_set(): return
+		logging.error('listener %d died with exit code %s, %d players and %d games lost, restarting it', index, listener.exitcode, lost['player'], lost['game'])
+		self.metrics.inc('listener_restarts')
+		self.startListener(index)
+	def readListener(self, index: int):
+		pipe = self.pipes[index]
+		try:
+			while pipe.poll():
+				msg = pipe.recv()
+				if msg[0] == 'hand_off': self.relayHandOff(index, *msg[1:], reduction.recv_handle(pipe))
+				elif msg[0] == 'own': self.registry.own(index, msg[1])
+				elif msg[0] == 'disown': self.registry.disown(index, msg[1])
+				elif msg[0] == 'unwaiting': self.registry.stopWaiting(index, msg[1])
+				elif msg[0] == 'waiting' and (target := self.registry.wait(index, msg[1])) is not None:
+					self.sendToListener(index, ('hand_off', msg[1], target))
+		except (EOFError, OSError):
+			pipe.close()
+			self.pipes[index] = None # NOTE the listener died, its sentinel tells
+	def relayHandOff(self, source: int, target: int, player: ConnectedPlayer, reqId: int, unparsed: bytes, fd: int):
+		try:
+			with self.pipeLocks[target]:
+				if self.pipes[target] is None: raise ConnectionError(f'listener {target} is down')
+				self.pipes[target].send(('take', player, reqId, unparsed))
+				reduction.send_handle(self.pipes[target], fd, self.listeners[target].pid)
+			self.registry.move(('player', player.id), target)
+			self.metrics.inc('moved_players')
+		except OSError as e:
+			logging.error('could not move player %d to listener %d: %r', player.id, target, e)
+			self.registry.disown(source, ('player', player.id))
+		finally:
+			os.close(fd) # NOTE the target has its own copy
+	def sendToListener(self, index: int, msg: tuple):
+		try:
+			with self.pipeLocks[index]:
+				if self.pipes[index] is not None: self.pipes[index].send(msg)
+		except OSError as e:
+			logging.error('listener %d unreachable: %r', index, e)
+
+ENGINES = {'threaded': Server, 'asyncio': AsyncServer, 'sharded': ShardedServer, 'reuseport': ReusePortServer}
+MULTIPROCESS_ENGINES = ('sharded', 'reuseport')
+
 def serverMain():
 	initLogging('server_log.txt')
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--engine', help='the server engine to use', choices=ENGINES.keys(), default='threaded')
+	parser.add_argument('--metrics-port', help='serve live metrics over HTTP on this localhost port', type=int)
+	parser.add_argument('--workers', help='worker processes of the sharded engine, by default one less than the cores, or listener processes of the reuseport engine, by default one per core', type=int)
+	parser.add_argument('--journal', help='directory of the journal the threaded engine recovers its players and games from after a restart')
+	parser.add_argument('--replays', help='record the finished games to binary replay files in this directory')
+	args, unknown = parser.parse_known_args()
+	if args.journal is not None and args.engine != 'threaded': parser.error('--journal needs the threaded engine')
 	ADDR = (socket.gethostbyname(socket.gethostname()), 1250)
-	server = Server(ADDR)
-	logging.info(f'server ready and listening at {ADDR[0]}:{ADDR[1]}')
+	if args.journal is not None: server = JournaledServer(ADDR, args.journal, args.replays)
+	elif args.engine in MULTIPROCESS_ENGINES: server = ENGINES[args.engine](ADDR, args.workers, args.replays)
+	else: server = ENGINES[args.engine](ADDR, args.replays)
+	logging.info(f'server ready and listening at {ADDR[0]}:{ADDR[1]}, engine {args.engine}')
+	metricsServer = None
+	if args.metrics_port is not None:
+		metricsServer = serveMetrics(('127.0.0.1', args.metrics_port), server.renderMetrics)
+		logging.info(f'metrics at http://127.0.0.1:{args.metrics_port}/')
 
 	closeNow = False
 	try:
-		while server.acceptThread.is_alive() and server.waitingReqsThread.is_alive():
+		while server.engineAlive():
 			time.sleep(3)
 	except KeyboardInterrupt:
 		print('Keyboard-Interrupt')
@@ -488,6 +1549,7 @@ def serverMain():
 		closeNow = True
 		logging.error('Thread died, alive threads: ' + ', '.join(map(str, threading.enumerate())))
 	finally:
+		if metricsServer: metricsServer.shutdown()
 		server.close(closeNow)
 def main():
 	runFuncLogged(serverMain)
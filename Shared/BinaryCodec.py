@@ -0,0 +1,169 @@
+'''Compact binary encoding of messages, negotiated during COM.CONNECT
+
+message body: VERSION (1B), command index (1B), id (4B), reqId (4B), payload value
+value: tag (1B) + data, ships and grid positions have their own tightly packed tags'''
+import struct
+from Shared.Enums import COM
+
+NAME = 'bin1'
+VERSION = 1
+
+COMMANDS = list(COM)
+COMMAND_IDXS = {c: i for i, c in enumerate(COMMANDS)}
+# NOTE append only, the index of a key is part of the format
+KEYS = ['name', 'id', 'paired', 'rematched', 'opponent', 'expected', 'opponent_ready', 'ready', 'ships', 'approved', 'started', 'on_turn', 'pos', 'hitted', 'sunken_ship', 'game_won', 'opponent_grid', 'game_end_msg', 'shotted', 'lost', 'expected_opponent_rematch', 'changed', 'opponent_rematching', 'opponent_disconnected', 'rematch_desired', 'stay_connected', 'error', 'error_obj', 'size', 'horizontal', 'codec', 'codecs', 'reqs', 'command', 'payload', 'req_id', 'push', 'resumed']
+KEY_IDXS = {k: i for i, k in enumerate(KEYS)}
+KEY_STR = 0xFF
+SHIP_KEYS = {'pos', 'size', 'horizontal', 'hitted'}
+BOOLS = {bool}
+
+HEADER = struct.Struct('>BBII')
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_LIST, T_DICT, T_POS, T_SHIP, T_SHIPS = range(11)
+_FLOAT = struct.Struct('>d')
+MAX_VARINT_BYTES = 10 # NOTE 70 bits hold any 64 bit int
+MAX_DEPTH = 8 # NOTE nested lists and dicts, the schemas go 7 deep: a batch, its reqs, a request, its payload, the ships, a ship, its hitted
+
+class DecodeError(ValueError):
+	pass
+class EncodeError(ValueError):
+	'''Raised when the message can't be represented, e.g. an id or reqId outside of the unsigned 32 bits of the header'''
+	pass
+
+# encoding --------------------------------------
+def encode(id: int, command: str, payload: dict, reqId: int) -> bytes:
+	try:
+		out = bytearray(HEADER.pack(VERSION, COMMAND_IDXS[command], id, reqId))
+		_encodeValue(out, payload)
+	except (struct.error, OverflowError, TypeError) as e:
+		raise EncodeError(str(e)) from e
+	return bytes(out)
+def _encodeVarint(out: bytearray, n: int):
+	while n > 0x7F:
+		out.append((n & 0x7F) | 0x80)
+		n >>= 7
+	out.append(n)
+def _isPos(v) -> bool:
+	return len(v) == 2 and type(v[0]) is int and type(v[1]) is int and 0 <= v[0] < 16 and 0 <= v[1] < 16
+def _isShip(v) -> bool:
+	if v.keys() != SHIP_KEYS: return False
+	size, hitted, pos = v['size'], v['hitted'], v['pos']
+	return type(size) is int and 0 < size <= 8 and type(v['horizontal']) is bool and type(hitted) is list and len(hitted) == size \
+		and BOOLS.issuperset(map(type, hitted)) and type(pos) in (list, tuple) and _isPos(pos)
+def _packShip(out: bytearray, ship: dict):
+	hittedMask = 0
+	for i, h in enumerate(ship['hitted']):
+		if h: hittedMask |= 1 << i
+	x, y = ship['pos']
+	out += bytes((x << 4 | y, ship['size'] << 1 | ship['horizontal'], hittedMask))
+def _encodeValue(out: bytearray, v):
+	if v is None: out.append(T_NONE)
+	elif v is True: out.append(T_TRUE)
+	elif v is False: out.append(T_FALSE)
+	elif isinstance(v, int):
+		if not -2**63 <= v < 2**63: raise OverflowError(f'int {v} too big for {NAME}')
+		out.append(T_INT)
+		_encodeVarint(out, (v << 1) ^ (v >> 63))
+	elif isinstance(v, float):
+		out.append(T_FLOAT)
+		out += _FLOAT.pack(v)
+	elif isinstance(v, str):
+		b = v.encode('utf-8')
+		out.append(T_STR)
+		_encodeVarint(out, len(b))
+		out += b
+	elif isinstance(v, dict):
+		if _isShip(v):
+			out.append(T_SHIP)
+			return _packShip(out, v)
+		out.append(T_DICT)
+		_encodeVarint(out, len(v))
+		for key, val in v.items():
+			if key in KEY_IDXS: out.append(KEY_IDXS[key])
+			else:
+				b = key.encode('utf-8')
+				out.append(KEY_STR)
+				_encodeVarint(out, len(b))
+				out += b
+			_encodeValue(out, val)
+	elif isinstance(v, (list, tuple)):
+		if _isPos(v):
+			out.append(T_POS)
+			out.append(v[0] << 4 | v[1])
+		elif len(v) and all(isinstance(s, dict) and _isShip(s) for s in v):
+			out.append(T_SHIPS)
+			_encodeVarint(out, len(v))
+			for ship in v: _packShip(out, ship)
+		else:
+			out.append(T_LIST)
+			_encodeVarint(out, len(v))
+			for item in v: _encodeValue(out, item)
+	else:
+		raise TypeError(f'Cannot encode {type(v)} in {NAME}')
+
+# decoding ---------------------------------------
+def decode(body) -> tuple[int, COM, dict, int]:
+	'''@return (id, command, payload, reqId)'''
+	try:
+		version, commandIdx, id, reqId = HEADER.unpack_from(body, 0)
+		if version != VERSION: raise DecodeError(f'Unsupported {NAME} version {version}')
+		payload, end = _decodeValue(memoryview(body), HEADER.size, 0)
+		if end != len(body): raise DecodeError('Trailing bytes after payload')
+		return id, COMMANDS[commandIdx], payload, reqId
+	except (IndexError, struct.error, UnicodeDecodeError) as e:
+		raise DecodeError(str(e)) from e
+def _decodeVarint(buf, i) -> tuple[int, int]:
+	n = shift = 0
+	while True:
+		b = buf[i]
+		i += 1
+		n |= (b & 0x7F) << shift
+		if b < 0x80: return n, i
+		shift += 7
+		if shift == 7 * MAX_VARINT_BYTES: raise DecodeError(f'varint longer than {MAX_VARINT_BYTES} bytes')
+HITTED_LISTS = [[[bool(mask >> s & 1) for s in range(size)] for mask in range(256)] for size in range(9)] # [size][mask]
+def _unpackShip(buf, i) -> dict:
+	posByte, sizeByte, hittedMask = buf[i], buf[i+1], buf[i+2]
+	size = sizeByte >> 1
+	return {'pos': [posByte >> 4, posByte & 0xF], 'size': size, 'horizontal': bool(sizeByte & 1), 'hitted': HITTED_LISTS[size][hittedMask].copy()}
+def _decodeValue(buf, i, depth) -> tuple[object, int]:
+	'''@depth: lists and dicts the value is nested in'''
+	tag = buf[i]
+	i += 1
+	if tag == T_NONE: return None, i
+	if tag == T_FALSE: return False, i
+	if tag == T_TRUE: return True, i
+	if tag == T_INT:
+		n, i = _decodeVarint(buf, i)
+		return (n >> 1) ^ -(n & 1), i
+	if tag == T_FLOAT: return _FLOAT.unpack_from(buf, i)[0], i + _FLOAT.size
+	if tag == T_STR:
+		n, i = _decodeVarint(buf, i)
+		return str(buf[i:i+n], 'utf-8'), i + n
+	if tag == T_POS: return [buf[i] >> 4, buf[i] & 0xF], i + 1
+	if tag == T_SHIP: return _unpackShip(buf, i), i + 3
+	if tag == T_SHIPS:
+		n, i = _decodeVarint(buf, i)
+		return [_unpackShip(buf, i + 3 * s) for s in range(n)], i + 3 * n
+	if tag == T_LIST:
+		if depth == MAX_DEPTH: raise DecodeError(f'value nested deeper than {MAX_DEPTH}')
+		n, i = _decodeVarint(buf, i)
+		l = []
+		for _ in range(n):
+			v, i = _decodeValue(buf, i, depth + 1)
+			l.append(v)
+		return l, i
+	if tag == T_DICT:
+		if depth == MAX_DEPTH: raise DecodeError(f'value nested deeper than {MAX_DEPTH}')
+		n, i = _decodeVarint(buf, i)
+		d = {}
+		for _ in range(n):
+			keyIdx = buf[i]
+			i += 1
+			if keyIdx == KEY_STR:
+				keyLen, i = _decodeVarint(buf, i)
+				key = str(buf[i:i+keyLen], 'utf-8')
+				i += keyLen
+			else: key = KEYS[keyIdx]
+			d[key], i = _decodeValue(buf, i, depth + 1)
+		return d, i
+	raise DecodeError(f'Unknown tag {tag}')
@@ -1,47 +1,116 @@
-import socket, json, logging
+import socket, json, logging, itertools
+from Shared import BinaryCodec
 
 DEBUG_REQS = True
+REQ_LOG_EVERY = 1 # NOTE only every n-th message is logged, 0 - none
+reqLogger = logging.getLogger('reqs')
+_reqLogCounter = itertools.count()
 
 MSGLEN_SIZE = 8
+MAX_MSG_LEN = 2**20
+MAX_BATCH_LEN = 16 # NOTE requests in one COM.BATCH
 
-def send(conn: socket.socket, id: int, command: str, payload: dict={}):
-	assert isinstance(payload, dict)
-	if DEBUG_REQS: logging.debug(f'sending req: id {id}, command {command} payload {payload}')
+# codecs ------------------------------------------
+CODEC_JSON = 'json'
+CODEC_BIN = BinaryCodec.NAME
+SUPPORTED_CODECS = [CODEC_BIN, CODEC_JSON] # NOTE in order of preference
+JSON_FIRST_BYTE = ord('{') # NOTE the codec of a message is recognised by its first byte
+ENVELOPE_KEYS = {'id', 'command', 'payload', 'req_id'}
+
+def chooseCodec(offered: list[str], forceJson=False) -> str:
+	'''picks the codec for the connection from the ones offered in COM.CONNECT'''
+	if forceJson: return CODEC_JSON
+	for codec in SUPPORTED_CODECS:
+		if codec in offered: return codec
+	return CODEC_JSON
+
+def encodeBody(id: int, command: str, payload: dict, reqId: int, codec: str) -> bytes:
+	if codec == CODEC_BIN: return BinaryCodec.encode(id, command, payload, reqId)
 	msg = {
 		'id': id,
 		'command': command,
-		'payload': payload
+		'payload': payload,
+		'req_id': reqId
 	}
-	msg = json.dumps(msg)
+	return json.dumps(msg).encode('utf-8')
+def decodeBody(body) -> tuple[int, str, dict, int, str]:
+	'''@return (id, command, payload, reqId, codec)
+	raises ValueError on a malformed body, so the server drops only the connection which sent it'''
+	if not body: raise ValueError('empty message')
+	try:
+		if body[0] != JSON_FIRST_BYTE:
+			return (*BinaryCodec.decode(body), CODEC_BIN)
+		response = json.loads(body.decode('utf-8'))
+	except RecursionError as e: # NOTE a value nested deeper than the interpreter's recursion limit, it must not kill the I/O thread
+		raise ValueError('message nested too deep') from e
+	if not isinstance(response, dict) or not ENVELOPE_KEYS <= response.keys(): raise ValueError('message without the id, command, payload and req_id')
+	id, command, payload, reqId = [response[x] for x in ['id', 'command', 'payload', 'req_id']]
+	return id, command, payload, reqId, CODEC_JSON
+
+class ConnectionClosed(ConnectionError):
+	'''Raised when the other side closed the connection'''
+	pass
+class MessageTooLong(ConnectionError):
+	'''Raised when the announced message length is over MAX_MSG_LEN'''
+	pass
+
+class MessageBuffer:
+	'''buffers bytes received on a non-blocking connection and splits off the whole message bodies'''
+	__slots__ = ('buffer',)
+	def __init__(self):
+		self.buffer = bytearray()
+	def feed(self, data: bytes) -> list[bytes]:
+		'''@return bodies of all messages completed by data, the partial rest stays buffered'''
+		self.buffer += data
+		bodies = []
+		start = 0
+		while len(self.buffer) - start >= MSGLEN_SIZE:
+			msgLen = int.from_bytes(self.buffer[start:start+MSGLEN_SIZE], byteorder='big')
+			if msgLen > MAX_MSG_LEN: raise MessageTooLong(f'message of {msgLen} bytes')
+			end = start + MSGLEN_SIZE + msgLen
+			if len(self.buffer) < end: break
+			bodies.append(bytes(self.buffer[start+MSGLEN_SIZE:end]))
+			start = end
+		del self.buffer[:start]
+		return bodies
+
+# sending and receiving ----------------------------
+def logReq(verb: str, id: int, command: str, reqId: int, payload: dict):
+	'''logs a sample of the messages on DEBUG, only the sampled payloads are stringified
+	the payload is snapshotted here, it's often changed after it's sent or received while the record waits for the writer thread'''
+	if DEBUG_REQS and REQ_LOG_EVERY and reqLogger.isEnabledFor(logging.DEBUG) and next(_reqLogCounter) % REQ_LOG_EVERY == 0:
+		reqLogger.debug('%s req: id %s, command %s, reqId %s payload %s', verb, id, command, reqId, repr(payload))
+def send(conn: socket.socket, id: int, command: str, payload: dict={}, reqId: int=0, codec: str=CODEC_JSON):
+	'''sends one message over the persistent connection, @reqId pairs the response with its request'''
+	assert isinstance(payload, dict)
+	logReq('sending', id, command, reqId, payload)
+	msg = encodeBody(id, command, payload, reqId, codec)
 	byteArr = bytearray(len(msg).to_bytes(MSGLEN_SIZE, byteorder='big'))
-	byteArr.extend(msg.encode('utf-8'))
+	byteArr.extend(msg)
 	conn.sendall(byteArr)
-	conn.shutdown(socket.SHUT_WR)
-
-def recv(conn: socket.socket) -> tuple[int, str, dict]:
-	response = recvWholeResponse(conn)
-	response = response.decode('utf-8')
-	response = json.loads(response)
-	id, command, payload = [response[x] for x in ['id', 'command', 'payload']]
-	assert isinstance(id, int) and isinstance(command, str) and isinstance(payload, dict)
-	if DEBUG_REQS: logging.debug(f'received req: id {id}, command {command} payload {payload}')
-	return id, command, payload
+
+def recv(conn: socket.socket) -> tuple[int, str, dict, int, str]:
+	'''receives one message, raises ConnectionClosed on closed connection
+	@return (id, command, payload, reqId, codec the message was sent in)'''
+	return decodeMessage(recvWholeResponse(conn))
+def decodeMessage(body) -> tuple[int, str, dict, int, str]:
+	'''decodes one message body, received whole by recv or split off by MessageBuffer'''
+	id, command, payload, reqId, codec = decodeBody(body)
+	assert isinstance(id, int) and isinstance(command, str) and isinstance(payload, dict) and isinstance(reqId, int)
+	logReq('received', id, command, reqId, payload)
+	return id, command, payload, reqId, codec
 def recvWholeResponse(conn: socket.socket):
-	res = conn.recv(2048)
-	if len(res) < MSGLEN_SIZE:
-		res = _recvBytes(conn, MSGLEN_SIZE - len(res), res)
-	responseLen = int.from_bytes(res[:MSGLEN_SIZE], byteorder='big') + MSGLEN_SIZE
-	if len(res) < responseLen:
-		res = _recvBytes(conn, responseLen - len(res), res)
-
-	conn.shutdown(socket.SHUT_RD)
-	return res[MSGLEN_SIZE:]
+	res = _recvBytes(conn, MSGLEN_SIZE, b'')
+	responseLen = int.from_bytes(res, byteorder='big')
+	if responseLen > MAX_MSG_LEN: raise MessageTooLong(f'message of {responseLen} bytes')
+	return _recvBytes(conn, responseLen, b'')
 def _recvBytes(conn, num, prevRecvd) -> bytes:
 	'''receives excactly num bytes'''
 	numRecvd = 0
 	response = bytearray(prevRecvd)
 	while numRecvd < num:
 		recvd = conn.recv(min(2048, num-numRecvd))
+		if not recvd: raise ConnectionClosed('connection closed by the other side')
 		response += recvd
 		numRecvd += len(recvd)
 	return response
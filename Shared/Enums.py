@@ -36,3 +36,4 @@ class COM(str, Enum):
 
 	DISCONNECT = '!DISCONNECT'
 	ERROR = '!ERROR'
+	BATCH = '!BATCH' # NOTE envelope of several requests, their responses are sent separately
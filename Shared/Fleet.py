@@ -0,0 +1,129 @@
+'''The fleet every player places and its validation
+
+a board is a bitmask with bit y * GRID_WIDTH + x set for every occupied cell,
+the occupied and surrounding cells of every possible placement are precomputed'''
+import struct
+from typing import Optional
+
+GRID_WIDTH = 10
+GRID_HEIGHT = 10
+SHIP_SIZES: dict[int, int] = {1: 2, 2: 4, 3: 2, 4: 1} # shipSize : shipCount
+SHIP_KEYS = {'pos', 'size', 'horizontal', 'hitted'}
+FLEET_HEADER = struct.Struct('<HB') # NOTE lengths of the packed ships and hits
+AUTOPLACE_SHIPS = [{'pos': [3, 0], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [4, 3], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [5, 7], 'size': 3, 'horizontal': True, 'hitted': [False, False, False]}, {'pos': [1, 5], 'size': 4, 'horizontal': False, 'hitted': [False, False, False, False]}, {'pos': [8, 4], 'size': 1, 'horizontal': True, 'hitted': [False]}, {'pos': [6, 1], 'size': 1, 'horizontal': False, 'hitted': [False]}, {'pos': [5, 9], 'size': 2, 'horizontal': True, 'hitted': [False, False]}, {'pos': [1, 1], 'size': 2, 'horizontal': False, 'hitted': [False, False]}, {'pos': [9, 0], 'size': 3, 'horizontal': False, 'hitted': [False, False, False]}]
+
+def _rectMask(x1, y1, x2, y2) -> int:
+	'''@return mask of the cells in [x1, x2) x [y1, y2) clipped to the grid'''
+	mask = 0
+	for y in range(max(y1, 0), min(y2, GRID_HEIGHT)):
+		for x in range(max(x1, 0), min(x2, GRID_WIDTH)):
+			mask |= 1 << (y * GRID_WIDTH + x)
+	return mask
+def _genPlacements() -> dict[tuple[int, int, int, bool], tuple[int, int]]:
+	'''@return {(x, y, size, horizontal): (occupied mask, mask of the occupied and touching cells)}'''
+	placements = {}
+	for size in SHIP_SIZES:
+		for horizontal in (True, False):
+			width, height = (size, 1) if horizontal else (1, size)
+			for y in range(GRID_HEIGHT - height + 1):
+				for x in range(GRID_WIDTH - width + 1):
+					placements[(x, y, size, horizontal)] = (_rectMask(x, y, x + width, y + height), _rectMask(x - 1, y - 1, x + width + 1, y + height + 1))
+	return placements
+PLACEMENTS = _genPlacements()
+
+def validateFleet(ships) -> Optional[str]:
+	'''checks the ships are the whole fleet, not hitted yet and inside the grid, a ship mustn't occupy any cell around another one, not even diagonally
+	@return description of the first problem found, None for a valid fleet'''
+	if not isinstance(ships, list): return 'ships are not a list'
+	if len(ships) != sum(SHIP_SIZES.values()): return f'expected {sum(SHIP_SIZES.values())} ships'
+	remaining = dict(SHIP_SIZES)
+	board = 0
+	for ship in ships:
+		if not isinstance(ship, dict) or ship.keys() != SHIP_KEYS: return 'malformed ship'
+		pos, size, horizontal, hitted = ship['pos'], ship['size'], ship['horizontal'], ship['hitted']
+		if not (isinstance(pos, list) and len(pos) == 2 and type(pos[0]) is int and type(pos[1]) is int and type(size) is int and type(horizontal) is bool):
+			return 'malformed ship'
+		if not (isinstance(hitted, list) and len(hitted) == size and all(type(h) is bool for h in hitted)): return 'malformed ship hits'
+		if any(hitted): return f'ship at {pos} already hitted'
+		if remaining.get(size, 0) == 0: return f'too many ships of size {size}'
+		remaining[size] -= 1
+		placement = PLACEMENTS.get((pos[0], pos[1], size, horizontal))
+		if placement is None: return f'ship at {pos} outside the grid'
+		occupied, surroundings = placement
+		if board & surroundings: return f'ship at {pos} touches another ship'
+		board |= occupied
+	return None
+
+# packed fleet --------------------------------------
+class PackedFleet:
+	'''the ships of one player as the server keeps them, converted from and to the ship dicts only at the protocol edge
+	@ships x, y, size and horizontal of every ship as one byte each, in the order they were sent
+	@hits bitmask of the hitted segments, the segments of all ships numbered one ship after another
+	@cells index of the ship on every cell plus one, 0 for water, meaningful only for a fleet passing validateFleet
+	@starts the number of the first segment of every ship
+	@remaining segments not hitted yet, the fleet is sunk at 0
+	the last three are built by index(), for a fleet read from the journal only once it's shot at'''
+	__slots__ = ('ships', 'hits', 'cells', 'starts', 'remaining')
+	def __init__(self, ships: list[dict]):
+		packed = bytearray()
+		self.hits = 0
+		segment = 0
+		for ship in ships:
+			x, y = ship['pos']
+			packed += bytes((x, y, ship['size'], ship['horizontal']))
+			for hitted in ship['hitted']:
+				self.hits |= hitted << segment
+				segment += 1
+		self.ships = bytes(packed)
+		self.index()
+	def index(self):
+		cells = bytearray(GRID_WIDTH * GRID_HEIGHT)
+		starts = bytearray()
+		ships = self.ships
+		segment = 0
+		for i in range(0, len(ships), 4):
+			x, y, size, horizontal = ships[i:i+4]
+			starts.append(segment)
+			segment += size
+			if (x, y, size, bool(horizontal)) not in PLACEMENTS: continue
+			step = 1 if horizontal else GRID_WIDTH
+			cell = y * GRID_WIDTH + x
+			cells[cell:cell + step * size:step] = bytes((i // 4 + 1,)) * size
+		self.cells, self.starts = cells, bytes(starts)
+		self.remaining = segment - bin(self.hits).count('1')
+
+	def shoot(self, x: int, y: int) -> tuple[bool, Optional[int], bool]:
+		'''marks the hit segment
+		@return (bool - hitted, int - index of the ship sunk if any, bool - whole fleet sunk)'''
+		if self.cells is None: self.index()
+		ship = self.cells[y * GRID_WIDTH + x] - 1
+		if ship < 0: return False, None, False
+		shipX, shipY, size, horizontal = self.ships[4*ship:4*ship+4]
+		start = self.starts[ship]
+		bit = 1 << (start + (x - shipX if horizontal else y - shipY))
+		if not self.hits & bit:
+			self.hits |= bit
+			self.remaining -= 1
+		shipMask = ((1 << size) - 1) << start
+		return True, ship if self.hits & shipMask == shipMask else None, self.remaining == 0
+	def shipDict(self, index: int) -> dict:
+		x, y, size, horizontal = self.ships[4*index:4*index+4]
+		segment = sum(self.ships[2:4*index:4]) if self.cells is None else self.starts[index]
+		return {'pos': [x, y], 'size': size, 'horizontal': bool(horizontal), 'hitted': [bool(self.hits >> (segment + i) & 1) for i in range(size)]}
+	def shipDicts(self) -> list[dict]:
+		return [self.shipDict(i) for i in range(len(self.ships) // 4)]
+	def pack(self) -> bytes:
+		'''@return the fleet as kept in the server journal, read back by PackedFleet.unpack'''
+		hitsBytes = (self.hits.bit_length() + 7) // 8
+		return FLEET_HEADER.pack(len(self.ships), hitsBytes) + self.ships + self.hits.to_bytes(hitsBytes, 'little')
+	@classmethod
+	def unpack(cls, data: bytes, offset=0) -> tuple['PackedFleet', int]:
+		'''@return the fleet packed at @offset and the offset right after it'''
+		fleet = cls.__new__(cls)
+		shipsBytes, hitsBytes = FLEET_HEADER.unpack_from(data, offset)
+		start = offset + FLEET_HEADER.size
+		end = start + shipsBytes
+		fleet.ships = data[start:end]
+		fleet.hits = int.from_bytes(data[end:end+hitsBytes], 'little')
+		fleet.cells = fleet.starts = fleet.remaining = None
+		return fleet, end + hitsBytes
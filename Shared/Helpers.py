@@ -1,18 +1,62 @@
-import os, sys
-import logging, traceback, argparse
+import os, sys, queue, atexit
+import logging, logging.handlers, traceback, argparse
+from typing import Any, NamedTuple
+
+from Shared import ConnectionPrimitives
 
 # logging ------------------------------
 DEFAULT_LOGGING_LVL = 'INFO'
-def initLogging(logFilename, progName=None):
+class LazyQueueHandler(logging.handlers.QueueHandler):
+	'''puts the records to the queue unformatted, the message with its %-args is built on the writer thread
+	so the logged objects mustn't be changed after logging them'''
+	def prepare(self, record):
+		return record
+def initLogging(logFilename, progName=None) -> logging.handlers.QueueListener:
+	'''the records go through a queue to a writer thread, which formats them and writes the file
+	@return the listener of the writer thread, it's stopped and flushed at exit'''
 	parser = argparse.ArgumentParser(progName)
 	parser.add_argument('--log', help='set the logging level', type=str, default=DEFAULT_LOGGING_LVL)
+	parser.add_argument('--log-reqs-every', help='log only every n-th sent and received message on DEBUG, 0 - none', type=int, default=1)
 	args, unknown = parser.parse_known_args()
 	logLvl = getattr(logging, args.log.upper(), DEFAULT_LOGGING_LVL)
+	ConnectionPrimitives.REQ_LOG_EVERY = args.log_reqs_every
 	if not os.path.exists('logs'): os.mkdir('logs')
 	handlers = [logging.FileHandler(os.path.join('logs', logFilename)), logging.StreamHandler()]
+	handlers[0].setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s %(process)d:%(threadName)s:%(module)s:%(funcName)s:	%(message)s'))
 	handlers[1].setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
-	logging.basicConfig(handlers=handlers, level=logLvl, format='[%(levelname)s] %(asctime)s %(process)d:%(threadName)s:%(module)s:%(funcName)s:	%(message)s')
+	logQueue = queue.SimpleQueue()
+	listener = logging.handlers.QueueListener(logQueue, *handlers)
+	listener.start()
+	atexit.register(listener.stop)
+	logging.basicConfig(handlers=[LazyQueueHandler(logQueue)], level=logLvl)
 	logging.debug('running')
+	return listener
+
+# logging of child processes -----------------
+class LogSettings(NamedTuple):
+	'''what a child process needs to log like the process which started it'''
+	queue: Any # NOTE multiprocessing queue of the records, read by forwardChildLogging() of the parent
+	level: int
+	debugReqs: bool
+	reqLogEvery: int
+class ForwardHandler(logging.Handler):
+	'''hands the records of the child processes to the loggers of this process, so they go through its queue and writer thread'''
+	def emit(self, record):
+		logging.getLogger(record.name).handle(record)
+def forwardChildLogging(context) -> tuple[LogSettings, logging.handlers.QueueListener]:
+	'''@context multiprocessing context of the child processes
+	@return the settings to pass to initChildLogging() in the children and the listener forwarding their records, stop it after they end'''
+	settings = LogSettings(context.Queue(), logging.getLogger().getEffectiveLevel(), ConnectionPrimitives.DEBUG_REQS, ConnectionPrimitives.REQ_LOG_EVERY)
+	listener = logging.handlers.QueueListener(settings.queue, ForwardHandler())
+	listener.start()
+	return settings, listener
+def initChildLogging(settings: LogSettings, prefix: str):
+	'''sends the records to the parent, the message is formatted here as the records are pickled, but only for the levels logged'''
+	ConnectionPrimitives.DEBUG_REQS, ConnectionPrimitives.REQ_LOG_EVERY = settings.debugReqs, settings.reqLogEvery
+	handler = logging.handlers.QueueHandler(settings.queue)
+	handler.setFormatter(logging.Formatter(prefix + '%(message)s'))
+	logging.basicConfig(handlers=[handler], level=settings.level)
+
 def runFuncLogged(func):
 	try:
 		func()
@@ -0,0 +1,160 @@
+'''Declarative schemas of the request and response payloads of every COM, compiled once into validator functions
+
+a spec is a type (matched exactly, so a bool is no int), None, a dict of key specs,
+one of the spec classes below or a tuple of specs where any one of them has to match
+a validator returns None for a valid value, otherwise a PayloadError locating the first problem'''
+from typing import Any, Callable, NamedTuple, Optional
+
+from Shared.Enums import COM
+from Shared import Fleet, ConnectionPrimitives
+
+class PayloadError(NamedTuple):
+	path: str
+	problem: str
+	def __str__(self):
+		return f'{self.path}: {self.problem}' if self.path else self.problem
+
+class Opt(NamedTuple):
+	'''key of a dict which may be missing'''
+	spec: Any
+class ListOf(NamedTuple):
+	spec: Any
+	maxLen: int
+	minLen: int = 0
+class Range(NamedTuple):
+	'''int in [lo, hi)'''
+	lo: int
+	hi: int
+class Check(NamedTuple):
+	'''@func additional condition on a value already matching @spec'''
+	spec: Any
+	func: Callable[[Any], bool]
+	problem: str
+
+Validator = Callable[[Any], Optional[PayloadError]]
+
+# compiling ----------------------------------------
+def compileSpec(spec) -> Validator:
+	if spec is None: return _compileType(type(None))
+	if isinstance(spec, type): return _compileType(spec)
+	if isinstance(spec, dict): return _compileDict(spec)
+	if isinstance(spec, ListOf): return _compileList(spec)
+	if isinstance(spec, Range): return _compileRange(spec)
+	if isinstance(spec, Check): return _compileCheck(spec)
+	if isinstance(spec, tuple): return _compileAlternatives(spec)
+	raise TypeError(f'unknown spec {spec!r}')
+def _at(key, error: PayloadError) -> PayloadError:
+	return PayloadError(f'{key}.{error.path}' if error.path else str(key), error.problem)
+
+def _compileType(t: type) -> Validator:
+	error = PayloadError('', f'expected {t.__name__}')
+	def validateType(value):
+		return None if type(value) is t else error
+	return validateType
+def _compileRange(spec: Range) -> Validator:
+	error = PayloadError('', f'expected int in [{spec.lo}, {spec.hi})')
+	lo, hi = spec.lo, spec.hi
+	def validateRange(value):
+		return None if type(value) is int and lo <= value < hi else error
+	return validateRange
+def _compileList(spec: ListOf) -> Validator:
+	validateItem = compileSpec(spec.spec)
+	lengthError = PayloadError('', f'expected list of {spec.maxLen} items' if spec.minLen == spec.maxLen else f'expected list of {spec.minLen} to {spec.maxLen} items')
+	minLen, maxLen = spec.minLen, spec.maxLen
+	def validateList(value):
+		if type(value) is not list or not minLen <= len(value) <= maxLen: return lengthError
+		for i, item in enumerate(value):
+			if (error := validateItem(item)) is not None: return _at(i, error)
+		return None
+	return validateList
+def _compileCheck(spec: Check) -> Validator:
+	validateSpec = compileSpec(spec.spec)
+	error = PayloadError('', spec.problem)
+	func = spec.func
+	def validateCheck(value):
+		if (specError := validateSpec(value)) is not None: return specError
+		return None if func(value) else error
+	return validateCheck
+def _compileAlternatives(specs: tuple) -> Validator:
+	validators = [compileSpec(spec) for spec in specs]
+	def validateAlternatives(value):
+		for validate in validators:
+			if (error := validate(value)) is None: return None
+		return error # NOTE the problem of the last alternative
+	return validateAlternatives
+def _compileDict(spec: dict) -> Validator:
+	'''unknown keys are rejected, so a payload can't smuggle anything in'''
+	required = [(key, compileSpec(s)) for key, s in spec.items() if not isinstance(s, Opt)]
+	optional = {key: compileSpec(s.spec) for key, s in spec.items() if isinstance(s, Opt)}
+	allowed = spec.keys()
+	notDict = PayloadError('', 'expected dict')
+	def validateDict(value):
+		if type(value) is not dict: return notDict
+		if not value.keys() <= allowed: return PayloadError(str(sorted(value.keys() - allowed)[0]), 'unexpected key')
+		for key, validate in required:
+			if key not in value: return PayloadError(key, 'missing')
+			if (error := validate(value[key])) is not None: return _at(key, error)
+		if len(value) > len(required):
+			for key, validate in optional.items():
+				if key in value and (error := validate(value[key])) is not None: return _at(key, error)
+		return None
+	return validateDict
+
+# schemas ---------------------------------------------
+FLEET_LEN = sum(Fleet.SHIP_SIZES.values())
+POS = ListOf(Range(0, max(Fleet.GRID_WIDTH, Fleet.GRID_HEIGHT)), 2, 2)
+GRID_POS = Check(POS, lambda pos: pos[0] < Fleet.GRID_WIDTH and pos[1] < Fleet.GRID_HEIGHT, 'position outside the grid')
+SHIP = Check({'pos': GRID_POS, 'size': Range(min(Fleet.SHIP_SIZES), max(Fleet.SHIP_SIZES) + 1), 'horizontal': bool, 'hitted': ListOf(bool, max(Fleet.SHIP_SIZES))},
+	lambda ship: len(ship['hitted']) == ship['size'], 'hitted does not match the size')
+GAME_STATE = {'ready': bool, 'ships': Opt(ListOf(SHIP, FLEET_LEN))}
+OPPONENT = {'id': int, 'name': str}
+
+REQUESTS: dict[COM, dict] = {
+	COM.CONNECT: {'name': str, 'codecs': Opt(ListOf(str, 8)), 'push': Opt(bool)},
+	COM.CONNECTION_CHECK: {},
+	COM.PAIR: {},
+	COM.OPPONENT_READY: {'expected': bool},
+	COM.GAME_READINESS: {'ships': ListOf(SHIP, FLEET_LEN), 'ready': bool}, # NOTE the rules of the fleet are checked by Fleet.validateFleet
+	COM.GAME_WAIT: {},
+	COM.SHOOT: {'pos': GRID_POS},
+	COM.OPPONENT_SHOT: {},
+	COM.AWAIT_REMATCH: {'expected_opponent_rematch': bool},
+	COM.UPDATE_REMATCH: {'rematch_desired': bool},
+	COM.DISCONNECT: {},
+	COM.BATCH: {'reqs': ListOf({'command': str, 'payload': dict, 'req_id': Range(0, 2**32)}, ConnectionPrimitives.MAX_BATCH_LEN, 1)}, # NOTE every batched payload is checked by validateBatched, the req_id bounds are the ones of the bin1 header
+}
+# NOTE responses ending the connection carry the end message, blocking ones in a game also the opponent's grid
+RESPONSE_COMMON = {'stay_connected': bool, 'game_end_msg': Opt(str), 'opponent_grid': Opt(GAME_STATE)}
+REMATCHED = {'rematched': Opt(bool), 'opponent': Opt(OPPONENT)}
+RESPONSES: dict[COM, dict] = {
+	COM.CONNECT: {'id': int, 'codec': str, 'push': Opt(bool), 'resumed': Opt(bool)},
+	COM.CONNECTION_CHECK: {},
+	COM.PAIR: {'paired': Opt(bool), **REMATCHED},
+	COM.OPPONENT_READY: {'opponent_ready': bool},
+	COM.GAME_READINESS: {'approved': bool, 'opponent_ready': bool},
+	COM.GAME_WAIT: {'started': bool, 'on_turn': Opt(int)},
+	COM.SHOOT: {'hitted': bool, 'sunken_ship': (None, SHIP), 'game_won': bool},
+	COM.OPPONENT_SHOT: {'shotted': bool, 'pos': Opt(GRID_POS), 'lost': Opt(bool)},
+	COM.AWAIT_REMATCH: {'changed': bool, 'opponent_rematching': Opt(bool), 'opponent_disconnected': Opt(bool), **REMATCHED},
+	COM.UPDATE_REMATCH: {'approved': bool, **REMATCHED},
+	COM.DISCONNECT: {},
+	COM.ERROR: {'error': str, 'error_obj': str},
+}
+
+_REQUEST_VALIDATORS = {command: compileSpec(spec) for command, spec in REQUESTS.items()}
+_RESPONSE_VALIDATORS = {command: compileSpec({**RESPONSE_COMMON, **spec}) for command, spec in RESPONSES.items()}
+UNKNOWN_COMMAND = PayloadError('command', 'unknown command')
+NESTED_BATCH = PayloadError('command', 'batch inside a batch')
+BATCHED_CONNECT = PayloadError('command', 'connect inside a batch') # NOTE it binds the connection the pushes go to, a batch only lends it
+
+def validateRequest(command: str, payload) -> Optional[PayloadError]:
+	validate = _REQUEST_VALIDATORS.get(command)
+	return UNKNOWN_COMMAND if validate is None else validate(payload)
+def validateBatched(command: str, payload) -> Optional[PayloadError]:
+	'''validates one of the requests of a COM.BATCH'''
+	if command == COM.BATCH: return NESTED_BATCH
+	if command == COM.CONNECT: return BATCHED_CONNECT
+	return validateRequest(command, payload)
+def validateResponse(command: str, payload) -> Optional[PayloadError]:
+	validate = _RESPONSE_VALIDATORS.get(command)
+	return UNKNOWN_COMMAND if validate is None else validate(payload)